@@ -0,0 +1,61 @@
+"""indexes for inbox, unread, sent and mark-read access paths
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_sender_id_timestamp_id', 'messages',
+                    ['sender_id', 'timestamp', 'id'])
+    op.create_index('ix_messages_timestamp_id', 'messages',
+                    ['timestamp', 'id'])
+    # Keep one row per recipient of a message: the read one (first read),
+    # else the lowest id
+    op.execute(
+        "DELETE FROM message_recipients WHERE id IN ("
+        " SELECT id FROM ("
+        "  SELECT id, row_number() OVER ("
+        "   PARTITION BY message_id, recipient_id"
+        "   ORDER BY CASE WHEN read THEN 0 ELSE 1 END,"
+        "    CASE WHEN read_at IS NULL THEN 1 ELSE 0 END, read_at, id) AS rank"
+        "  FROM message_recipients) ranked"
+        " WHERE rank > 1)"
+    )
+    # Batch mode, so SQLite rebuilds the table to add the constraint
+    with op.batch_alter_table('message_recipients') as batch_op:
+        batch_op.create_unique_constraint('uq_message_recipients_message_id_recipient_id',
+                                          ['message_id', 'recipient_id'])
+    op.create_index('ix_message_recipients_recipient_id_read_message_id',
+                    'message_recipients', ['recipient_id', 'read', 'message_id'])
+    op.create_index('ix_message_recipients_unread', 'message_recipients',
+                    ['recipient_id', 'message_id'],
+                    postgresql_where=sa.text('read = false'),
+                    sqlite_where=sa.text('read = 0'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_message_recipients_unread',
+                  table_name='message_recipients')
+    op.drop_index('ix_message_recipients_recipient_id_read_message_id',
+                  table_name='message_recipients')
+    with op.batch_alter_table('message_recipients') as batch_op:
+        batch_op.drop_constraint('uq_message_recipients_message_id_recipient_id',
+                                 type_='unique')
+    op.drop_index('ix_messages_timestamp_id', table_name='messages')
+    op.drop_index('ix_messages_sender_id_timestamp_id', table_name='messages')
@@ -0,0 +1,64 @@
+"""full-text search over message subject and content
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # Rewrites messages once to compute the stored column
+        op.execute(
+            "ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', coalesce(subject, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED"
+        )
+        op.execute(
+            "CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5("
+            "subject, content, content='messages', content_rowid='rowid')")
+        op.execute(
+            "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts (rowid, subject, content) "
+            "VALUES (new.rowid, new.subject, new.content); END")
+        op.execute(
+            "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+            "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+            "VALUES ('delete', old.rowid, old.subject, old.content); END")
+        op.execute(
+            "CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN "
+            "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+            "VALUES ('delete', old.rowid, old.subject, old.content); "
+            "INSERT INTO messages_fts (rowid, subject, content) "
+            "VALUES (new.rowid, new.subject, new.content); END")
+        op.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.drop_index('ix_messages_search_vector', table_name='messages')
+        op.drop_column('messages', 'search_vector')
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+        op.execute("DROP TABLE messages_fts")
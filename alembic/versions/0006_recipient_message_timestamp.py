@@ -0,0 +1,89 @@
+"""copy message timestamp onto recipient rows
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _create_sqlite_triggers() -> None:
+    # As created by 0005
+    op.execute(
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        "VALUES (new.rowid, new.subject, new.content); END")
+    op.execute(
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        "VALUES ('delete', old.rowid, old.subject, old.content); END")
+    op.execute(
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        "VALUES ('delete', old.rowid, old.subject, old.content); "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        "VALUES (new.rowid, new.subject, new.content); END")
+
+
+def _drop_sqlite_triggers() -> None:
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+
+
+def _set_timestamp_nullable(nullable: bool) -> None:
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        # The batch rebuild of messages takes the FTS triggers with it
+        _drop_sqlite_triggers()
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=nullable)
+    if sqlite:
+        _create_sqlite_triggers()
+        op.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("UPDATE messages SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL")
+    _set_timestamp_nullable(False)
+
+    op.add_column('message_recipients',
+                  sa.Column('message_timestamp', sa.DateTime(), nullable=True))
+    op.execute(
+        "UPDATE message_recipients SET message_timestamp = "
+        "(SELECT timestamp FROM messages WHERE messages.id = message_recipients.message_id)"
+    )
+    with op.batch_alter_table('message_recipients') as batch_op:
+        batch_op.alter_column('message_timestamp', existing_type=sa.DateTime(), nullable=False)
+
+    op.create_index('ix_message_recipients_inbox', 'message_recipients',
+                    ['recipient_id', 'message_timestamp', 'message_id'], unique=False)
+    op.drop_index('ix_message_recipients_unread', table_name='message_recipients')
+    op.create_index('ix_message_recipients_unread', 'message_recipients',
+                    ['recipient_id', 'message_timestamp', 'message_id'], unique=False,
+                    postgresql_where=sa.text('read = false'),
+                    sqlite_where=sa.text('read = 0'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_message_recipients_unread', table_name='message_recipients')
+    op.create_index('ix_message_recipients_unread', 'message_recipients',
+                    ['recipient_id', 'message_id'], unique=False,
+                    postgresql_where=sa.text('read = false'),
+                    sqlite_where=sa.text('read = 0'))
+    op.drop_index('ix_message_recipients_inbox', table_name='message_recipients')
+    op.drop_column('message_recipients', 'message_timestamp')
+    _set_timestamp_nullable(True)
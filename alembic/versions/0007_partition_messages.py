@@ -0,0 +1,155 @@
+"""optional monthly range partitioning of messages and recipients
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 12:30:00.000000
+
+Only runs on Postgres with DB_PARTITION_MESSAGES=true; otherwise it is a
+no-op. Both tables are rebuilt as tables partitioned by month on
+messages.timestamp / message_recipients.message_timestamp, with a
+default partition for anything outside the monthly ones. Rows are copied
+across, so on a large database run it in a maintenance window; later
+months are created ahead of time by `python -m app.manage partitions`.
+
+"""
+from typing import Sequence, Union
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_VECTOR = (
+    "search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', coalesce(subject, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED"
+)
+
+
+def _enabled() -> bool:
+    return (op.get_bind().dialect.name == 'postgresql'
+            and os.getenv('DB_PARTITION_MESSAGES', 'false').lower() in ('1', 'true', 'yes'))
+
+
+def _is_partitioned() -> bool:
+    return op.get_bind().execute(sa.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('messages'))")).scalar()
+
+
+def _create_tables(partitioned: bool) -> None:
+    messages_key = "PARTITION BY RANGE (timestamp)" if partitioned else ""
+    recipients_key = "PARTITION BY RANGE (message_timestamp)" if partitioned else ""
+    op.execute(f"""
+        CREATE TABLE messages_new (
+            id uuid NOT NULL,
+            subject varchar,
+            content text,
+            sender_id uuid,
+            timestamp timestamp NOT NULL,
+            {SEARCH_VECTOR}
+        ) {messages_key}""")
+    op.execute(f"""
+        CREATE TABLE message_recipients_new (
+            id uuid NOT NULL,
+            message_id uuid,
+            recipient_id uuid,
+            read boolean,
+            read_at timestamp,
+            message_timestamp timestamp NOT NULL
+        ) {recipients_key}""")
+
+
+def _create_partitions() -> None:
+    # One partition per month from the oldest message to two months ahead
+    op.execute("""
+        DO $$
+        DECLARE
+            month date;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', coalesce(min(timestamp), now())),
+                    date_trunc('month', now()) + interval '2 months',
+                    interval '1 month')::date
+                FROM messages
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages_new FOR VALUES FROM (%L) TO (%L)',
+                    'messages_p' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF message_recipients_new FOR VALUES FROM (%L) TO (%L)',
+                    'message_recipients_p' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+            END LOOP;
+        END $$""")
+    op.execute("CREATE TABLE messages_default PARTITION OF messages_new DEFAULT")
+    op.execute("CREATE TABLE message_recipients_default PARTITION OF message_recipients_new DEFAULT")
+
+
+def _swap_tables(partitioned: bool) -> None:
+    """Copy rows into the *_new tables, replace the old ones, then index."""
+    op.execute("INSERT INTO messages_new (id, subject, content, sender_id, timestamp) "
+               "SELECT id, subject, content, sender_id, timestamp FROM messages")
+    op.execute("INSERT INTO message_recipients_new "
+               "(id, message_id, recipient_id, read, read_at, message_timestamp) "
+               "SELECT id, message_id, recipient_id, read, read_at, message_timestamp "
+               "FROM message_recipients")
+    op.execute("DROP TABLE message_recipients")
+    op.execute("DROP TABLE messages")
+    op.execute("ALTER TABLE messages_new RENAME TO messages")
+    op.execute("ALTER TABLE message_recipients_new RENAME TO message_recipients")
+
+    # Unique keys on a partitioned table must include the partition key
+    message_key = "id, timestamp" if partitioned else "id"
+    recipient_key = "id, message_timestamp" if partitioned else "id"
+    recipient_unique = ("message_id, recipient_id, message_timestamp" if partitioned
+                        else "message_id, recipient_id")
+    message_ref = ("(message_id, message_timestamp) REFERENCES messages (id, timestamp)"
+                   if partitioned else "(message_id) REFERENCES messages (id)")
+    op.execute(f"ALTER TABLE messages ADD CONSTRAINT messages_pkey PRIMARY KEY ({message_key})")
+    op.execute("ALTER TABLE messages ADD CONSTRAINT messages_sender_id_fkey "
+               "FOREIGN KEY (sender_id) REFERENCES users (id)")
+    op.execute("CREATE INDEX ix_messages_sender_id_timestamp_id "
+               "ON messages (sender_id, timestamp, id)")
+    op.execute("CREATE INDEX ix_messages_timestamp_id ON messages (timestamp, id)")
+    op.execute("CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)")
+
+    op.execute("ALTER TABLE message_recipients ADD CONSTRAINT message_recipients_pkey "
+               f"PRIMARY KEY ({recipient_key})")
+    op.execute("ALTER TABLE message_recipients ADD CONSTRAINT "
+               f"uq_message_recipients_message_id_recipient_id UNIQUE ({recipient_unique})")
+    op.execute("ALTER TABLE message_recipients ADD CONSTRAINT message_recipients_message_id_fkey "
+               f"FOREIGN KEY {message_ref}")
+    op.execute("ALTER TABLE message_recipients ADD CONSTRAINT message_recipients_recipient_id_fkey "
+               "FOREIGN KEY (recipient_id) REFERENCES users (id)")
+    op.execute("CREATE INDEX ix_message_recipients_recipient_id_read_message_id "
+               "ON message_recipients (recipient_id, read, message_id)")
+    op.execute("CREATE INDEX ix_message_recipients_inbox "
+               "ON message_recipients (recipient_id, message_timestamp, message_id)")
+    op.execute("CREATE INDEX ix_message_recipients_unread "
+               "ON message_recipients (recipient_id, message_timestamp, message_id) "
+               "WHERE read = false")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if not _enabled() or _is_partitioned():
+        return
+    _create_tables(partitioned=True)
+    _create_partitions()
+    _swap_tables(partitioned=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql' or not _is_partitioned():
+        return
+    # Detached or archived partitions are not copied back
+    _create_tables(partitioned=False)
+    _swap_tables(partitioned=False)
@@ -0,0 +1,153 @@
+"""group broadcasts and deduplicated message bodies
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 15:00:00.000000
+
+Bodies stored in message_bodies leave messages.content NULL, so search
+can no longer be a generated column over content: Postgres keeps
+search_vector with a trigger instead, and the SQLite FTS triggers read
+through to message_bodies.
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_BODY = "coalesce({row}.content, (SELECT content FROM message_bodies WHERE hash = {row}.body_hash))"
+
+
+def _create_sqlite_triggers(body: str) -> None:
+    op.execute(
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        f"VALUES (new.rowid, new.subject, {body.format(row='new')}); END")
+    op.execute(
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        f"VALUES ('delete', old.rowid, old.subject, {body.format(row='old')}); END")
+    op.execute(
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        f"VALUES ('delete', old.rowid, old.subject, {body.format(row='old')}); "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        f"VALUES (new.rowid, new.subject, {body.format(row='new')}); END")
+
+
+def _drop_sqlite_triggers() -> None:
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    op.create_table('groups',
+                    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('message_count', sa.BigInteger(), server_default='0',
+                              nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('name')
+                    )
+    op.create_table('group_members',
+                    sa.Column('group_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('joined_at', sa.DateTime(), nullable=True),
+                    sa.Column('synced_seq', sa.BigInteger(), server_default='0',
+                              nullable=False),
+                    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+                    sa.PrimaryKeyConstraint('group_id', 'user_id')
+                    )
+    op.create_index(op.f('ix_group_members_user_id'), 'group_members', ['user_id'], unique=False)
+    op.create_table('message_bodies',
+                    sa.Column('hash', sa.String(length=64), nullable=False),
+                    sa.Column('content', sa.Text(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash')
+                    )
+
+    if dialect == 'sqlite':
+        # The batch rebuild of messages takes the FTS triggers with it
+        _drop_sqlite_triggers()
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('body_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('group_id', postgresql.UUID(as_uuid=True), nullable=True))
+        batch_op.add_column(sa.Column('group_seq', sa.BigInteger(), nullable=True))
+        batch_op.create_foreign_key('messages_body_hash_fkey', 'message_bodies',
+                                    ['body_hash'], ['hash'])
+        batch_op.create_foreign_key('messages_group_id_fkey', 'groups', ['group_id'], ['id'])
+        batch_op.create_index('ix_messages_group_id_group_seq', ['group_id', 'group_seq'],
+                              unique=False)
+
+    if dialect == 'postgresql':
+        op.execute("ALTER TABLE messages ALTER COLUMN search_vector DROP EXPRESSION")
+        op.execute(
+            "CREATE OR REPLACE FUNCTION messages_search_vector() RETURNS trigger "
+            "LANGUAGE plpgsql AS $$ BEGIN NEW.search_vector := "
+            "setweight(to_tsvector('english', coalesce(NEW.subject, '')), 'A') || "
+            f"setweight(to_tsvector('english', coalesce({SEARCH_BODY.format(row='NEW')}, '')), 'B'); "
+            "RETURN NEW; END $$")
+        op.execute(
+            "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF subject, content, body_hash "
+            "ON messages FOR EACH ROW EXECUTE FUNCTION messages_search_vector()")
+    elif dialect == 'sqlite':
+        _create_sqlite_triggers(SEARCH_BODY)
+        op.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    # Put shared bodies back inline, and give members recipient rows for
+    # broadcasts they haven't been synced to yet (run reconcile-unread after)
+    op.execute(
+        "UPDATE messages SET content = (SELECT content FROM message_bodies "
+        "WHERE message_bodies.hash = messages.body_hash) WHERE body_hash IS NOT NULL")
+    if dialect == 'postgresql':
+        op.execute(
+            "INSERT INTO message_recipients "
+            "(id, message_id, recipient_id, read, message_timestamp) "
+            "SELECT gen_random_uuid(), messages.id, group_members.user_id, false, messages.timestamp "
+            "FROM group_members JOIN messages ON messages.group_id = group_members.group_id "
+            "AND messages.group_seq > group_members.synced_seq")
+        op.execute("DROP TRIGGER messages_search_vector ON messages")
+        op.execute("DROP FUNCTION messages_search_vector()")
+        op.drop_index('ix_messages_search_vector', table_name='messages')
+        op.drop_column('messages', 'search_vector')
+        op.execute(
+            "ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', coalesce(subject, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED"
+        )
+        op.execute(
+            "CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)")
+    elif dialect == 'sqlite':
+        _drop_sqlite_triggers()
+
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_index('ix_messages_group_id_group_seq')
+        batch_op.drop_constraint('messages_group_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('messages_body_hash_fkey', type_='foreignkey')
+        batch_op.drop_column('group_seq')
+        batch_op.drop_column('group_id')
+        batch_op.drop_column('body_hash')
+
+    if dialect == 'sqlite':
+        _create_sqlite_triggers("{row}.content")
+        op.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    op.drop_table('message_bodies')
+    op.drop_index(op.f('ix_group_members_user_id'), table_name='group_members')
+    op.drop_table('group_members')
+    op.drop_table('groups')
@@ -0,0 +1,40 @@
+"""idempotency keys for message sends
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0009'
+down_revision: Union[str, None] = '0008'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('idempotency_keys',
+                    sa.Column('sender_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('key', sa.String(length=255), nullable=False),
+                    sa.Column('message_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('request_hash', sa.String(length=64), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['sender_id'], ['users.id'], ),
+                    sa.PrimaryKeyConstraint('sender_id', 'key')
+                    )
+    op.create_index(op.f('ix_idempotency_keys_created_at'), 'idempotency_keys',
+                    ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_idempotency_keys_created_at'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
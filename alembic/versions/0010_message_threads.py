@@ -0,0 +1,39 @@
+"""message threads
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 18:00:00.000000
+
+Existing messages keep a NULL thread_id and are read as threads of their
+own, so the upgrade adds nullable columns without rewriting the table.
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0010'
+down_revision: Union[str, None] = '0009'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('thread_id', postgresql.UUID(as_uuid=True), nullable=True))
+        batch_op.add_column(sa.Column('parent_id', postgresql.UUID(as_uuid=True), nullable=True))
+    op.create_index('ix_messages_thread_id_timestamp_id', 'messages',
+                    ['thread_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_thread_id_timestamp_id', table_name='messages')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('parent_id')
+        batch_op.drop_column('thread_id')
@@ -0,0 +1,40 @@
+"""outbox for queued message deliveries
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 19:00:00.000000
+
+Downgrading drops deliveries still queued; drain the outbox first
+(python -m app.outbox --once).
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0011'
+down_revision: Union[str, None] = '0010'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('message_outbox',
+                    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                              autoincrement=True, nullable=False),
+                    sa.Column('message_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('message_timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('recipient_ids', sa.JSON(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('message_outbox')
@@ -0,0 +1,35 @@
+"""slot to shard map for mailboxes sharded by user id
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18 21:00:00.000000
+
+Run on every shard; only shard 0's table is used.
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0012'
+down_revision: Union[str, None] = '0011'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('shard_slots',
+                    sa.Column('slot', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('shard', sa.Integer(), nullable=False),
+                    sa.Column('moved_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('slot')
+                    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('shard_slots')
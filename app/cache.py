@@ -0,0 +1,200 @@
+# Response cache for mailbox listings
+#
+# Pages are cached as rendered JSON under keys that include a per-user
+# generation token. Writers replace the token of every affected user,
+# which orphans that user's cached pages without having to find them.
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable, Optional
+import math
+import os
+import time
+import uuid
+
+from . import metrics
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+# Generation tokens outlive the pages keyed on them; one that expires only
+# costs its user a fresh token and a miss
+CACHE_GENERATION_TTL = float(os.getenv("CACHE_GENERATION_TTL", "86400"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+
+cache_hits = metrics.Counter("cache_hits_total", "Mailbox cache hits")
+cache_misses = metrics.Counter("cache_misses_total", "Mailbox cache misses")
+cache_evictions = metrics.Counter(
+    "cache_evictions_total", "Mailbox cache entries evicted to stay under the size limit")
+
+
+class LRUCache:
+    """In-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = Lock()
+
+    async def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = -1):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    async def set_many(self, mapping: dict, ttl: Optional[float] = -1):
+        for key, value in mapping.items():
+            await self.set(key, value, ttl)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = -1) -> bool:
+        """Set unless the key exists; returns True if it was set."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.monotonic()):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def _set(self, key, value, ttl):
+        ttl = self.ttl if ttl == -1 else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            cache_evictions.inc()
+
+
+class RedisCache:
+    """Backend for any Redis-protocol server, via an asyncio client."""
+
+    def __init__(self, client, ttl: float = CACHE_TTL):
+        self.client = client
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str = CACHE_URL, ttl: float = CACHE_TTL):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError(
+                "CACHE_BACKEND=redis requires the 'redis' package")
+        return cls(redis.Redis.from_url(url, decode_responses=True), ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(key)
+
+    def _px(self, ttl: Optional[float]) -> Optional[int]:
+        # Milliseconds, rounded up: Redis rejects an expiry of 0
+        ttl = self.ttl if ttl == -1 else ttl
+        return math.ceil(ttl * 1000) if ttl else None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = -1):
+        await self.client.set(key, value, px=self._px(ttl))
+
+    async def set_many(self, mapping: dict, ttl: Optional[float] = -1):
+        px = self._px(ttl)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, px=px)
+            await pipe.execute()
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = -1) -> bool:
+        return bool(await self.client.set(key, value, px=self._px(ttl), nx=True))
+
+
+class NullCache:
+    async def get(self, key):
+        return None
+
+    async def set(self, key, value, ttl=-1):
+        pass
+
+    async def set_many(self, mapping, ttl=-1):
+        pass
+
+    async def add(self, key, value, ttl=-1):
+        return False
+
+
+def build_cache(backend: str = CACHE_BACKEND):
+    if backend == "memory":
+        return LRUCache()
+    if backend == "redis":
+        return RedisCache.from_url()
+    if backend == "none":
+        return NullCache()
+    raise ValueError(f"Unknown CACHE_BACKEND {backend!r}")
+
+
+mailbox_cache = build_cache()
+
+# Mailbox pages
+
+
+def _generation_key(user_id: uuid.UUID) -> str:
+    return f"mailbox-gen:{user_id}"
+
+
+async def _generation(user_id: uuid.UUID) -> str:
+    key = _generation_key(user_id)
+    generation = await mailbox_cache.get(key)
+    if generation is None:
+        # Tokens are random, so an evicted generation is never reused
+        await mailbox_cache.add(key, uuid.uuid4().hex, ttl=CACHE_GENERATION_TTL)
+        generation = await mailbox_cache.get(key)
+    return generation
+
+
+async def page_key(user_id: uuid.UUID, view: str, cursor: Optional[str], limit: int) -> str:
+    generation = await _generation(user_id)
+    return f"mailbox:{user_id}:{generation}:{view}:{cursor or ''}:{limit}"
+
+
+async def get_page(key: str) -> Optional[str]:
+    page = await mailbox_cache.get(key)
+    if page is None:
+        cache_misses.inc()
+    else:
+        cache_hits.inc()
+    return page
+
+
+async def set_page(key: str, page: str):
+    await mailbox_cache.set(key, page)
+
+
+async def invalidate(user_ids: Iterable[uuid.UUID]):
+    await mailbox_cache.set_many(
+        {_generation_key(user_id): uuid.uuid4().hex for user_id in set(user_ids)},
+        ttl=CACHE_GENERATION_TTL)
+
+# Read-your-writes
+#
+# Users who just wrote are remembered for a few seconds, and their reads
+# go to the primary rather than a replica that may lag. Shared across
+# workers only with a shared backend (CACHE_BACKEND=redis).
+
+
+def _write_key(user_id: uuid.UUID) -> str:
+    return f"recent-write:{user_id}"
+
+
+async def remember_writes(user_ids: Iterable[uuid.UUID], seconds: float):
+    await mailbox_cache.set_many(
+        {_write_key(user_id): "1" for user_id in set(user_ids)}, ttl=seconds)
+
+
+async def wrote_recently(user_id: uuid.UUID) -> bool:
+    return await mailbox_cache.get(_write_key(user_id)) is not None
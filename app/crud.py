@@ -0,0 +1,1270 @@
+# Database queries shared by the REST routes and the MCP tools
+
+from sqlalchemy import BigInteger, DateTime, Integer, String, and_, any_, bindparam, case, cast, column, delete, exists, false, func, insert, literal, literal_column, or_, select, table, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, Query, selectinload
+from typing import Iterable, List, Optional, Sequence, Tuple
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import base64
+import binascii
+import hashlib
+import json
+import os
+import uuid
+
+from . import models, partitions
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class EmailTaken(ValueError):
+    def __init__(self, email: str):
+        self.email = email
+        super().__init__(f"User with email {email} already exists")
+
+
+class UnknownUsers(ValueError):
+    def __init__(self, user_ids: Iterable[uuid.UUID]):
+        self.user_ids = sorted(str(user_id) for user_id in user_ids)
+        super().__init__(f"Unknown user ids: {', '.join(self.user_ids)}")
+
+
+class IdempotentReplay(Exception):
+    """The idempotency key was already used for this exact send."""
+
+    def __init__(self, message_id: uuid.UUID):
+        self.message_id = message_id
+        super().__init__(f"Already sent as message {message_id}")
+
+
+class IdempotencyKeyReused(ValueError):
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__(f"Idempotency key {key!r} was already used for a different message")
+
+
+class GroupNameTaken(ValueError):
+    def __init__(self, name: str):
+        self.name = name
+        super().__init__(f"Group with name {name} already exists")
+
+
+class NotAParticipant(ValueError):
+    def __init__(self, user_id: uuid.UUID, message_id: uuid.UUID):
+        self.user_id = user_id
+        self.message_id = message_id
+        super().__init__(f"User {user_id} did not send or receive message {message_id}")
+
+# Cursor helpers
+
+
+def encode_cursor(timestamp: datetime, message_id: uuid.UUID) -> str:
+    raw = f"{timestamp.isoformat()}|{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), uuid.UUID(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+
+
+def _window_env(value: str) -> Tuple[timedelta, ...]:
+    return tuple(timedelta(days=int(days)) for days in value.split(",") if days.strip())
+
+
+# Listings on partitioned tables look back through these windows in turn
+# (newest first) until a page fills, so each query is bounded in time and
+# only touches the partitions it needs; the last step is unbounded, so no
+# message is missed. Unpartitioned, the index alone bounds a listing.
+LISTING_WINDOWS = _window_env(os.getenv("LISTING_WINDOW_DAYS", "30,365"))
+
+
+def paginate_messages(
+    query: Query, cursor: Optional[str], limit: int, keys=None,
+    windows: Optional[Sequence[timedelta]] = None
+) -> Tuple[List[models.Message], Optional[str]]:
+    """Keyset pagination on (timestamp, id), newest first.
+
+    ``keys`` are the (timestamp, id) columns to page on, by default the
+    message's own. The windows are disjoint time ranges below the cursor,
+    so a page is the concatenation of at most len(windows) + 1 queries;
+    by default LISTING_WINDOWS when messages is partitioned, else none.
+    """
+    if windows is None:
+        windows = LISTING_WINDOWS if partitions.listings_partitioned(query.session) else ()
+    timestamp_key, id_key = keys or (models.Message.timestamp, models.Message.id)
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        # The plain bound is implied by the row comparison, but only it
+        # lets Postgres prune partitions newer than the cursor
+        query = query.filter(tuple_(timestamp_key, id_key) < tuple_(timestamp, message_id),
+                             timestamp_key <= timestamp)
+        upper = timestamp
+    else:
+        upper = models.utcnow()
+    query = query.order_by(timestamp_key.desc(), id_key.desc())
+
+    rows = []
+    newer = None
+    for floor in [upper - window for window in windows] + [None]:
+        step = query
+        if newer is not None:
+            step = step.filter(timestamp_key < newer)
+        if floor is not None:
+            step = step.filter(timestamp_key >= floor)
+        rows.extend(step.limit(limit + 1 - len(rows)).all())
+        if len(rows) > limit:
+            break
+        newer = floor
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
+
+# Users
+
+
+def create_user(db: Session, email: str, name: str) -> models.User:
+    db_user = models.User(email=email, name=name)
+    db.add(db_user)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise EmailTaken(email)
+    db.refresh(db_user)
+    return db_user
+
+
+def _encode_email_cursor(email: str) -> str:
+    return base64.urlsafe_b64encode(email.encode()).decode().rstrip("=")
+
+
+def _decode_email_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+
+
+def list_users(db: Session, email_prefix: Optional[str] = None, cursor: Optional[str] = None,
+               limit: int = DEFAULT_PAGE_SIZE) -> Tuple[List[models.User], Optional[str]]:
+    """Keyset pagination in email order, walking ix_users_email.
+
+    The prefix filter is a LIKE 'prefix%' the planner turns into a range
+    on the same index (under a C collation; other collations need a
+    text_pattern_ops index for that).
+    """
+    query = db.query(models.User)
+    if email_prefix:
+        query = query.filter(models.User.email.startswith(email_prefix, autoescape=True))
+    if cursor:
+        query = query.filter(models.User.email > _decode_email_cursor(cursor))
+    users = query.order_by(models.User.email).limit(limit + 1).all()
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = _encode_email_cursor(users[-1].email)
+    return users, next_cursor
+
+
+def get_user(db: Session, user_id: uuid.UUID) -> Optional[models.User]:
+    return db.query(models.User).filter(models.User.id == user_id).first()
+
+
+def get_users(db: Session, user_ids: Iterable[uuid.UUID]) -> List[models.User]:
+    """Users by id in request order; unknown ids are left out."""
+    user_ids = list(dict.fromkeys(user_ids))
+    found = {user.id: user for user in
+             db.query(models.User).filter(models.User.id.in_(user_ids))}
+    return [found[user_id] for user_id in user_ids if user_id in found]
+
+
+# Postgres bulk insert from unnest()ed arrays: one statement and four
+# parameters however many users are imported
+_new_users = func.unnest(
+    bindparam("ids", type_=ARRAY(UUID(as_uuid=True))),
+    bindparam("emails", type_=ARRAY(String)),
+    bindparam("names", type_=ARRAY(String)),
+    bindparam("created_ats", type_=ARRAY(DateTime)),
+).table_valued("id", "email", "name", "created_at").render_derived(name="new_users")
+
+_USERS_INSERT = (
+    postgresql.insert(models.User.__table__)
+    .from_select(["id", "email", "name", "created_at"], select(_new_users))
+    .on_conflict_do_nothing(index_elements=["email"])
+    .returning(*models.User.__table__.c)
+)
+
+
+def create_users(db: Session, users: Iterable[Tuple[str, str]]):
+    """Insert (email, name) pairs, skipping emails that already exist.
+
+    Returns (created rows, emails skipped). Duplicate emails within the
+    batch keep their first name.
+    """
+    names = {}
+    for email, name in users:
+        names.setdefault(email, name)
+    if not names:
+        return [], []
+    now = models.utcnow()
+    if db.get_bind().dialect.name == "postgresql":
+        created = db.execute(_USERS_INSERT, {
+            "ids": [uuid.uuid4() for _ in names],
+            "emails": list(names),
+            "names": list(names.values()),
+            "created_ats": [now] * len(names)
+        }).all()
+    else:
+        table = models.User.__table__
+        stmt = (
+            sqlite.insert(table)
+            .on_conflict_do_nothing(index_elements=["email"])
+            .returning(*table.c)
+        )
+        created = db.execute(stmt, [
+            {"id": uuid.uuid4(), "email": email, "name": name, "created_at": now}
+            for email, name in names.items()
+        ]).all()
+    db.commit()
+    created_emails = {user.email for user in created}
+    return created, [email for email in names if email not in created_emails]
+
+# Sending
+
+# Postgres fan-out: validates recipients and inserts their rows in one
+# INSERT ... SELECT over unnest()ed arrays of client-side ids.
+_fanout = func.unnest(
+    bindparam("row_ids", type_=ARRAY(UUID(as_uuid=True))),
+    bindparam("recipient_ids", type_=ARRAY(UUID(as_uuid=True))),
+).table_valued("id", "recipient_id").render_derived(name="fanout")
+
+_FANOUT_INSERT = insert(models.MessageRecipient.__table__).from_select(
+    ["id", "message_id", "recipient_id", "read", "message_timestamp"],
+    select(
+        _fanout.c.id,
+        bindparam("message_id", type_=UUID(as_uuid=True)),
+        _fanout.c.recipient_id,
+        false(),
+        bindparam("message_timestamp", type_=DateTime)
+    ).join(models.User, models.User.id == _fanout.c.recipient_id)
+)
+
+
+def _upsert(db: Session, table):
+    dialect = db.get_bind().dialect.name
+    return (postgresql.insert if dialect == "postgresql" else sqlite.insert)(table)
+
+
+def _bump_unread_counts(db: Session, user_ids: Iterable[uuid.UUID]):
+    # A user listed n times gains n unread. Sorted so concurrent sends lock
+    # counter rows in the same order.
+    counts = Counter(user_ids)
+    user_ids = sorted(counts)
+    amounts = [counts[user_id] for user_id in user_ids]
+    stats = models.UserMailboxStats.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        bumped = func.unnest(
+            bindparam("user_ids", type_=ARRAY(UUID(as_uuid=True))),
+            bindparam("amounts", type_=ARRAY(Integer))
+        ).table_valued("user_id", "amount").render_derived(name="bumped")
+        stmt = postgresql.insert(stats).from_select(
+            ["user_id", "unread_count", "version"],
+            select(bumped.c.user_id, bumped.c.amount, literal(1))
+        )
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[stats.c.user_id],
+            set_={"unread_count": stats.c.unread_count + stmt.excluded.unread_count,
+                  "version": stats.c.version + 1}
+        ), {"user_ids": user_ids, "amounts": amounts})
+    else:
+        stmt = _upsert(db, stats).values(version=1)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[stats.c.user_id],
+            set_={"unread_count": stats.c.unread_count + stmt.excluded.unread_count,
+                  "version": stats.c.version + 1}
+        ), [{"user_id": user_id, "unread_count": amount}
+            for user_id, amount in zip(user_ids, amounts)])
+
+
+# Bodies at least this long (UTF-8 bytes) are stored once per distinct
+# content in message_bodies and referenced by hash
+BODY_DEDUP_BYTES = int(os.getenv("BODY_DEDUP_BYTES", "4096"))
+
+
+def _store_body(db: Session, content: str) -> dict:
+    """Message column values for a body: inline, or by hash when large."""
+    encoded = content.encode()
+    if len(encoded) < BODY_DEDUP_BYTES:
+        return {"stored_content": content, "body_hash": None}
+    body_hash = hashlib.sha256(encoded).hexdigest()
+    db.execute(
+        _upsert(db, models.MessageBody.__table__)
+        .values(hash=body_hash, content=content)
+        .on_conflict_do_nothing(index_elements=["hash"])
+    )
+    return {"stored_content": None, "body_hash": body_hash}
+
+
+# Sends to at least this many recipients are queued: the message commits
+# with outbox entries of OUTBOX_CHUNK recipients each, and the worker in
+# app.outbox writes their rows later
+OUTBOX_MIN_RECIPIENTS = int(os.getenv("OUTBOX_MIN_RECIPIENTS", "1000"))
+OUTBOX_CHUNK = int(os.getenv("OUTBOX_CHUNK", "5000"))
+
+
+def delivers_later(recipient_ids: Sequence[uuid.UUID]) -> bool:
+    """Whether a send to these recipients goes through the outbox."""
+    return len(set(recipient_ids)) >= OUTBOX_MIN_RECIPIENTS
+
+
+def _missing_users(db: Session, user_ids: Iterable[uuid.UUID]) -> set:
+    wanted = set(user_ids)
+    found = set(db.scalars(
+        select(models.User.id).where(models.User.id.in_(wanted))))
+    return wanted - found
+
+
+def _send_hash(recipient_ids: List[uuid.UUID], subject: Optional[str], content: str,
+               parent_id: Optional[uuid.UUID] = None) -> str:
+    request = [sorted(str(recipient_id) for recipient_id in recipient_ids), subject, content]
+    if parent_id is not None:
+        request.append(str(parent_id))
+    request = json.dumps(request)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def _check_idempotency_key(db: Session, sender_id: uuid.UUID, key: str, request_hash: str):
+    """Raise IdempotentReplay (or IdempotencyKeyReused) if the key is taken."""
+    keys = models.IdempotencyKey.__table__
+    row = db.execute(
+        select(keys.c.message_id, keys.c.request_hash)
+        .where(keys.c.sender_id == sender_id, keys.c.key == key)
+    ).first()
+    if row is None:
+        return
+    if row.request_hash != request_hash:
+        raise IdempotencyKeyReused(key)
+    raise IdempotentReplay(row.message_id)
+
+
+def send_message(db: Session, sender_id: uuid.UUID, recipient_ids: Iterable[uuid.UUID],
+                 content: str, subject: Optional[str] = None,
+                 idempotency_key: Optional[str] = None,
+                 thread_id: Optional[uuid.UUID] = None,
+                 parent_id: Optional[uuid.UUID] = None,
+                 message_id: Optional[uuid.UUID] = None,
+                 timestamp: Optional[datetime] = None,
+                 queue: Optional[bool] = None,
+                 request_hash: Optional[str] = None) -> models.Message:
+    """Insert a message and its recipient rows in a single transaction.
+
+    Ids are generated client side so the recipient rows can be written
+    in one statement instead of one ORM object per recipient. A message
+    without a thread_id starts its own thread. Sends that delivers_later()
+    (or with queue set) commit the message with outbox entries instead of
+    recipient rows. message_id, timestamp and request_hash (of the whole
+    send, not this shard's recipients) are given by sharding.py, which
+    writes the same message to several shards.
+
+    With an idempotency_key, a retry of the same send raises
+    IdempotentReplay with the original message id after one primary-key
+    lookup. The key is claimed in the sending transaction, before the
+    fan-out, so concurrent retries wait on each other and only one of them
+    writes recipient rows.
+    """
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+    if idempotency_key is not None:
+        request_hash = request_hash or _send_hash(recipient_ids, subject, content, parent_id)
+        _check_idempotency_key(db, sender_id, idempotency_key, request_hash)
+    postgres = db.get_bind().dialect.name == "postgresql"
+    queued = bool(recipient_ids) and (delivers_later(recipient_ids) if queue is None else queue)
+    if queued and postgres:
+        # The worker can't reject the send, so recipients are checked now
+        found = db.scalar(
+            select(func.count()).select_from(models.User)
+            .where(models.User.id == any_(
+                bindparam("user_ids", recipient_ids, type_=ARRAY(UUID(as_uuid=True))))))
+        if found != len(recipient_ids):
+            raise UnknownUsers(_missing_users(db, recipient_ids))
+    elif not postgres:
+        missing = _missing_users(db, recipient_ids + [sender_id])
+        if missing:
+            raise UnknownUsers(missing)
+
+    message_id = message_id or uuid.uuid4()
+    message = models.Message(
+        id=message_id,
+        sender_id=sender_id,
+        subject=subject,
+        content=content,
+        timestamp=timestamp or models.utcnow(),
+        thread_id=thread_id or message_id,
+        parent_id=parent_id
+    )
+    try:
+        db.execute(insert(models.Message).values(
+            id=message.id,
+            sender_id=message.sender_id,
+            subject=message.subject,
+            timestamp=message.timestamp,
+            thread_id=message.thread_id,
+            parent_id=parent_id,
+            **_store_body(db, content)
+        ))
+    except IntegrityError:
+        db.rollback()
+        if idempotency_key is not None:
+            # A message id derived from the key (sharding.py) collides when
+            # a concurrent retry committed first: that's a replay
+            _check_idempotency_key(db, sender_id, idempotency_key, request_hash)
+        raise UnknownUsers([sender_id])
+
+    if idempotency_key is not None:
+        keys = models.IdempotencyKey.__table__
+        claimed = db.scalar(
+            _upsert(db, keys)
+            .values(sender_id=sender_id, key=idempotency_key, message_id=message.id,
+                    request_hash=request_hash, created_at=message.timestamp)
+            .on_conflict_do_nothing(index_elements=["sender_id", "key"])
+            .returning(keys.c.message_id)
+        )
+        if claimed is None:
+            # A concurrent send with the same key committed first
+            db.rollback()
+            _check_idempotency_key(db, sender_id, idempotency_key, request_hash)
+            return send_message(db, sender_id, recipient_ids, content, subject,
+                                idempotency_key, thread_id, parent_id,
+                                message_id, timestamp, queue, request_hash)
+
+    if queued:
+        db.execute(insert(models.OutboxEntry), [
+            {"message_id": message.id, "message_timestamp": message.timestamp,
+             "recipient_ids": [str(recipient_id)
+                               for recipient_id in recipient_ids[start:start + OUTBOX_CHUNK]],
+             "created_at": message.timestamp}
+            for start in range(0, len(recipient_ids), OUTBOX_CHUNK)
+        ])
+    elif recipient_ids and postgres:
+        inserted = db.execute(_FANOUT_INSERT, {
+            "row_ids": [uuid.uuid4() for _ in recipient_ids],
+            "recipient_ids": recipient_ids,
+            "message_id": message.id,
+            "message_timestamp": message.timestamp
+        }).rowcount
+        if inserted != len(recipient_ids):
+            db.rollback()
+            raise UnknownUsers(_missing_users(db, recipient_ids))
+    elif recipient_ids:
+        db.execute(insert(models.MessageRecipient), [
+            {"id": uuid.uuid4(), "message_id": message.id,
+             "recipient_id": recipient_id, "read": False,
+             "message_timestamp": message.timestamp}
+            for recipient_id in recipient_ids
+        ])
+    if recipient_ids and not queued:
+        _bump_unread_counts(db, recipient_ids)
+    db.commit()
+    return message
+
+
+def deliver_outbox(db: Session, batch_size: int = 1) -> list:
+    """Write the recipient rows of up to batch_size queued outbox entries.
+
+    Entries are claimed with FOR UPDATE SKIP LOCKED, so any number of
+    workers can drain the outbox side by side, and each is removed in the
+    transaction that delivers it. Returns one row per entry delivered, with
+    the message's id, sender_id, subject and timestamp, its recipient_ids
+    and the entry's created_at.
+    """
+    outbox = models.OutboxEntry.__table__
+    messages = models.Message.__table__
+    entries = db.execute(
+        select(outbox.c.id.label("entry_id"), messages.c.id, messages.c.sender_id,
+               messages.c.subject, outbox.c.message_timestamp.label("timestamp"),
+               outbox.c.recipient_ids, outbox.c.created_at)
+        .outerjoin(messages, and_(messages.c.id == outbox.c.message_id,
+                                  messages.c.timestamp == outbox.c.message_timestamp))
+        .order_by(outbox.c.id)
+        .limit(batch_size)
+        .with_for_update(of=outbox, skip_locked=True)
+    ).all()
+    if not entries:
+        return []
+    postgres = db.get_bind().dialect.name == "postgresql"
+    delivered = []
+    for entry in entries:
+        if entry.id is None:
+            # The message was deleted while queued
+            continue
+        recipient_ids = [uuid.UUID(recipient_id) for recipient_id in entry.recipient_ids]
+        if postgres:
+            db.execute(_FANOUT_INSERT, {
+                "row_ids": [uuid.uuid4() for _ in recipient_ids],
+                "recipient_ids": recipient_ids,
+                "message_id": entry.id,
+                "message_timestamp": entry.timestamp
+            })
+        else:
+            db.execute(insert(models.MessageRecipient), [
+                {"id": uuid.uuid4(), "message_id": entry.id,
+                 "recipient_id": recipient_id, "read": False,
+                 "message_timestamp": entry.timestamp}
+                for recipient_id in recipient_ids
+            ])
+        delivered.append(entry)
+    if delivered:
+        # One pass over the whole batch keeps the counter locks in order
+        _bump_unread_counts(db, [uuid.UUID(recipient_id) for entry in delivered
+                                 for recipient_id in entry.recipient_ids])
+    db.execute(delete(outbox).where(outbox.c.id.in_([entry.entry_id for entry in entries])))
+    db.commit()
+    return delivered
+
+
+def delivery_pending(db: Session, message_id: uuid.UUID) -> bool:
+    """Whether the message still has outbox entries waiting for the worker."""
+    outbox = models.OutboxEntry.__table__
+    return db.scalar(select(exists().where(outbox.c.message_id == message_id)))
+
+
+def outbox_stats(db: Session) -> Tuple[int, Optional[datetime]]:
+    """Entries queued in the outbox and when the oldest was queued."""
+    outbox = models.OutboxEntry.__table__
+    return tuple(db.execute(
+        select(func.count(), func.min(outbox.c.created_at)).select_from(outbox)).one())
+
+
+def prune_idempotency_keys(db: Session, older_than: datetime) -> int:
+    """Forget keys created before older_than; returns the number removed."""
+    keys = models.IdempotencyKey.__table__
+    removed = db.execute(delete(keys).where(keys.c.created_at < older_than)).rowcount
+    db.commit()
+    return removed
+
+# Groups and broadcasts
+#
+# A broadcast is one message row addressed to a group and numbered by the
+# group's message_count. Members get recipient rows lazily:
+# sync_group_deliveries creates the rows for broadcasts past their
+# synced_seq. Writes to a mailbox sync it themselves; listings of received
+# messages don't write, so their callers sync first (with
+# has_pending_broadcasts to stay on a replica when there's nothing to do).
+# Sending is O(1) in the group size, and members who never open their
+# mailbox cost no rows. Until then their pending broadcasts are counted
+# from the sequence numbers alone.
+
+
+# Postgres membership insert: unnests the user ids and joins users, so
+# unknown ids are left out rather than failing the foreign key
+_new_members = func.unnest(
+    bindparam("user_ids", type_=ARRAY(UUID(as_uuid=True)))
+).table_valued("user_id").render_derived(name="new_members")
+
+_MEMBERS_INSERT = (
+    postgresql.insert(models.GroupMember.__table__)
+    .from_select(
+        ["group_id", "user_id", "joined_at", "synced_seq"],
+        select(
+            bindparam("group_id", type_=UUID(as_uuid=True)),
+            _new_members.c.user_id,
+            bindparam("joined_at", type_=DateTime),
+            bindparam("synced_seq", type_=BigInteger)
+        ).join(models.User, models.User.id == _new_members.c.user_id)
+    )
+    .on_conflict_do_nothing(index_elements=["group_id", "user_id"])
+    .returning(models.GroupMember.__table__.c.user_id)
+)
+
+
+def create_group(db: Session, name: str,
+                 member_ids: Iterable[uuid.UUID] = ()) -> models.Group:
+    group = models.Group(id=uuid.uuid4(), name=name, created_at=models.utcnow())
+    db.add(group)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise GroupNameTaken(name)
+    add_group_members(db, group.id, member_ids)
+    db.refresh(group)
+    return group
+
+
+def get_group(db: Session, group_id: uuid.UUID) -> Optional[models.Group]:
+    return db.get(models.Group, group_id)
+
+
+def get_group_members_among(db: Session, group_id: uuid.UUID,
+                            user_ids: Iterable[uuid.UUID]) -> List[uuid.UUID]:
+    """Those of user_ids who are members of the group."""
+    return list(db.scalars(
+        select(models.GroupMember.user_id)
+        .where(models.GroupMember.group_id == group_id,
+               models.GroupMember.user_id.in_(list(user_ids)))))
+
+
+def add_group_members(db: Session, group_id: uuid.UUID,
+                      user_ids: Iterable[uuid.UUID]) -> List[uuid.UUID]:
+    """Add users to a group; returns the ids that weren't members yet.
+
+    New members start synced to the group's latest broadcast, so they only
+    receive what is sent after they join.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        db.commit()
+        return []
+    members = models.GroupMember.__table__
+    params = {
+        "group_id": group_id,
+        "joined_at": models.utcnow(),
+        "synced_seq": db.scalar(
+            select(models.Group.message_count).where(models.Group.id == group_id))
+    }
+    if db.get_bind().dialect.name == "postgresql":
+        added = list(db.scalars(_MEMBERS_INSERT, {**params, "user_ids": user_ids}))
+        # Ids already in the group also come up short; only look if so
+        missing = _missing_users(db, user_ids) if len(added) < len(user_ids) else None
+    else:
+        missing = _missing_users(db, user_ids)
+        stmt = (
+            sqlite.insert(members)
+            .on_conflict_do_nothing(index_elements=["group_id", "user_id"])
+            .returning(members.c.user_id)
+        )
+        added = [] if missing else list(db.scalars(stmt, [
+            {**params, "user_id": user_id} for user_id in user_ids
+        ]))
+    if missing:
+        db.rollback()
+        raise UnknownUsers(missing)
+    db.commit()
+    return added
+
+
+def remove_group_member(db: Session, group_id: uuid.UUID, user_id: uuid.UUID) -> bool:
+    """Remove a member, keeping the broadcasts they received; False if not a member."""
+    sync_group_deliveries(db, user_id)
+    members = models.GroupMember.__table__
+    removed = db.execute(
+        delete(members)
+        .where(members.c.group_id == group_id, members.c.user_id == user_id)
+        .returning(members.c.user_id)
+    ).first()
+    if removed:
+        # The group's count leaves the mailbox version; step past it so
+        # the version never repeats (see get_mailbox_version)
+        message_count = db.scalar(
+            select(models.Group.message_count).where(models.Group.id == group_id))
+        stats = models.UserMailboxStats.__table__
+        stmt = _upsert(db, stats).values(
+            user_id=user_id, unread_count=0, version=message_count + 1)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[stats.c.user_id],
+            set_={"version": stats.c.version + message_count + 1}
+        ))
+    db.commit()
+    return removed is not None
+
+
+def broadcast_message(db: Session, sender_id: uuid.UUID, group_id: uuid.UUID,
+                      content: str, subject: Optional[str] = None) -> Optional[models.Message]:
+    """Send a message to every member of a group; None if there is no such group.
+
+    The group row is locked while its sequence number is taken, so a
+    committed message_count implies every broadcast up to it is visible.
+    """
+    if db.get_bind().dialect.name != "postgresql" and _missing_users(db, [sender_id]):
+        raise UnknownUsers([sender_id])
+    groups = models.Group.__table__
+    group_seq = db.scalar(
+        update(groups)
+        .where(groups.c.id == group_id)
+        .values(message_count=groups.c.message_count + 1)
+        .returning(groups.c.message_count)
+    )
+    if group_seq is None:
+        db.rollback()
+        return None
+    message_id = uuid.uuid4()
+    message = models.Message(
+        id=message_id,
+        sender_id=sender_id,
+        subject=subject,
+        content=content,
+        timestamp=models.utcnow(),
+        thread_id=message_id,
+        group_id=group_id,
+        group_seq=group_seq
+    )
+    try:
+        db.execute(insert(models.Message).values(
+            id=message.id,
+            sender_id=message.sender_id,
+            subject=message.subject,
+            timestamp=message.timestamp,
+            thread_id=message.thread_id,
+            group_id=group_id,
+            group_seq=group_seq,
+            **_store_body(db, content)
+        ))
+    except IntegrityError:
+        db.rollback()
+        raise UnknownUsers([sender_id])
+    db.commit()
+    return message
+
+
+def _pending_broadcasts(user_id: uuid.UUID):
+    members = models.GroupMember.__table__
+    groups = models.Group.__table__
+    return (
+        select(members.c.group_id, members.c.synced_seq, groups.c.message_count)
+        .join(groups, groups.c.id == members.c.group_id)
+        .where(members.c.user_id == user_id,
+               groups.c.message_count > members.c.synced_seq)
+    )
+
+
+def has_pending_broadcasts(db: Session, user_id: uuid.UUID) -> bool:
+    """Whether sync_group_deliveries has rows to create for the user."""
+    return db.execute(_pending_broadcasts(user_id).limit(1)).first() is not None
+
+
+def sync_group_deliveries(db: Session, user_id: uuid.UUID) -> int:
+    """Create the user's recipient rows for broadcasts not yet materialized.
+
+    With nothing pending this is one indexed SELECT. Idempotent: memberships
+    move to the synced seq in the same transaction. Returns rows created.
+    """
+    if not has_pending_broadcasts(db, user_id):
+        return 0
+    members = models.GroupMember.__table__
+    messages = models.Message.__table__
+    # Locking the memberships makes a concurrent sync wait, then skip them
+    pending = db.execute(_pending_broadcasts(user_id).with_for_update(of=members)).all()
+    created = 0
+    for group_id, synced_seq, message_count in pending:
+        delivered = db.execute(
+            select(messages.c.id, messages.c.timestamp)
+            .where(messages.c.group_id == group_id,
+                   messages.c.group_seq > synced_seq,
+                   messages.c.group_seq <= message_count)
+        ).all()
+        if delivered:
+            db.execute(insert(models.MessageRecipient), [
+                {"id": uuid.uuid4(), "message_id": message_id, "recipient_id": user_id,
+                 "read": False, "message_timestamp": timestamp}
+                for message_id, timestamp in delivered
+            ])
+            created += len(delivered)
+        db.execute(
+            update(members)
+            .where(members.c.group_id == group_id, members.c.user_id == user_id)
+            .values(synced_seq=message_count)
+        )
+    if created:
+        # Pending broadcasts were already counted as unread and in the
+        # mailbox version, so only the counter moves
+        stats = models.UserMailboxStats.__table__
+        stmt = _upsert(db, stats).values(user_id=user_id, unread_count=created, version=0)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[stats.c.user_id],
+            set_={"unread_count": stats.c.unread_count + created}
+        ))
+    db.commit()
+    return created
+
+# Message listings
+#
+# Listings return flat rows selected column-wise. Summary rows carry a
+# snippet cut from content in the database, so full bodies are never read
+# or shipped; fields="full" selects content instead. Inbox and unread rows
+# also carry the recipient's read state from the join they filter on.
+
+LIST_FIELDS = ("summary", "full")
+SNIPPET_LENGTH = 140
+
+# Messages from before threading have no thread_id and are each a thread
+# of their own; every new message has one
+_thread_key = func.coalesce(models.Message.thread_id, models.Message.id)
+
+
+def _listing_columns(fields: str, *extra):
+    if fields not in LIST_FIELDS:
+        raise ValueError(f"Unknown fields {fields!r}")
+    if fields == "full":
+        body = models.Message.content
+    else:
+        body = func.substr(models.Message.content, 1, SNIPPET_LENGTH).label("snippet")
+    return (
+        models.Message.id,
+        models.Message.sender_id,
+        models.Message.subject,
+        models.Message.timestamp,
+        _thread_key.label("thread_id"),
+        models.Message.parent_id,
+        body,
+        *extra
+    )
+
+
+_read_state = (models.MessageRecipient.read, models.MessageRecipient.read_at)
+
+
+def get_sent_messages(db: Session, user_id: uuid.UUID, cursor: Optional[str] = None,
+                      limit: int = DEFAULT_PAGE_SIZE, fields: str = "full"):
+    query = db.query(*_listing_columns(fields)).filter(
+        models.Message.sender_id == user_id)
+    return paginate_messages(query, cursor, limit)
+
+
+# Inbox pages walk the recipient's rows in index order and fetch each
+# message by (id, timestamp), which also prunes a partitioned messages
+# table to one partition per lookup
+_inbox_keys = (models.MessageRecipient.message_timestamp, models.MessageRecipient.message_id)
+_inbox_join = and_(models.Message.id == models.MessageRecipient.message_id,
+                   models.Message.timestamp == models.MessageRecipient.message_timestamp)
+
+
+def get_inbox_messages(db: Session, user_id: uuid.UUID, cursor: Optional[str] = None,
+                       limit: int = DEFAULT_PAGE_SIZE, fields: str = "full"):
+    """Messages the user received, newest first; sync_group_deliveries first."""
+    query = (
+        db.query(*_listing_columns(fields, *_read_state))
+        .select_from(models.MessageRecipient)
+        .join(models.Message, _inbox_join)
+        .filter(models.MessageRecipient.recipient_id == user_id)
+    )
+    return paginate_messages(query, cursor, limit, keys=_inbox_keys)
+
+
+def get_unread_messages(db: Session, user_id: uuid.UUID, cursor: Optional[str] = None,
+                        limit: int = DEFAULT_PAGE_SIZE, fields: str = "full"):
+    """The user's unread messages, newest first; sync_group_deliveries first."""
+    query = (
+        db.query(*_listing_columns(fields, *_read_state))
+        .select_from(models.MessageRecipient)
+        .join(models.Message, _inbox_join)
+        .filter(
+            models.MessageRecipient.recipient_id == user_id,
+            models.MessageRecipient.read == False
+        )
+    )
+    return paginate_messages(query, cursor, limit, keys=_inbox_keys)
+
+# Threads
+
+
+def prepare_reply(db: Session, message_id: uuid.UUID, sender_id: uuid.UUID,
+                  subject: Optional[str] = None,
+                  recipient_ids: Optional[Iterable[uuid.UUID]] = None) -> Optional[dict]:
+    """The send_message arguments of a reply; None if there is no such message.
+
+    Only the message's sender and recipients may reply. Without
+    recipient_ids the reply goes to everyone else on the message, except
+    that replies to a broadcast go back to its sender alone.
+    """
+    parent = db.execute(
+        select(models.Message.id, _thread_key.label("thread_id"), models.Message.sender_id,
+               models.Message.subject, models.Message.group_id, models.Message.timestamp)
+        .where(models.Message.id == message_id)
+    ).first()
+    if parent is None:
+        return None
+    # A broadcast reaches a member once their deliveries are synced
+    sync_group_deliveries(db, sender_id)
+    recipients = models.MessageRecipient
+    received = (
+        select(recipients.recipient_id)
+        .where(recipients.message_id == parent.id,
+               recipients.message_timestamp == parent.timestamp)
+    )
+    if parent.group_id is not None:
+        # Of a broadcast's recipients only the replier matters
+        received = received.where(recipients.recipient_id == sender_id)
+    received = list(db.scalars(received))
+    if sender_id != parent.sender_id and sender_id not in received:
+        raise NotAParticipant(sender_id, message_id)
+
+    if recipient_ids is None:
+        everyone = [parent.sender_id] if parent.group_id else [parent.sender_id, *received]
+        recipient_ids = [user_id for user_id in everyone if user_id != sender_id]
+    if subject is None and parent.subject is not None:
+        subject = parent.subject
+        if not subject.lower().startswith("re:"):
+            subject = f"Re: {subject}"
+    return {"recipient_ids": list(dict.fromkeys(recipient_ids)), "subject": subject,
+            "thread_id": parent.thread_id, "parent_id": parent.id}
+
+
+def reply_to_message(db: Session, message_id: uuid.UUID, sender_id: uuid.UUID,
+                     content: str, subject: Optional[str] = None,
+                     recipient_ids: Optional[Iterable[uuid.UUID]] = None,
+                     idempotency_key: Optional[str] = None
+                     ) -> Optional[Tuple[models.Message, List[uuid.UUID]]]:
+    """Send a reply in the thread of message_id; None if there is no such message.
+
+    Recipients and subject default as in prepare_reply. Returns the reply
+    and the ids it was delivered to.
+    """
+    reply = prepare_reply(db, message_id, sender_id, subject, recipient_ids)
+    if reply is None:
+        return None
+    message = send_message(db, sender_id, content=content,
+                           idempotency_key=idempotency_key, **reply)
+    return message, reply["recipient_ids"]
+
+
+def get_thread_messages(db: Session, thread_id: uuid.UUID, cursor: Optional[str] = None,
+                        limit: int = DEFAULT_PAGE_SIZE, fields: str = "full"):
+    """A thread's messages, newest first, on the (thread_id, timestamp, id) index."""
+    query = db.query(*_listing_columns(fields)).filter(or_(
+        models.Message.thread_id == thread_id,
+        and_(models.Message.id == thread_id, models.Message.thread_id.is_(None))))
+    # Threads are contiguous in the index, so time windows only add queries
+    return paginate_messages(query, cursor, limit, windows=())
+
+
+def get_thread_inbox(db: Session, user_id: uuid.UUID, cursor: Optional[str] = None,
+                     limit: int = DEFAULT_PAGE_SIZE, fields: str = "full"):
+    """The latest message the user received in each thread, newest first.
+
+    One statement: Postgres keeps each thread's first row with DISTINCT ON
+    over the inbox join, other databases number the rows per thread with
+    a window function. Pages are keyset over the picked rows. Callers run
+    sync_group_deliveries first.
+    """
+    newest = (models.MessageRecipient.message_timestamp.desc(),
+              models.MessageRecipient.message_id.desc())
+    latest = (
+        select(*_listing_columns(fields, *_read_state))
+        .select_from(models.MessageRecipient)
+        .join(models.Message, _inbox_join)
+        .where(models.MessageRecipient.recipient_id == user_id)
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        latest = latest.distinct(_thread_key).order_by(_thread_key, *newest).subquery("latest")
+    else:
+        position = func.row_number().over(partition_by=_thread_key, order_by=newest)
+        ranked = latest.add_columns(position.label("position")).subquery("ranked")
+        latest = (
+            select(*[c for c in ranked.c if c.key != "position"])
+            .where(ranked.c.position == 1)
+            .subquery("latest")
+        )
+    query = db.query(*latest.c)
+    return paginate_messages(query, cursor, limit, keys=(latest.c.timestamp, latest.c.id),
+                             windows=())
+
+
+# Export
+
+EXPORT_FOLDERS = ("inbox", "sent")
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_statements(user_id: uuid.UUID, folders: Iterable[str] = EXPORT_FOLDERS):
+    """(folder, SELECT) pairs covering a user's whole mailbox, oldest first.
+
+    They are plain statements rather than query results so the caller can
+    stream them with a server-side cursor on either kind of session.
+    """
+    order = (models.Message.timestamp, models.Message.id)
+    for folder in folders:
+        if folder == "inbox":
+            yield folder, (
+                select(*_listing_columns("full", *_read_state))
+                .select_from(models.MessageRecipient)
+                .join(models.Message, _inbox_join)
+                .where(models.MessageRecipient.recipient_id == user_id)
+                .order_by(*order)
+            )
+        elif folder == "sent":
+            yield folder, (
+                select(*_listing_columns("full"))
+                .where(models.Message.sender_id == user_id)
+                .order_by(*order)
+            )
+        else:
+            raise ValueError(f"Unknown folder {folder!r}")
+
+
+# Search
+
+SEARCH_FOLDERS = ("inbox", "sent")
+
+# SQLite FTS5 index, created by DDL in models
+_messages_fts = table("messages_fts", column("rowid"))
+
+
+def _encode_offset(offset: int) -> str:
+    return base64.urlsafe_b64encode(f"offset|{offset}".encode()).decode().rstrip("=")
+
+
+def _decode_offset(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        kind, offset = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+        if kind != "offset" or int(offset) < 0:
+            raise ValueError(kind)
+        return int(offset)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+
+
+def _fts5_query(terms: str) -> str:
+    # Quote every term so user input can't use FTS5 query syntax
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+def search_messages(db: Session, user_id: uuid.UUID, terms: str, folder: str = "inbox",
+                    cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                    fields: str = "full"):
+    """Ranked full-text search of one folder, best match first.
+
+    Postgres matches the trigger-maintained search_vector column (subject
+    weighted above content), SQLite the messages_fts FTS5 table. Ranked order has
+    no keyset, so the cursor carries an offset. Callers run
+    sync_group_deliveries first for the inbox.
+    """
+    if folder not in SEARCH_FOLDERS:
+        raise ValueError(f"Unknown folder {folder!r}")
+    offset = _decode_offset(cursor) if cursor else 0
+
+    query = db.query(*_listing_columns(fields)).select_from(models.Message)
+    if folder == "sent":
+        query = query.filter(models.Message.sender_id == user_id)
+    else:
+        query = query.filter(
+            select(models.MessageRecipient.id)
+            .where(models.MessageRecipient.message_id == models.Message.id,
+                   models.MessageRecipient.recipient_id == user_id)
+            .exists())
+
+    if db.get_bind().dialect.name == "postgresql":
+        tsquery = func.websearch_to_tsquery("english", terms)
+        vector = literal_column("messages.search_vector")
+        query = query.filter(vector.op("@@")(tsquery))
+        rank = func.ts_rank(vector, tsquery).desc()
+    else:
+        fts_query = _fts5_query(terms)
+        if not fts_query:
+            return [], None
+        query = (
+            query.join(_messages_fts,
+                       _messages_fts.c.rowid == literal_column("messages.rowid"))
+            .filter(literal_column("messages_fts").op("MATCH")(fts_query))
+        )
+        # bm25() is lower for better matches
+        rank = func.bm25(literal_column("messages_fts"))
+
+    rows = (
+        query.order_by(rank, models.Message.timestamp.desc(), models.Message.id.desc())
+        .offset(offset)
+        .limit(limit + 1)
+        .all()
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_offset(offset + limit)
+    return rows, next_cursor
+
+# Single messages
+
+
+def get_message(db: Session, message_id: uuid.UUID,
+                include_recipients: bool = False) -> Optional[models.Message]:
+    query = db.query(models.Message).filter(models.Message.id == message_id)
+    if include_recipients:
+        # One extra SELECT ... WHERE message_id IN (...) per 500 recipients
+        query = query.options(selectinload(models.Message.recipients))
+    return query.first()
+
+
+def mark_message_as_read(db: Session, message_id: uuid.UUID, user_id: uuid.UUID) -> bool:
+    """Mark one recipient row read; returns False if there is no such row.
+
+    Re-marking an already read message is a no-op, so the unread counter
+    is only decremented for the transition.
+    """
+    recipients = models.MessageRecipient.__table__
+    marked = db.execute(
+        update(recipients)
+        .where(
+            recipients.c.message_id == message_id,
+            recipients.c.recipient_id == user_id,
+            recipients.c.read == False
+        )
+        .values(read=True, read_at=models.utcnow())
+        .returning(recipients.c.id)
+    ).first()
+    if not marked:
+        if sync_group_deliveries(db, user_id):
+            # It may have been a broadcast without a recipient row yet
+            return mark_message_as_read(db, message_id, user_id)
+        return db.query(
+            db.query(models.MessageRecipient)
+            .filter(
+                models.MessageRecipient.message_id == message_id,
+                models.MessageRecipient.recipient_id == user_id
+            )
+            .exists()
+        ).scalar()
+
+    _drop_unread_count(db, user_id, 1)
+    db.commit()
+    return True
+
+
+def mark_messages_as_read(db: Session, user_id: uuid.UUID,
+                          message_ids: Iterable[uuid.UUID]) -> List[uuid.UUID]:
+    """Mark a batch of messages read; returns the ids that were unread."""
+    message_ids = list(dict.fromkeys(message_ids))
+    if not message_ids:
+        return []
+    sync_group_deliveries(db, user_id)
+    recipients = models.MessageRecipient.__table__
+    return _mark_read(db, user_id, update(recipients).where(
+        recipients.c.recipient_id == user_id,
+        recipients.c.message_id.in_(message_ids),
+        recipients.c.read == False
+    ))
+
+
+def mark_all_as_read(db: Session, user_id: uuid.UUID, up_to: Optional[datetime] = None,
+                     cursor: Optional[str] = None) -> List[uuid.UUID]:
+    """Mark every unread message up to a point read; returns the ids marked.
+
+    ``up_to`` includes messages with timestamp <= up_to; ``cursor`` (from a
+    listing page) includes the message it points at and everything older.
+    With neither, the whole inbox is marked read.
+    """
+    sync_group_deliveries(db, user_id)
+    recipients = models.MessageRecipient.__table__
+    stmt = update(recipients).where(
+        recipients.c.recipient_id == user_id,
+        recipients.c.read == False
+    )
+    if up_to is not None:
+        if up_to.tzinfo is not None:
+            up_to = up_to.astimezone(timezone.utc).replace(tzinfo=None)
+        stmt = stmt.where(recipients.c.message_timestamp <= up_to)
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(recipients.c.message_timestamp, recipients.c.message_id)
+                          <= tuple_(timestamp, message_id))
+    return _mark_read(db, user_id, stmt)
+
+
+def _mark_read(db: Session, user_id: uuid.UUID, stmt) -> List[uuid.UUID]:
+    recipients = models.MessageRecipient.__table__
+    marked = list(db.scalars(
+        stmt.values(read=True, read_at=models.utcnow())
+        .returning(recipients.c.message_id)
+    ))
+    if marked:
+        _drop_unread_count(db, user_id, len(marked))
+    db.commit()
+    return marked
+
+
+def _drop_unread_count(db: Session, user_id: uuid.UUID, count: int):
+    stats = models.UserMailboxStats.__table__
+    db.execute(
+        update(stats)
+        .where(stats.c.user_id == user_id)
+        .values(
+            unread_count=case(
+                (stats.c.unread_count > count, stats.c.unread_count - count),
+                else_=0
+            ),
+            version=stats.c.version + 1
+        )
+    )
+
+# Counters
+
+
+def _group_total(user_id: uuid.UUID, value):
+    """Sum of a per-membership expression over the user's groups."""
+    return cast(func.coalesce(
+        select(func.sum(value))
+        .select_from(models.GroupMember)
+        .join(models.Group, models.Group.id == models.GroupMember.group_id)
+        .where(models.GroupMember.user_id == user_id)
+        .scalar_subquery(), 0), BigInteger)
+
+
+def get_unread_count(db: Session, user_id: uuid.UUID) -> Optional[int]:
+    """Unread count from the counter table plus broadcasts not yet synced.
+
+    None if the user doesn't exist.
+    """
+    pending = _group_total(
+        user_id, models.Group.message_count - models.GroupMember.synced_seq)
+    row = db.execute(
+        select(func.coalesce(models.UserMailboxStats.unread_count, 0) + pending)
+        .select_from(models.User)
+        .outerjoin(models.UserMailboxStats,
+                   models.UserMailboxStats.user_id == models.User.id)
+        .where(models.User.id == user_id)
+    ).first()
+    return row[0] if row else None
+
+
+def get_mailbox_version(db: Session, user_id: uuid.UUID) -> int:
+    """Version bumped on every delivery to and read-state change of a user.
+
+    Broadcasts bump their group's message_count rather than each member's
+    counter row, so the version adds up the counts of the user's groups.
+    """
+    version = select(models.UserMailboxStats.version).where(
+        models.UserMailboxStats.user_id == user_id).scalar_subquery()
+    return db.scalar(select(
+        func.coalesce(version, 0) + _group_total(user_id, models.Group.message_count)))
+
+
+def rebuild_unread_counts(db: Session) -> int:
+    """Recompute every counter from message_recipients; returns rows written.
+
+    Versions are bumped rather than reset so clients' ETags stay unique.
+    """
+    stats = models.UserMailboxStats.__table__
+    recipients = models.MessageRecipient.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        # Block concurrent increments until the rebuilt counts are visible
+        db.execute(text("LOCK TABLE user_mailbox_stats IN EXCLUSIVE MODE"))
+    db.execute(update(stats).values(
+        unread_count=0, version=stats.c.version + 1))
+    stmt = _upsert(db, stats).from_select(
+        ["user_id", "unread_count", "version"],
+        select(recipients.c.recipient_id, func.count(), literal(1))
+        .where(recipients.c.read == False,
+               recipients.c.recipient_id.is_not(None))
+        .group_by(recipients.c.recipient_id)
+    )
+    written = db.execute(stmt.on_conflict_do_update(
+        index_elements=[stats.c.user_id],
+        set_={"unread_count": stmt.excluded.unread_count}
+    )).rowcount
+    db.commit()
+    return written
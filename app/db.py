@@ -1,10 +1,23 @@
 # DB connection setup
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from starlette.concurrency import run_in_threadpool
+from threading import Lock
+from typing import Optional
+import asyncio
+import itertools
+import logging
 import os
+import time
 from dotenv import load_dotenv
 
+from . import metrics
+
 # Load environment variables
 load_dotenv()
 
@@ -15,12 +28,247 @@ DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 DB_NAME = os.getenv("DB_NAME", "messaging_db")
 
-# Construct database URL
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Serve requests from the asyncio engine instead of the threadpool
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+
+# Construct database URLs
+SQLALCHEMY_DATABASE_URL = os.getenv(
+    "DATABASE_URL",
+    f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+
+# Optional read replicas, comma separated. Read-only handlers are served
+# from them round-robin; everything else goes to the primary above.
+DB_REPLICA_URLS = [url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",")
+                   if url.strip()]
+ASYNC_DB_REPLICA_URLS = [url.strip() for url in os.getenv("ASYNC_DB_REPLICA_URLS", "").split(",")
+                         if url.strip()]
+# A replica that fails is skipped for this many seconds
+DB_REPLICA_RETRY = float(os.getenv("DB_REPLICA_RETRY", "30"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10"))
+# Reads about a user go to the primary this long after the user writes
+DB_READ_YOUR_WRITES = float(os.getenv("DB_READ_YOUR_WRITES", "5"))
+
+# Optional extra shards, comma separated, for mailboxes sharded by user
+# id (see app/sharding.py). The primary above is shard 0.
+DB_SHARD_URLS = [url.strip() for url in os.getenv("DB_SHARD_URLS", "").split(",")
+                 if url.strip()]
+
+# Connection pool configuration
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Set when an external pooler (PgBouncer in transaction mode) owns pooling
+DB_EXTERNAL_POOLER = os.getenv("DB_EXTERNAL_POOLER", "false").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+# Pool metrics
+pool_wait_seconds = metrics.Histogram(
+    "db_pool_wait_seconds",
+    "Time a checkout waited for a connection to come back to an exhausted pool",
+    labelnames=("engine",))
+
+
+def _timed_pool(pool_class, label):
+    class TimedPool(pool_class):
+        def _do_get(self):
+            # Only a checkout that finds no idle connection and no overflow
+            # left waits; the others count as 0, since their time is spent
+            # connecting, not queueing
+            exhausted = (not self.checkedin() and self._max_overflow > -1
+                         and self.overflow() >= self._max_overflow)
+            if not exhausted:
+                pool_wait_seconds.observe(0, engine=label)
+                return super()._do_get()
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                pool_wait_seconds.observe(
+                    time.perf_counter() - start, engine=label)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+
+def _engine_options(url, label, pool_class):
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return {}
+    if DB_EXTERNAL_POOLER:
+        options = {"poolclass": NullPool}
+        if url.get_driver_name() == "asyncpg":
+            # PgBouncer transaction pooling can't keep prepared statements
+            options["connect_args"] = {"statement_cache_size": 0}
+        return options
+    return {
+        "poolclass": _timed_pool(pool_class, label),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
 
 # Create engine and session
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(SQLALCHEMY_DATABASE_URL,
+                       **_engine_options(SQLALCHEMY_DATABASE_URL, "sync", QueuePool))
+
+# Async engine and session (only when enabled, so asyncpg stays optional)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **_engine_options(ASYNC_DATABASE_URL, "async", AsyncAdaptedQueuePool)
+) if DB_ASYNC else None
+
+# Replicas
+
+
+class ReplicaPool:
+    """Replica engines taken in turn, skipping any that recently failed.
+
+    A replica is marked down for DB_REPLICA_RETRY seconds when a query on
+    it fails to connect or loses its connection, or when check() can't
+    reach it; check() also brings recovered replicas back.
+    """
+
+    def __init__(self, engines, retry: float = DB_REPLICA_RETRY):
+        self.engines = list(engines)
+        self.retry = retry
+        self._down_until = {}
+        self._turn = itertools.count()
+        self._lock = Lock()
+        for replica in self.engines:
+            event.listen(self._sync(replica), "handle_error", self._on_error)
+
+    @staticmethod
+    def _sync(replica):
+        return replica.sync_engine if isinstance(replica, AsyncEngine) else replica
+
+    def _on_error(self, context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, exc.OperationalError):
+            self.mark_down(context.engine)
+
+    def mark_down(self, sync_engine):
+        with self._lock:
+            self._down_until[sync_engine] = time.monotonic() + self.retry
+        logger.warning("Replica %s is down", sync_engine.url.render_as_string())
+
+    def is_up(self, replica) -> bool:
+        return self._down_until.get(self._sync(replica), 0) <= time.monotonic()
+
+    def pick(self):
+        """The next healthy replica's sync engine, or None to use the primary."""
+        for _ in range(len(self.engines)):
+            replica = self.engines[next(self._turn) % len(self.engines)]
+            if self.is_up(replica):
+                return self._sync(replica)
+        return None
+
+    async def check(self):
+        for replica in self.engines:
+            try:
+                if isinstance(replica, AsyncEngine):
+                    async with replica.connect() as connection:
+                        await connection.execute(text("SELECT 1"))
+                else:
+                    await run_in_threadpool(self._ping, replica)
+            except Exception:
+                self.mark_down(self._sync(replica))
+            else:
+                with self._lock:
+                    self._down_until.pop(self._sync(replica), None)
+
+    @staticmethod
+    def _ping(replica):
+        with replica.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+
+replicas = ReplicaPool(
+    create_engine(url, **_engine_options(url, f"replica-{i}", QueuePool))
+    for i, url in enumerate(DB_REPLICA_URLS))
+async_replicas = ReplicaPool(
+    create_async_engine(url, **_engine_options(url, f"async-replica-{i}", AsyncAdaptedQueuePool))
+    for i, url in enumerate(ASYNC_DB_REPLICA_URLS)) if DB_ASYNC else ReplicaPool([])
+
+
+# Shards
+if DB_SHARD_URLS and DB_ASYNC:
+    raise RuntimeError("DB_SHARD_URLS runs on the sync engines; unset DB_ASYNC")
+shards = [engine] + [
+    create_engine(url, **_engine_options(url, f"shard-{i}", QueuePool))
+    for i, url in enumerate(DB_SHARD_URLS, start=1)]
+
+
+async def check_replicas(interval: float = DB_REPLICA_CHECK_INTERVAL):
+    """Health-check the replicas every interval seconds, forever."""
+    while True:
+        for pool in (replicas, async_replicas):
+            await pool.check()
+        await asyncio.sleep(interval)
+
+
+def _is_read(clause) -> bool:
+    return (clause is not None and getattr(clause, "is_select", False)
+            and getattr(clause, "_for_update_arg", None) is None)
+
+
+class RoutingSession(Session):
+    """Session that can send its reads to a replica.
+
+    With a replica engine in info["replica"], plain SELECTs go there until
+    the session's first write; from then on everything, reads included,
+    goes to the primary, so a request reads its own writes. A shard
+    engine in info["shard"] takes the primary's place.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get("replica")
+        if replica is not None and not self.info.get("wrote"):
+            if _is_read(clause):
+                return replica
+            if clause is not None or mapper is not None:
+                self.info["wrote"] = True
+        shard = self.info.get("shard")
+        if shard is not None:
+            return shard
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, sync_session_class=RoutingSession, autoflush=False, expire_on_commit=False)
+
+
+def _pool_samples(stat):
+    def samples():
+        engines = [("sync", engine)]
+        if async_engine is not None:
+            engines.append(("async", async_engine.sync_engine))
+        engines += [(f"replica-{i}", replica) for i, replica in enumerate(replicas.engines)]
+        engines += [(f"async-replica-{i}", replica.sync_engine)
+                    for i, replica in enumerate(async_replicas.engines)]
+        engines += [(f"shard-{i}", shard) for i, shard in enumerate(shards) if i]
+        for label, eng in engines:
+            if isinstance(eng.pool, QueuePool):
+                yield {"engine": label}, stat(eng.pool)
+    return samples
+
+
+metrics.Gauge("db_pool_size", "Configured connection pool size",
+              callback=_pool_samples(lambda pool: pool.size()))
+metrics.Gauge("db_pool_checked_out", "Connections currently checked out",
+              callback=_pool_samples(lambda pool: pool.checkedout()))
+metrics.Gauge("db_pool_checked_in", "Idle connections held by the pool",
+              callback=_pool_samples(lambda pool: pool.checkedin()))
+metrics.Gauge("db_pool_overflow", "Connections open beyond pool_size",
+              callback=_pool_samples(lambda pool: max(pool.overflow(), 0)))
 
 # Create declarative base
 
@@ -37,3 +285,70 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def has_replicas() -> bool:
+    return bool(replicas.engines or async_replicas.engines)
+
+
+def use_replica(db):
+    """Send the session's reads to a healthy replica, if there is one."""
+    if isinstance(db, AsyncSession):
+        db.sync_session.info["replica"] = async_replicas.pick()
+    else:
+        db.info["replica"] = replicas.pick()
+
+
+def use_primary(db):
+    """Undo use_replica: the session's reads go to the primary again."""
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    session.info.pop("replica", None)
+
+
+def use_shard(db, index: int):
+    """Bind the session to shard index (0 is the primary)."""
+    db.info["shard"] = shards[index]
+
+
+@asynccontextmanager
+async def session_scope(replica: bool = False, shard: Optional[int] = None):
+    """Session for callers outside FastAPI's dependency injection (MCP tools).
+
+    The session is always closed, returning its connection to the pool.
+    With replica set its reads go to a replica (see RoutingSession); with
+    shard set it runs on that shard.
+    """
+    if DB_ASYNC:
+        async with AsyncSessionLocal() as db:
+            if replica:
+                use_replica(db)
+            yield db
+    else:
+        db = SessionLocal()
+        if replica:
+            use_replica(db)
+        if shard is not None:
+            use_shard(db, shard)
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+# Session dependency used by the routes, selected by DB_ASYNC
+get_session = get_async_db if DB_ASYNC else get_db
+
+
+async def run_db(db, fn, *args, **kwargs):
+    """Run a sync crud function against either kind of session.
+
+    AsyncSession runs it in a greenlet on the event loop; a plain Session
+    is handed to the threadpool so the loop is never blocked.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
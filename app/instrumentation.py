@@ -0,0 +1,168 @@
+# Per-request latency and database metrics
+#
+# RequestMetricsMiddleware times every HTTP request and traced() every MCP
+# tool call. Each keeps a RequestStats in a context variable, which the
+# SQLAlchemy cursor hooks below add their query time, count and rows to.
+# Threadpool calls (run_db, run_in_threadpool) copy the context, so the
+# queries of sync sessions count towards the request that made them.
+# Results go to /metrics per route, optionally to a Server-Timing header,
+# and statements slower than SLOW_QUERY_MS are logged with their route.
+
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Optional
+import functools
+import logging
+import os
+import time
+
+from . import metrics
+
+# Add a Server-Timing header (db time and queries, app time) to responses
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# Log statements taking at least this long; 0 turns the log off
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+slow_query_logger = logging.getLogger("app.slow_queries")
+
+request_duration = metrics.Histogram(
+    "http_request_duration_seconds", "Time to answer a request or MCP tool call",
+    labelnames=("method", "route", "status"))
+request_db_time = metrics.Histogram(
+    "db_time_per_request_seconds", "Time a request spent in database queries",
+    labelnames=("route",))
+request_queries = metrics.Histogram(
+    "db_queries_per_request", "Database queries made by a request",
+    labelnames=("route",), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+request_rows = metrics.Histogram(
+    "db_rows_per_request",
+    "Rows returned or changed by a request's queries, as far as the driver reports them",
+    labelnames=("route",), buckets=(0, 1, 10, 100, 1000, 10000, 100000))
+slow_queries = metrics.Counter(
+    "db_slow_queries_total", "Statements slower than SLOW_QUERY_MS",
+    labelnames=("route",))
+
+
+class RequestStats:
+    __slots__ = ("name", "scope", "queries", "rows", "db_seconds")
+
+    def __init__(self, name: Optional[str] = None, scope: Optional[dict] = None):
+        self.name = name
+        self.scope = scope
+        self.queries = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        # Read from the scope when needed: routing sets it after the request starts
+        return self.name or _route_label(self.scope)
+
+    def server_timing(self, app_seconds: float) -> str:
+        return (f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries", '
+                f'app;dur={app_seconds * 1000:.1f}')
+
+    def observe(self, method: str, status, seconds: float):
+        request_duration.observe(seconds, method=method, route=self.route, status=status)
+        request_db_time.observe(self.db_seconds, route=self.route)
+        request_queries.observe(self.queries, route=self.route)
+        request_rows.observe(self.rows, route=self.route)
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+# Query hooks, on every engine (primary, replicas, shards, the async engine's sync side)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("query_start", time.perf_counter())
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        # -1 when the driver doesn't know (SQLite SELECTs, server-side cursors)
+        stats.rows += max(cursor.rowcount, 0)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        route = stats.route if stats is not None else "-"
+        slow_queries.inc(route=route)
+        slow_query_logger.warning("Slow query (%.1f ms) in %s: %s",
+                                  elapsed * 1000, route, " ".join(statement.split()))
+
+# REST
+
+
+def _route_label(scope) -> str:
+    # The matched route's template keeps the label set small. Its
+    # path_format is relative to the router it was declared on, so the
+    # part of the path before what the route matched (the include prefix)
+    # goes in front. Mounted apps (the MCP server) are labelled by their
+    # mount path, and paths that match nothing are counted together.
+    route = scope.get("route")
+    if route is None:
+        mount = scope.get("root_path", "")[len(scope.get("app_root_path", "")):]
+        return mount or "unmatched"
+    path = scope["path"]
+    for start, char in enumerate(path):
+        if char == "/" and route.path_regex.match(path[start:]):
+            return path[:start] + route.path_format
+    return route.path_format
+
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware, so streamed responses aren't buffered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope=scope)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    timing = stats.server_timing(time.perf_counter() - start)
+                    message["headers"] = [*message.get("headers", []),
+                                          (b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            stats.observe(scope["method"], status, time.perf_counter() - start)
+            _current.reset(token)
+
+# MCP
+
+
+def traced(name: str):
+    """Record an MCP tool's calls like requests, under route mcp:<name>."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            stats = RequestStats(f"mcp:{name}")
+            token = _current.set(stats)
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                stats.observe("MCP", status, time.perf_counter() - start)
+                _current.reset(token)
+        return wrapper
+    return decorate
@@ -1,18 +1,41 @@
 # Entry point for FastAPI app
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import uuid
 
-from . import models, routes
-from .db import engine
+from . import instrumentation, metrics, outbox, realtime, routes, sharding
+from .db import async_engine, check_replicas, has_replicas
 from .mcp_server import app as mcp_app
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+# Database schema is managed by Alembic (`just migrate`)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await realtime.backend.start()
+    tasks = []
+    if outbox.OUTBOX_INPROCESS:
+        tasks.append(asyncio.create_task(outbox.run_worker()))
+    if has_replicas():
+        tasks.append(asyncio.create_task(check_replicas()))
+    if sharding.enabled():
+        tasks.append(asyncio.create_task(sharding.refresh_map()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await realtime.backend.stop()
+    if async_engine is not None:
+        await async_engine.dispose()
 
 app = FastAPI(
     title="Messaging System API",
     description="Backend messaging system API for River Flow Solutions",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -23,6 +46,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so its latency covers the whole stack
+app.add_middleware(instrumentation.RequestMetricsMiddleware)
 
 # Include routes
 app.include_router(routes.router, prefix="/api/v1")
@@ -32,3 +57,55 @@ app.mount("/mcp", mcp_app)
 @app.get("/")
 async def root():
     return {"message": "Welcome to Messaging System API"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Internal Prometheus scrape endpoint. Gauges such as the outbox's
+    # query the database, so render off the event loop.
+    return PlainTextResponse(await run_in_threadpool(metrics.render), media_type="text/plain; version=0.0.4")
+
+
+# Real-time mailbox notifications
+
+
+@app.websocket("/ws/{user_id}")
+async def mailbox_socket(websocket: WebSocket, user_id: uuid.UUID):
+    await websocket.accept()
+    subscription = realtime.hub.subscribe(user_id)
+    receiver = event = None
+    try:
+        # Watch for the client going away while waiting for events
+        receiver = asyncio.create_task(websocket.receive())
+        while True:
+            if event is None:
+                event = asyncio.create_task(subscription.get())
+            done, _ = await asyncio.wait(
+                {event, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                message = receiver.result()
+                if message["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+            # A finished get() has taken its event off the subscription, so
+            # send it even when a client frame arrived at the same time; a
+            # pending one carries on into the next wait
+            if event in done:
+                await websocket.send_text(event.result())
+                event = None
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in (receiver, event):
+            if task is not None:
+                task.cancel()
+        realtime.hub.unsubscribe(subscription)
+
+
+@app.get("/events/{user_id}")
+async def mailbox_events(user_id: uuid.UUID, request: Request):
+    return StreamingResponse(
+        realtime.sse_events(user_id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,139 @@
+# Maintenance commands
+#
+# Usage: python -m app.manage <command>
+#
+# Per-database commands run on every shard when the mailboxes are sharded.
+
+import argparse
+import sys
+from datetime import timedelta
+
+from . import crud, models, partitions, sharding
+
+
+def _on_shards(label: str):
+    # (prefix for output lines, session) per shard; sessions are closed after use
+    for index in range(sharding.shard_count()):
+        db = sharding.session(index)
+        try:
+            yield f"{label} on shard {index}: " if sharding.enabled() else "", db
+        finally:
+            db.close()
+
+
+def reconcile_unread(args):
+    for prefix, db in _on_shards("reconcile-unread"):
+        written = crud.rebuild_unread_counts(db)
+        print(f"{prefix}Rebuilt unread counters for {written} users")
+
+
+def prune_idempotency_keys(args):
+    for prefix, db in _on_shards("prune-idempotency-keys"):
+        removed = crud.prune_idempotency_keys(
+            db, models.utcnow() - timedelta(days=args.days))
+        print(f"{prefix}Removed {removed} idempotency keys older than {args.days} days")
+
+
+def maintain_partitions(args):
+    for prefix, db in _on_shards("partitions"):
+        if not partitions.is_partitioned(db):
+            sys.exit(f"{prefix}messages is not partitioned "
+                     "(run the migrations with DB_PARTITION_MESSAGES=true)")
+        created = partitions.ensure_partitions(db, args.ahead)
+        archived = []
+        if args.retain_months is not None:
+            archived = partitions.archive_partitions(
+                db, args.retain_months, schema=args.schema, drop=args.drop)
+        print(f"{prefix}Created {len(created)} partitions: {', '.join(created) or '-'}")
+        action = "Dropped" if args.drop else f"Archived to {args.schema}"
+        print(f"{prefix}{action} {len(archived)} partitions: {', '.join(archived) or '-'}")
+
+
+def shard_status(args):
+    print("shard  slots  users")
+    for row in sharding.status():
+        print(f"{row['shard']:>5}  {row['slots']:>5}  {row['users']:>5}")
+
+
+def sync_users(args):
+    copied = sharding.sync_users()
+    print(f"Copied {copied} missing user rows to the shards")
+
+
+def move_slots(args):
+    try:
+        moved = sharding.move_slots({slot: args.to for slot in args.slots}, args.grace, print)
+    except (ValueError, RuntimeError) as e:
+        sys.exit(str(e))
+    print(f"Moved {moved} users")
+
+
+def rebalance_shards(args):
+    try:
+        moved = sharding.rebalance(args.shards, args.grace, print)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    print(f"Moved {moved} users")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reconcile = commands.add_parser(
+        "reconcile-unread",
+        help="rebuild user_mailbox_stats from message_recipients")
+    reconcile.set_defaults(func=reconcile_unread)
+
+    prune = commands.add_parser(
+        "prune-idempotency-keys",
+        help="forget send idempotency keys after their retry window")
+    prune.add_argument("--days", type=int, default=7,
+                       help="keep keys this many days (default 7)")
+    prune.set_defaults(func=prune_idempotency_keys)
+
+    maintain = commands.add_parser(
+        "partitions",
+        help="create upcoming monthly partitions and archive old ones")
+    maintain.add_argument("--ahead", type=int, default=2,
+                          help="months past the current one to create (default 2)")
+    maintain.add_argument("--retain-months", type=int,
+                          help="detach partitions older than this many months")
+    maintain.add_argument("--schema", default="archive",
+                          help="schema detached partitions move to (default archive)")
+    maintain.add_argument("--drop", action="store_true",
+                          help="drop detached partitions instead of archiving them")
+    maintain.set_defaults(func=maintain_partitions)
+
+    status = commands.add_parser(
+        "shard-status", help="slots and users on each shard")
+    status.set_defaults(func=shard_status)
+
+    sync = commands.add_parser(
+        "sync-users", help="copy users missing from a shard over from shard 0")
+    sync.set_defaults(func=sync_users)
+
+    grace = {"type": float, "default": 2 * sharding.SHARD_MAP_REFRESH,
+             "help": "seconds to wait for the API to reload the slot map "
+                     "(default twice SHARD_MAP_REFRESH)"}
+    move = commands.add_parser(
+        "move-slots", help="move the mailboxes in some slots to another shard")
+    move.add_argument("slots", type=int, nargs="+",
+                      help=f"slots to move (0-{sharding.SHARD_SLOTS - 1})")
+    move.add_argument("--to", type=int, required=True, help="shard to move them to")
+    move.add_argument("--grace", **grace)
+    move.set_defaults(func=move_slots)
+
+    rebalance = commands.add_parser(
+        "rebalance-shards", help="spread the slots evenly over the shards")
+    rebalance.add_argument("--shards", type=int,
+                           help="use only the first N shards, emptying the rest")
+    rebalance.add_argument("--grace", **grace)
+    rebalance.set_defaults(func=rebalance_shards)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
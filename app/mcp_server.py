@@ -1,13 +1,12 @@
 # MCP server integration
 from fastapi import FastAPI, HTTPException, Depends
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from datetime import datetime
 import uuid
-from . import models, schemas
-from .db import get_db
-from sqlalchemy.orm import Session
-from datetime import datetime, timezone
+from starlette.concurrency import run_in_threadpool
+from . import cache, crud, instrumentation, models, realtime, schemas, sharding
+from .db import DB_READ_YOUR_WRITES, has_replicas, run_db, session_scope, use_primary
 from pydantic import BaseModel
-from sqlalchemy.exc import IntegrityError
 from mcp.server.fastmcp import FastMCP
 
 # Initialize MCP server
@@ -35,168 +34,346 @@ class MessageRead(BaseModel):
     message_id: str
     user_id: str
 
+# Helpers
+
+
+def _message_to_dict(row) -> dict:
+    """Listing row as a dict; inbox rows carry the recipient's read state."""
+    data = {
+        "id": str(row.id),
+        "subject": row.subject,
+        "sender_id": str(row.sender_id),
+        "timestamp": row.timestamp.isoformat(),
+        "thread_id": str(row.thread_id),
+        "parent_id": str(row.parent_id) if row.parent_id else None
+    }
+    if "content" in row._fields:
+        data["content"] = row.content
+    else:
+        data["snippet"] = row.snippet
+    if "read" in row._fields:
+        data["read"] = row.read
+        data["read_at"] = row.read_at.isoformat() if row.read_at else None
+    return data
+
+
+async def _from_replica(user_id: Optional[str] = None) -> bool:
+    # Like the REST read routes: replicas, except for a user who just wrote
+    return has_replicas() and not (user_id and await cache.wrote_recently(user_id))
+
+
+async def _user_scope(user_id: str, read: bool = False):
+    # The user's shard when sharded; reads may use a replica otherwise
+    return sharding.user_scope(user_id, replica=read and await _from_replica(user_id))
+
+
+async def _remember_writes(user_ids):
+    if has_replicas():
+        await cache.remember_writes(user_ids, DB_READ_YOUR_WRITES)
+
+
+async def _replayed(db, message_id: uuid.UUID) -> dict:
+    # queued, like the original, while the outbox worker still has deliveries of it
+    if sharding.enabled():
+        pending = await run_in_threadpool(sharding.delivery_pending, message_id)
+    else:
+        pending = await run_db(db, crud.delivery_pending, message_id)
+    return {"message_id": str(message_id), "replayed": True, "queued": pending}
+
+
+async def _page(fetch, user_id: str, cursor: Optional[str], limit: int,
+                fields: str = "summary", user_scoped: bool = True, sync: bool = False) -> dict:
+    if fields not in crud.LIST_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {fields!r}")
+    limit = max(1, min(limit, crud.MAX_PAGE_SIZE))
+    if user_scoped:
+        scope = await _user_scope(user_id, read=True)
+    else:
+        scope = session_scope(replica=await _from_replica())
+    async with scope as db:
+        # Pending group broadcasts become recipient rows on the primary first
+        if sync and await run_db(db, crud.has_pending_broadcasts, uuid.UUID(user_id)):
+            use_primary(db)
+            await run_db(db, crud.sync_group_deliveries, uuid.UUID(user_id))
+        try:
+            messages, next_cursor = await run_db(
+                db, fetch, uuid.UUID(user_id), cursor, limit, fields)
+        except crud.InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {
+            "items": [_message_to_dict(row) for row in messages],
+            "next_cursor": next_cursor
+        }
+
 # MCP Tools
+#
+# Each tool opens its own session with session_scope() and runs its queries
+# through run_db, so the event loop is never blocked and the connection is
+# returned to the pool on every path.
+
 
+def tool():
+    """mcp.tool(), with calls timed and their queries counted (see instrumentation)."""
+    def register(fn):
+        return mcp.tool()(instrumentation.traced(fn.__name__)(fn))
+    return register
 
-@mcp.tool()
+
+@tool()
 async def create_user(email: str, name: str) -> dict:
     """Create a new user in the messaging system"""
-    db = next(get_db())
-    try:
-        db_user = models.User(email=email, name=name)
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+    async with session_scope() as db:
+        try:
+            if sharding.enabled():
+                db_user = await run_in_threadpool(sharding.create_user, email, name)
+            else:
+                db_user = await run_db(db, crud.create_user, email=email, name=name)
+        except crud.EmailTaken as e:
+            raise HTTPException(status_code=400, detail=str(e))
         return {"id": str(db_user.id), "email": db_user.email, "name": db_user.name}
-    except IntegrityError:
-        db.rollback()
-        existing_user = db.query(models.User).filter(
-            models.User.email == email).first()
-        if existing_user:
-            raise HTTPException(
-                status_code=400,
-                detail=f"User with email {email} already exists"
-            )
-        raise HTTPException(status_code=400, detail="Failed to create user")
-
-
-@mcp.tool()
-async def send_message(sender_id: str, recipient_ids: List[str], content: str, subject: str = "") -> dict:
-    """Send a message to one or more recipients"""
-    db = next(get_db())
-    try:
-        db_message = models.Message(
-            sender_id=uuid.UUID(sender_id),
-            subject=subject,
-            content=content
-        )
-        db.add(db_message)
-        db.commit()
-        db.refresh(db_message)
-
-        for recipient_id in recipient_ids:
-            recipient = models.MessageRecipient(
-                message_id=db_message.id,
-                recipient_id=uuid.UUID(recipient_id)
+
+
+@tool()
+async def create_users(users: List[Dict[str, str]]) -> dict:
+    """Create many users from {"email", "name"} objects; existing emails are skipped"""
+    batch = schemas.UserBulkCreate(users=users)
+    pairs = [(user.email, user.name) for user in batch.users]
+    if sharding.enabled():
+        created, existing = await run_in_threadpool(sharding.create_users, pairs)
+    else:
+        async with session_scope() as db:
+            created, existing = await run_db(db, crud.create_users, pairs)
+    return {
+        "created": [{"id": str(user.id), "email": user.email, "name": user.name}
+                    for user in created],
+        "existing": existing
+    }
+
+
+@tool()
+async def get_users(user_ids: List[str]) -> List[dict]:
+    """Look up users by id; unknown ids are left out"""
+    if len(user_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 user ids per lookup")
+    async with session_scope(replica=await _from_replica()) as db:
+        users = await run_db(db, crud.get_users, [uuid.UUID(user_id) for user_id in user_ids])
+    return [{"id": str(user.id), "email": user.email, "name": user.name} for user in users]
+
+
+@tool()
+async def send_message(sender_id: str, recipient_ids: List[str], content: str, subject: str = "",
+                       idempotency_key: Optional[str] = None) -> dict:
+    """Send a message to one or more recipients.
+
+    Retrying with the same idempotency_key returns the original message id
+    (with replayed=true) instead of sending again. Large sends come back
+    with queued=true and are delivered by the outbox worker.
+    """
+    send = dict(
+        sender_id=uuid.UUID(sender_id),
+        recipient_ids=[uuid.UUID(recipient_id) for recipient_id in recipient_ids],
+        subject=subject,
+        content=content,
+        idempotency_key=idempotency_key
+    )
+    async with session_scope() as db:
+        try:
+            if sharding.enabled():
+                db_message = await run_in_threadpool(sharding.send_message, **send)
+            else:
+                db_message = await run_db(db, crud.send_message, **send)
+        except crud.IdempotentReplay as e:
+            return await _replayed(db, e.message_id)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    await _remember_writes([sender_id])
+    delivered = [uuid.UUID(recipient_id) for recipient_id in recipient_ids]
+    if crud.delivers_later(delivered):
+        return {"message_id": str(db_message.id), "replayed": False, "queued": True}
+    await cache.invalidate(delivered)
+    await realtime.publish_delivery(db_message, delivered)
+    return {"message_id": str(db_message.id), "replayed": False, "queued": False}
+
+
+@tool()
+async def broadcast_message(sender_id: str, group_id: str, content: str, subject: str = "") -> dict:
+    """Send a message to every member of a group"""
+    if sharding.enabled():
+        raise HTTPException(status_code=501, detail="Groups are not available with sharding")
+    async with session_scope() as db:
+        try:
+            db_message = await run_db(
+                db,
+                crud.broadcast_message,
+                sender_id=uuid.UUID(sender_id),
+                group_id=uuid.UUID(group_id),
+                subject=subject,
+                content=content
             )
-            db.add(recipient)
-
-        db.commit()
-        return {"message_id": str(db_message.id)}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
-
-
-@mcp.tool()
-async def get_messages(user_id: str) -> List[dict]:
-    """Get all messages for a user"""
-    db = next(get_db())
-    messages = (
-        db.query(models.Message)
-        .join(models.MessageRecipient)
-        .filter(models.MessageRecipient.recipient_id == uuid.UUID(user_id))
-        .all()
+        except crud.UnknownUsers as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if db_message is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+    await _remember_writes([sender_id])
+    await realtime.publish_broadcast(db_message)
+    return {"message_id": str(db_message.id), "group_seq": db_message.group_seq}
+
+
+@tool()
+async def reply_message(message_id: str, sender_id: str, content: str,
+                        subject: Optional[str] = None, recipient_ids: Optional[List[str]] = None,
+                        idempotency_key: Optional[str] = None) -> dict:
+    """Reply to a message in its thread.
+
+    Without recipient_ids the reply goes to everyone else on the message;
+    without a subject it reuses the message's, prefixed with "Re: ".
+    """
+    reply = dict(
+        sender_id=uuid.UUID(sender_id),
+        subject=subject,
+        content=content,
+        recipient_ids=None if recipient_ids is None else [
+            uuid.UUID(recipient_id) for recipient_id in recipient_ids],
+        idempotency_key=idempotency_key
     )
-    return [
-        {
-            "id": str(msg.id),
-            "subject": msg.subject,
-            "content": msg.content,
-            "sender_id": str(msg.sender_id),
-            "timestamp": msg.timestamp.isoformat()
-        }
-        for msg in messages
-    ]
+    async with session_scope() as db:
+        try:
+            if sharding.enabled():
+                result = await run_in_threadpool(
+                    sharding.reply_to_message, uuid.UUID(message_id), **reply)
+            else:
+                result = await run_db(db, crud.reply_to_message, uuid.UUID(message_id), **reply)
+        except crud.IdempotentReplay as e:
+            return await _replayed(db, e.message_id)
+        except crud.NotAParticipant as e:
+            raise HTTPException(status_code=403, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    db_message, delivered = result
+    await _remember_writes([sender_id])
+    queued = crud.delivers_later(delivered)
+    if not queued:
+        await cache.invalidate(delivered)
+        await realtime.publish_delivery(db_message, delivered)
+    return {"message_id": str(db_message.id), "thread_id": str(db_message.thread_id),
+            "replayed": False, "queued": queued}
+
+
+@tool()
+async def get_thread(thread_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                     fields: str = "summary") -> dict:
+    """Get a page of the messages in a thread, newest first"""
+    if sharding.enabled():
+        def fetch(db, thread_id, cursor, limit, fields):
+            return sharding.get_thread_messages(thread_id, cursor, limit, fields)
+    else:
+        fetch = crud.get_thread_messages
+    return await _page(fetch, thread_id, cursor, limit, fields, user_scoped=False)
+
+
+@tool()
+async def get_threads(user_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                      fields: str = "summary") -> dict:
+    """Get the latest message a user received in each thread, newest first"""
+    return await _page(crud.get_thread_inbox, user_id, cursor, limit, fields, sync=True)
+
+
+@tool()
+async def get_messages(user_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                       fields: str = "summary") -> dict:
+    """Get a page of messages for a user, newest first; fields="full" includes the bodies"""
+    return await _page(crud.get_inbox_messages, user_id, cursor, limit, fields, sync=True)
 
 
-@mcp.tool()
+@tool()
 async def mark_message_read(message_id: str, user_id: str) -> dict:
     """Mark a message as read"""
-    db = next(get_db())
-    recipient = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.message_id == uuid.UUID(message_id),
-            models.MessageRecipient.recipient_id == uuid.UUID(user_id)
-        )
-        .first()
-    )
-    if not recipient:
+    async with await _user_scope(user_id) as db:
+        found = await run_db(db, crud.mark_message_as_read,
+                             uuid.UUID(message_id), uuid.UUID(user_id))
+    if not found:
         raise HTTPException(
             status_code=404, detail="Message recipient not found")
-
-    recipient.read = True
-    recipient.read_at = datetime.now(timezone.utc)
-    db.commit()
+    await _remember_writes([user_id])
+    await cache.invalidate([uuid.UUID(user_id)])
     return {"status": "success"}
 
 
-@mcp.tool()
-async def get_unread_messages(user_id: str) -> List[dict]:
-    """Get all unread messages for a user"""
-    db = next(get_db())
-    messages = (
-        db.query(models.Message)
-        .join(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.recipient_id == uuid.UUID(user_id),
-            models.MessageRecipient.read == False
-        )
-        .all()
-    )
-    return [
-        {
-            "id": str(msg.id),
-            "subject": msg.subject,
-            "content": msg.content,
-            "sender_id": str(msg.sender_id),
-            "timestamp": msg.timestamp.isoformat()
-        }
-        for msg in messages
-    ]
-
-
-@mcp.tool()
-async def get_sent_messages(user_id: str) -> List[dict]:
-    """Get all messages sent by a user"""
-    db = next(get_db())
-    messages = (
-        db.query(models.Message)
-        .filter(models.Message.sender_id == uuid.UUID(user_id))
-        .all()
-    )
-    return [
-        {
-            "id": str(msg.id),
-            "subject": msg.subject,
-            "content": msg.content,
-            "sender_id": str(msg.sender_id),
-            "timestamp": msg.timestamp.isoformat()
-        }
-        for msg in messages
-    ]
-
-
-@mcp.tool()
-async def get_inbox_messages(user_id: str) -> List[dict]:
-    """Get all messages received by a user"""
-    db = next(get_db())
-    messages = (
-        db.query(models.Message)
-        .join(models.MessageRecipient)
-        .filter(models.MessageRecipient.recipient_id == uuid.UUID(user_id))
-        .all()
-    )
-    return [
-        {
-            "id": str(msg.id),
-            "subject": msg.subject,
-            "content": msg.content,
-            "sender_id": str(msg.sender_id),
-            "timestamp": msg.timestamp.isoformat()
-        }
-        for msg in messages
-    ]
+@tool()
+async def mark_messages_read(message_ids: List[str], user_id: str) -> dict:
+    """Mark several messages as read"""
+    async with await _user_scope(user_id) as db:
+        marked = await run_db(db, crud.mark_messages_as_read, uuid.UUID(user_id),
+                              [uuid.UUID(message_id) for message_id in message_ids])
+    if marked:
+        await _remember_writes([user_id])
+        await cache.invalidate([uuid.UUID(user_id)])
+    return {"status": "success", "marked": len(marked),
+            "message_ids": [str(message_id) for message_id in marked]}
+
+
+@tool()
+async def mark_all_read(user_id: str, up_to: Optional[str] = None, cursor: Optional[str] = None) -> dict:
+    """Mark all messages up to an ISO timestamp or listing cursor as read"""
+    async with await _user_scope(user_id) as db:
+        try:
+            marked = await run_db(
+                db, crud.mark_all_as_read, uuid.UUID(user_id),
+                up_to=datetime.fromisoformat(up_to) if up_to else None,
+                cursor=cursor)
+        except (crud.InvalidCursor, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if marked:
+        await _remember_writes([user_id])
+        await cache.invalidate([uuid.UUID(user_id)])
+    return {"status": "success", "marked": len(marked),
+            "message_ids": [str(message_id) for message_id in marked]}
+
+
+@tool()
+async def get_unread_messages(user_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                              fields: str = "summary") -> dict:
+    """Get a page of unread messages for a user, newest first; fields="full" includes the bodies"""
+    return await _page(crud.get_unread_messages, user_id, cursor, limit, fields, sync=True)
+
+
+@tool()
+async def get_unread_count(user_id: str) -> dict:
+    """Get the number of unread messages for a user"""
+    async with await _user_scope(user_id, read=True) as db:
+        unread_count = await run_db(db, crud.get_unread_count, uuid.UUID(user_id))
+    if unread_count is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"user_id": user_id, "unread_count": unread_count}
+
+
+@tool()
+async def get_sent_messages(user_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                            fields: str = "summary") -> dict:
+    """Get a page of messages sent by a user, newest first; fields="full" includes the bodies"""
+    return await _page(crud.get_sent_messages, user_id, cursor, limit, fields)
+
+
+@tool()
+async def get_inbox_messages(user_id: str, cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                             fields: str = "summary") -> dict:
+    """Get a page of messages received by a user, newest first; fields="full" includes the bodies"""
+    return await _page(crud.get_inbox_messages, user_id, cursor, limit, fields, sync=True)
+
+
+@tool()
+async def search_messages(user_id: str, query: str, folder: str = "inbox",
+                          cursor: Optional[str] = None, limit: int = crud.DEFAULT_PAGE_SIZE,
+                          fields: str = "summary") -> dict:
+    """Full-text search of a user's inbox or sent folder, best match first"""
+    if folder not in crud.SEARCH_FOLDERS:
+        raise HTTPException(status_code=400, detail=f"Unknown folder {folder!r}")
+
+    def search(db, user_id, cursor, limit, fields):
+        return crud.search_messages(db, user_id, query, folder, cursor, limit, fields)
+    return await _page(search, user_id, cursor, limit, fields, sync=folder == "inbox")
 
 # Mount MCP server to FastAPI app
 app.mount("/", mcp)
@@ -1,7 +1,9 @@
 # SQLAlchemy or Tortoise models
 
-from sqlalchemy import Column, String, Text, Boolean, ForeignKey, DateTime
+from sqlalchemy import DDL, JSON, Column, String, Text, Boolean, ForeignKey, DateTime, Index, Integer, BigInteger, UniqueConstraint
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
 import uuid
@@ -9,13 +11,18 @@ import uuid
 from .db import Base
 
 
+def utcnow() -> datetime:
+    # Columns are naive DateTime holding UTC; asyncpg rejects aware values
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     email = Column(String, unique=True, index=True)
     name = Column(String)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
 
     # Relationships
     sent_messages = relationship("Message", back_populates="sender")
@@ -23,19 +30,131 @@ class User(Base):
         "MessageRecipient", back_populates="recipient")
 
 
+class Group(Base):
+    """Named recipient list that broadcasts are addressed to."""
+    __tablename__ = "groups"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    name = Column(String, unique=True, nullable=False)
+    created_at = Column(DateTime, default=utcnow)
+    # Broadcasts sent so far; the group_seq of the latest one
+    message_count = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+class GroupMember(Base):
+    __tablename__ = "group_members"
+
+    group_id = Column(UUID(as_uuid=True), ForeignKey("groups.id"), primary_key=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True, index=True)
+    joined_at = Column(DateTime, default=utcnow)
+    # Broadcasts up to this group_seq have recipient rows for the member
+    # (or predate the membership); later ones are materialized on demand
+    synced_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+class MessageBody(Base):
+    """Large message bodies, stored once per distinct content."""
+    __tablename__ = "message_bodies"
+
+    hash = Column(String(64), primary_key=True)  # sha256 hex of the UTF-8 body
+    content = Column(Text, nullable=False)
+
+
 class Message(Base):
     __tablename__ = "messages"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     subject = Column(String, nullable=True)
-    content = Column(Text)
+    # NULL when the body is deduplicated into message_bodies; read
+    # Message.content, which falls back to the shared body
+    stored_content = Column("content", Text)
+    body_hash = Column(String(64), ForeignKey("message_bodies.hash"), nullable=True)
     sender_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
-    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = Column(DateTime, nullable=False, default=utcnow)
+    # Broadcasts are addressed to a group and numbered within it
+    group_id = Column(UUID(as_uuid=True), ForeignKey("groups.id"), nullable=True)
+    group_seq = Column(BigInteger, nullable=True)
+    # Replies share the thread_id of the message that started the thread
+    # (its own id). parent_id has no foreign key: a partitioned messages
+    # table can only be referenced by (id, timestamp).
+    thread_id = Column(UUID(as_uuid=True), nullable=True)
+    parent_id = Column(UUID(as_uuid=True), nullable=True)
 
     # Relationships
+    body = relationship(MessageBody, lazy="joined")
     sender = relationship("User", back_populates="sent_messages")
     recipients = relationship("MessageRecipient", back_populates="message")
 
+    # Keyset pagination indexes on (timestamp, id); broadcasts by group_seq
+    __table_args__ = (
+        Index("ix_messages_sender_id_timestamp_id", "sender_id", "timestamp", "id"),
+        Index("ix_messages_timestamp_id", "timestamp", "id"),
+        Index("ix_messages_group_id_group_seq", "group_id", "group_seq"),
+        Index("ix_messages_thread_id_timestamp_id", "thread_id", "timestamp", "id"),
+    )
+
+    @hybrid_property
+    def content(self):
+        if self.stored_content is None and self.body is not None:
+            return self.body.content
+        return self.stored_content
+
+    @content.inplace.setter
+    def _content_setter(self, value):
+        self.stored_content = value
+
+    @content.inplace.expression
+    @classmethod
+    def _content_expression(cls):
+        return func.coalesce(
+            cls.stored_content,
+            select(MessageBody.content).where(MessageBody.hash == cls.body_hash).scalar_subquery()
+        ).label("content")
+
+
+# Full-text search over subject and content. The index structures are
+# dialect specific and not mapped: Postgres gets a tsvector column kept by
+# a trigger with a GIN index, SQLite an external-content FTS5 table kept
+# in step by triggers. Both index deduplicated bodies through
+# message_bodies. Alembic revisions 0005 and 0008 create the same objects.
+SEARCH_BODY = "coalesce({row}.content, (SELECT content FROM message_bodies WHERE hash = {row}.body_hash))"
+
+SEARCH_DDL = {
+    "postgresql": [
+        "ALTER TABLE messages ADD COLUMN search_vector tsvector",
+        "CREATE OR REPLACE FUNCTION messages_search_vector() RETURNS trigger "
+        "LANGUAGE plpgsql AS $$ BEGIN NEW.search_vector := "
+        "setweight(to_tsvector('english', coalesce(NEW.subject, '')), 'A') || "
+        f"setweight(to_tsvector('english', coalesce({SEARCH_BODY.format(row='NEW')}, '')), 'B'); "
+        "RETURN NEW; END $$",
+        "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF subject, content, body_hash "
+        "ON messages FOR EACH ROW EXECUTE FUNCTION messages_search_vector()",
+        "CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE messages_fts USING fts5("
+        "subject, content, content='messages', content_rowid='rowid')",
+        "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        f"VALUES (new.rowid, new.subject, {SEARCH_BODY.format(row='new')}); END",
+        "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        f"VALUES ('delete', old.rowid, old.subject, {SEARCH_BODY.format(row='old')}); END",
+        "CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, subject, content) "
+        f"VALUES ('delete', old.rowid, old.subject, {SEARCH_BODY.format(row='old')}); "
+        "INSERT INTO messages_fts (rowid, subject, content) "
+        f"VALUES (new.rowid, new.subject, {SEARCH_BODY.format(row='new')}); END",
+    ],
+}
+
+for _dialect, _statements in SEARCH_DDL.items():
+    for _statement in _statements:
+        event.listen(Message.__table__, "after_create",
+                     DDL(_statement).execute_if(dialect=_dialect))
+event.listen(Message.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect="sqlite"))
+
 
 class MessageRecipient(Base):
     __tablename__ = "message_recipients"
@@ -45,7 +164,79 @@ class MessageRecipient(Base):
     recipient_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
     read = Column(Boolean, default=False)
     read_at = Column(DateTime, nullable=True)
+    # Copy of Message.timestamp: inbox keyset order without the join, and
+    # the partition key when the tables are partitioned (alembic 0007)
+    message_timestamp = Column(DateTime, nullable=False)
 
     # Relationships
     message = relationship("Message", back_populates="recipients")
     recipient = relationship("User", back_populates="received_messages")
+
+    __table_args__ = (
+        UniqueConstraint("message_id", "recipient_id",
+                         name="uq_message_recipients_message_id_recipient_id"),
+        Index("ix_message_recipients_recipient_id_read_message_id",
+              "recipient_id", "read", "message_id"),
+        # Inbox keyset pagination on (message_timestamp, message_id)
+        Index("ix_message_recipients_inbox",
+              "recipient_id", "message_timestamp", "message_id"),
+        # Unread rows only; Postgres/SQLite partial index
+        Index("ix_message_recipients_unread",
+              "recipient_id", "message_timestamp", "message_id",
+              postgresql_where=(read == False),
+              sqlite_where=(read == False)),
+    )
+
+
+class IdempotencyKey(Base):
+    """Client-supplied key of a send, so a retry returns the first message.
+
+    Kept apart from messages: a unique index there would have to include
+    the partition key when messages is partitioned.
+    """
+    __tablename__ = "idempotency_keys"
+
+    sender_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    # sha256 of the request, to reject a key reused for a different send
+    request_hash = Column(String(64), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=utcnow, index=True)
+
+
+class OutboxEntry(Base):
+    """Recipients of a large send still waiting for the delivery worker.
+
+    A send is split into entries of at most OUTBOX_CHUNK recipients that
+    workers claim independently. message_id has no foreign key, for the
+    same reason as IdempotencyKey's.
+    """
+    __tablename__ = "message_outbox"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    message_id = Column(UUID(as_uuid=True), nullable=False)
+    message_timestamp = Column(DateTime, nullable=False)
+    recipient_ids = Column(JSON, nullable=False)  # list of UUID strings
+    created_at = Column(DateTime, nullable=False, default=utcnow)
+
+
+class UserMailboxStats(Base):
+    """Per-user counters kept in step with message_recipients."""
+    __tablename__ = "user_mailbox_stats"
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Bumped on every delivery and read-state change; used for ETags
+    version = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+class ShardSlot(Base):
+    """Shard of a slot of user ids that the rebalancer moved off shard 0.
+
+    Only shard 0's table is read; see app/sharding.py.
+    """
+    __tablename__ = "shard_slots"
+
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(Integer, nullable=False)
+    moved_at = Column(DateTime, nullable=False, default=utcnow)
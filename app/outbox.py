@@ -0,0 +1,166 @@
+# Background delivery of queued sends
+#
+# Large sends commit their message with outbox entries (see
+# crud.send_message) and return 202. Workers drain the outbox here: each
+# claims a batch of entries with FOR UPDATE SKIP LOCKED, writes their
+# recipient rows and counters, and then notifies connected recipients.
+#
+# Usage: python -m app.outbox [--workers N] [--batch N] [--once]
+# With OUTBOX_INPROCESS set, the API process runs a worker itself. With
+# shards, a worker drains the outbox of each shard in turn.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Optional
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+
+from . import crud, metrics, models, realtime, sharding
+from .db import run_db, session_scope
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "4"))
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "1"))
+OUTBOX_INPROCESS = os.getenv("OUTBOX_INPROCESS", "false").lower() in ("1", "true", "yes")
+
+outbox_delivered = metrics.Counter(
+    "outbox_delivered_recipients_total", "Recipient rows written by the outbox worker")
+outbox_lag = metrics.Histogram(
+    "outbox_delivery_lag_seconds", "Time from a queued send to its delivery",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+
+
+class _QueueSample:
+    """Outbox depth and oldest entry across shards, read once per scrape.
+
+    Read from the database at scrape time, so the API process reports the
+    queue however many worker processes drain it; both gauges report the
+    same read.
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def refresh(self):
+        depth, oldest = 0, None
+        for index in range(sharding.shard_count()):
+            db = sharding.session(index)
+            try:
+                count, first = crud.outbox_stats(db)
+            except Exception:
+                logger.exception("Failed to read the outbox")
+                self.value = None
+                return
+            finally:
+                db.close()
+            depth += count
+            if first is not None and (oldest is None or first < oldest):
+                oldest = first
+        self.value = depth, oldest
+
+    def samples(self, stat):
+        def samples():
+            return [] if self.value is None else [({}, stat(*self.value))]
+        return samples
+
+
+_queue = _QueueSample()
+metrics.refresh_before_render(_queue.refresh)
+metrics.Gauge("outbox_queue_depth", "Outbox entries waiting for delivery",
+              callback=_queue.samples(lambda depth, oldest: depth))
+metrics.Gauge("outbox_oldest_entry_seconds", "Age of the oldest queued outbox entry",
+              callback=_queue.samples(
+                  lambda depth, oldest:
+                  (models.utcnow() - oldest).total_seconds() if oldest else 0))
+
+
+async def drain(batch_size: int = OUTBOX_BATCH) -> int:
+    """Deliver queued entries until none are left unclaimed.
+
+    Returns the number of recipient rows written. Cached mailbox pages need
+    no invalidation: their keys include the mailbox version, which the
+    delivery bumps.
+    """
+    total = 0
+    for index in range(sharding.shard_count()):
+        total += await _drain_shard(index, batch_size)
+    return total
+
+
+async def _drain_shard(index: int, batch_size: int) -> int:
+    total = 0
+    while True:
+        async with session_scope(shard=index) as db:
+            entries = await run_db(db, crud.deliver_outbox, batch_size)
+        if not entries:
+            return total
+        now = models.utcnow()
+        for entry in entries:
+            outbox_lag.observe((now - entry.created_at).total_seconds())
+            outbox_delivered.inc(len(entry.recipient_ids))
+            total += len(entry.recipient_ids)
+            await realtime.publish_delivery(
+                entry, [uuid.UUID(recipient_id) for recipient_id in entry.recipient_ids])
+
+
+async def run_worker(batch_size: int = OUTBOX_BATCH, poll: float = OUTBOX_POLL):
+    """Drain the outbox forever, polling every poll seconds once it is empty."""
+    while True:
+        try:
+            await drain(batch_size)
+        except Exception:
+            logger.exception("Outbox delivery failed; retrying")
+        await asyncio.sleep(poll)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int):
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+
+async def main(workers: int, batch_size: int, poll: float, once: bool,
+               metrics_port: Optional[int] = None):
+    if metrics_port:
+        serve_metrics(metrics_port)
+    try:
+        if once:
+            delivered = sum(await asyncio.gather(*(drain(batch_size) for _ in range(workers))))
+            print(f"Delivered {delivered} recipient rows")
+        else:
+            await asyncio.gather(*(run_worker(batch_size, poll) for _ in range(workers)))
+    finally:
+        await realtime.backend.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="python -m app.outbox")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="concurrent delivery loops in this process")
+    parser.add_argument("--batch", type=int, default=OUTBOX_BATCH,
+                        help="outbox entries claimed per transaction")
+    parser.add_argument("--poll", type=float, default=OUTBOX_POLL,
+                        help="seconds to wait when the outbox is empty")
+    parser.add_argument("--once", action="store_true",
+                        help="exit once the outbox is empty")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve /metrics for this worker on the port")
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.batch, args.poll, args.once, args.metrics_port))
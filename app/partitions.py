@@ -0,0 +1,159 @@
+# Partition maintenance for messages and message_recipients
+#
+# When alembic 0007 ran with DB_PARTITION_MESSAGES set, both tables are
+# range partitioned by month on the message timestamp, with partitions
+# named <table>_pYYYY_MM plus a <table>_default catch-all. Partitions for
+# upcoming months are created ahead of time; months past the retention
+# period are detached together and moved to an archive schema or dropped.
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional
+from datetime import date, datetime
+import re
+
+from . import models
+
+# (table, partition key, copied columns); messages first so that rows are
+# inserted parent before child and removed child before parent
+PARTITIONED_TABLES = (
+    ("messages", "timestamp",
+     "id, subject, content, body_hash, sender_id, timestamp, group_id, group_seq, "
+     "thread_id, parent_id"),
+    ("message_recipients", "message_timestamp",
+     "id, message_id, recipient_id, read, read_at, message_timestamp"),
+)
+
+_PARTITION_NAME = re.compile(r"^messages_p(\d{4})_(\d{2})$")
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def is_partitioned(db: Session) -> bool:
+    if db.get_bind().dialect.name != "postgresql":
+        return False
+    return db.scalar(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('messages'))"))
+
+
+# is_partitioned per engine, for the query paths: only a migration changes
+# it, and the app is restarted after one
+_partitioned: Dict[object, bool] = {}
+
+
+def listings_partitioned(db: Session) -> bool:
+    """is_partitioned, remembered for the session's engine."""
+    bind = db.get_bind()
+    if bind not in _partitioned:
+        _partitioned[bind] = is_partitioned(db)
+    return _partitioned[bind]
+
+
+def partition_months(db: Session) -> List[date]:
+    """Months that currently have an attached messages partition, oldest first."""
+    names = db.scalars(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"))
+    months = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def _create_month(db: Session, month: date):
+    start, end = month, add_months(month, 1)
+    bounds = {"start": start, "end": end}
+    # A month can't be split off while the default partition holds rows in
+    # its range, so those rows are parked in temp tables and put back after
+    for table, key, columns in reversed(PARTITIONED_TABLES):
+        db.execute(text(
+            f"CREATE TEMP TABLE moved_{table} ON COMMIT DROP AS "
+            f"SELECT {columns} FROM {table}_default WITH NO DATA"))
+        db.execute(text(
+            f"WITH moved AS (DELETE FROM {table}_default "
+            f"WHERE {key} >= :start AND {key} < :end RETURNING {columns}) "
+            f"INSERT INTO moved_{table} SELECT * FROM moved"), bounds)
+    for table, key, columns in PARTITIONED_TABLES:
+        db.execute(text(
+            f"CREATE TABLE {partition_name(table, month)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+        db.execute(text(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM moved_{table}"))
+
+
+def ensure_partitions(db: Session, months_ahead: int = 2,
+                      now: Optional[datetime] = None) -> List[str]:
+    """Create monthly partitions up to months_ahead past the current month.
+
+    Returns the names of the messages partitions created.
+    """
+    current = (now or models.utcnow()).date().replace(day=1)
+    existing = set(partition_months(db))
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month in existing:
+            continue
+        _create_month(db, month)
+        db.commit()
+        created.append(partition_name("messages", month))
+    return created
+
+
+def _drop_foreign_keys(db: Session, table: str):
+    # Archived tables keep no foreign keys, so they never block changes to
+    # the live tables (or to each other)
+    names = db.scalars(text(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = to_regclass(:table) AND contype = 'f'"), {"table": table})
+    for name in list(names):
+        db.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+
+
+def archive_partitions(db: Session, retain_months: int, schema: str = "archive",
+                       drop: bool = False, now: Optional[datetime] = None) -> List[str]:
+    """Detach partitions for months older than retain_months.
+
+    Detached tables are moved to ``schema``, or dropped when ``drop`` is
+    set. Unread counters lose the archived rows in the same transaction,
+    and their versions are bumped so cached pages and ETags turn over.
+    Returns the names of the messages partitions archived.
+    """
+    cutoff = add_months((now or models.utcnow()).date().replace(day=1), -retain_months)
+    if not drop:
+        db.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+    archived = []
+    for month in partition_months(db):
+        if month >= cutoff:
+            break
+        recipients = partition_name("message_recipients", month)
+        db.execute(text(
+            "UPDATE user_mailbox_stats AS stats "
+            "SET unread_count = stats.unread_count - archived.unread, "
+            "version = stats.version + 1 "
+            f"FROM (SELECT recipient_id, count(*) AS unread FROM {recipients} "
+            "WHERE read = false GROUP BY recipient_id) AS archived "
+            "WHERE stats.user_id = archived.recipient_id"))
+        for table, _, _ in reversed(PARTITIONED_TABLES):
+            partition = partition_name(table, month)
+            db.execute(text(f"ALTER TABLE {table} DETACH PARTITION {partition}"))
+            _drop_foreign_keys(db, partition)
+        for table, _, _ in reversed(PARTITIONED_TABLES):
+            partition = partition_name(table, month)
+            if drop:
+                db.execute(text(f"DROP TABLE {partition}"))
+            else:
+                db.execute(text(f'ALTER TABLE {partition} SET SCHEMA "{schema}"'))
+        db.commit()
+        archived.append(partition_name("messages", month))
+    return archived
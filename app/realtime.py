@@ -0,0 +1,286 @@
+# Real-time mailbox notifications
+#
+# Connected clients subscribe to a user's mailbox on the in-process Hub.
+# Events are published through a backend: LocalBackend delivers straight
+# to this process's hub, PostgresBackend fans out to every worker through
+# LISTEN/NOTIFY and each worker's listener delivers to its own hub.
+# A group broadcast is published once for the whole group; each hub looks
+# up which of its own subscribers are members.
+
+from collections import deque
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+REALTIME_BACKEND = os.getenv("REALTIME_BACKEND", "local")
+# Per-connection buffer limits; a subscriber that falls further behind
+# has its backlog dropped and is told to resync from the unread listing.
+REALTIME_MAX_EVENTS = int(os.getenv("REALTIME_MAX_EVENTS", "100"))
+REALTIME_MAX_BYTES = int(os.getenv("REALTIME_MAX_BYTES", str(64 * 1024)))
+REALTIME_HEARTBEAT = float(os.getenv("REALTIME_HEARTBEAT", "15"))
+
+NOTIFY_CHANNEL = "mailbox_events"
+# Stay well under Postgres' 8000 byte NOTIFY payload limit
+NOTIFY_CHUNK = 150
+
+RESYNC_EVENT = json.dumps({"type": "resync"})
+
+realtime_connections = metrics.Gauge(
+    "realtime_connections", "Open WebSocket/SSE mailbox subscriptions")
+realtime_resyncs = metrics.Counter(
+    "realtime_resyncs_total", "Subscriptions whose backlog overflowed and was dropped")
+
+
+class Subscription:
+    """A bounded event buffer for one connection."""
+
+    def __init__(self, user_id: uuid.UUID, max_events: int = REALTIME_MAX_EVENTS,
+                 max_bytes: int = REALTIME_MAX_BYTES):
+        self.user_id = user_id
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._events: deque = deque()
+        self._bytes = 0
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def offer(self, event: str):
+        """Queue an event; safe to call from any thread or event loop."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._offer(event)
+        else:
+            self._loop.call_soon_threadsafe(self._offer, event)
+
+    def _offer(self, event: str):
+        if (len(self._events) >= self.max_events
+                or self._bytes + len(event) > self.max_bytes):
+            self._events.clear()
+            self._bytes = 0
+            realtime_resyncs.inc()
+            event = RESYNC_EVENT
+        self._events.append(event)
+        self._bytes += len(event)
+        self._ready.set()
+
+    async def get(self) -> str:
+        while not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+        event = self._events.popleft()
+        self._bytes -= len(event)
+        return event
+
+
+class Hub:
+    def __init__(self):
+        self._subscriptions: Dict[uuid.UUID, Set[Subscription]] = {}
+        self._lock = Lock()
+
+    def subscribe(self, user_id: uuid.UUID) -> Subscription:
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def dispatch(self, user_ids: Iterable[uuid.UUID], event: str):
+        with self._lock:
+            targets = [subscription
+                       for user_id in user_ids
+                       for subscription in self._subscriptions.get(user_id, ())]
+        for subscription in targets:
+            subscription.offer(event)
+
+    async def dispatch_group(self, group_id: uuid.UUID, event: str):
+        """Deliver event to the subscribers who are members of the group."""
+        with self._lock:
+            user_ids = list(self._subscriptions)
+        if user_ids:
+            self.dispatch(await _subscribed_members(group_id, user_ids), event)
+
+    def connection_count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+async def _subscribed_members(group_id: uuid.UUID, user_ids: List[uuid.UUID]):
+    from . import crud
+    from .db import run_db, session_scope
+    async with session_scope() as db:
+        return await run_db(db, crud.get_group_members_among, group_id, user_ids)
+
+
+hub = Hub()
+realtime_connections.add_callback(lambda: [({}, hub.connection_count())])
+
+# Backends
+
+
+class LocalBackend:
+    """Single-process delivery, also the stand-in for tests."""
+
+    def __init__(self, hub: Hub):
+        self.hub = hub
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_ids: List[uuid.UUID], event: str):
+        self.hub.dispatch(user_ids, event)
+
+    async def publish_group(self, group_id: uuid.UUID, event: str):
+        await self.hub.dispatch_group(group_id, event)
+
+
+class PostgresBackend:
+    """Cross-worker delivery over Postgres LISTEN/NOTIFY (asyncpg)."""
+
+    def __init__(self, hub: Hub, dsn: str):
+        self.hub = hub
+        self.dsn = dsn
+        self._listener = None
+        self._pool = None
+        # Group dispatches in flight, referenced until they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        import asyncpg
+        self._listener = await asyncpg.connect(self.dsn)
+        await self._listener.add_listener(NOTIFY_CHANNEL, self._on_notify)
+
+    async def stop(self):
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def _notify(self, payload: dict):
+        if self._pool is None:
+            import asyncpg
+            self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+        await self._pool.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, json.dumps(payload))
+
+    async def publish(self, user_ids: List[uuid.UUID], event: str):
+        user_ids = [str(user_id) for user_id in user_ids]
+        for start in range(0, len(user_ids), NOTIFY_CHUNK):
+            await self._notify({"user_ids": user_ids[start:start + NOTIFY_CHUNK], "event": event})
+
+    async def publish_group(self, group_id: uuid.UUID, event: str):
+        await self._notify({"group_id": str(group_id), "event": event})
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+            if "group_id" in data:
+                task = asyncio.get_running_loop().create_task(
+                    self.hub.dispatch_group(uuid.UUID(data["group_id"]), data["event"]))
+                self._tasks.add(task)
+                task.add_done_callback(self._group_dispatched)
+                return
+            self.hub.dispatch([uuid.UUID(user_id) for user_id in data["user_ids"]],
+                              data["event"])
+        except (ValueError, KeyError):
+            logger.warning("Ignoring malformed %s payload", channel)
+
+    def _group_dispatched(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to deliver a group event", exc_info=task.exception())
+
+
+def _postgres_dsn() -> str:
+    from sqlalchemy.engine import make_url
+    from .db import SQLALCHEMY_DATABASE_URL
+    url = make_url(SQLALCHEMY_DATABASE_URL).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+
+def build_backend(name: str = REALTIME_BACKEND):
+    if name == "local":
+        return LocalBackend(hub)
+    if name == "postgres":
+        return PostgresBackend(hub, _postgres_dsn())
+    raise ValueError(f"Unknown REALTIME_BACKEND {name!r}")
+
+
+backend = build_backend()
+
+# Events
+
+
+def _message_event(message) -> str:
+    return json.dumps({
+        "type": "message",
+        "message_id": str(message.id),
+        "sender_id": str(message.sender_id),
+        "subject": (message.subject or "")[:100],
+        "timestamp": message.timestamp.isoformat()
+    })
+
+
+async def publish_delivery(message, recipient_ids: Iterable[uuid.UUID]):
+    """Tell connected recipients about a committed message."""
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+    if not recipient_ids:
+        return
+    try:
+        await backend.publish(recipient_ids, _message_event(message))
+    except Exception:
+        # Delivery is already committed; clients catch up on reconnect
+        logger.exception("Failed to publish delivery of %s", message.id)
+
+
+async def publish_broadcast(message):
+    """Tell connected members of the message's group about a committed broadcast.
+
+    One event whatever the group's size: hubs resolve it against their own
+    subscribers.
+    """
+    try:
+        await backend.publish_group(message.group_id, _message_event(message))
+    except Exception:
+        logger.exception("Failed to publish broadcast %s", message.id)
+
+
+async def sse_events(user_id: uuid.UUID, is_disconnected=None,
+                     heartbeat: float = REALTIME_HEARTBEAT):
+    """Server-Sent Events stream of a user's mailbox events.
+
+    Subscribes once the stream starts, so a response that is never
+    streamed (the client left first) leaves nothing in the hub.
+    """
+    subscription = hub.subscribe(user_id)
+    try:
+        while not (is_disconnected and await is_disconnected()):
+            try:
+                event = await asyncio.wait_for(subscription.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {event}\n\n"
+    finally:
+        hub.unsubscribe(subscription)
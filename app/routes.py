@@ -1,126 +1,518 @@
 # FastAPI routes
+#
+# Handlers are async and hand their queries to crud through run_db, which
+# uses the asyncio engine when DB_ASYNC is set and the threadpool otherwise.
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session, joinedload
-from typing import List
-from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Union
+import hashlib
 import uuid
 
-from . import models, schemas
-from .db import get_db
+from . import cache, crud, realtime, schemas, sharding
+from .db import (DB_READ_YOUR_WRITES, get_session, has_replicas, run_db, use_primary, use_replica,
+                 use_shard)
 
 router = APIRouter()
 
+
+def _use_user_shard(request: Request, db):
+    # Malformed ids are left to the path parameter's validation
+    try:
+        user_id = uuid.UUID(request.path_params["user_id"])
+    except (KeyError, ValueError):
+        return
+    use_shard(db, sharding.shard_of(user_id))
+
+
+async def get_read_session(request: Request, db=Depends(get_session)):
+    """Session for read-only handlers, reading from a replica if configured.
+
+    Reads about a user who wrote in the last DB_READ_YOUR_WRITES seconds
+    stay on the primary, so they see their own sends and read marks. With
+    shards, reads about a user go to their shard instead.
+    """
+    if sharding.enabled():
+        _use_user_shard(request, db)
+        return db
+    user_id = request.path_params.get("user_id")
+    if has_replicas() and not (user_id and await cache.wrote_recently(user_id)):
+        use_replica(db)
+    return db
+
+
+async def get_user_session(request: Request, db=Depends(get_session)):
+    """Session for handlers that change a user's mailbox: on their shard, if sharded."""
+    if sharding.enabled():
+        _use_user_shard(request, db)
+    return db
+
+
+def unsharded():
+    if sharding.enabled():
+        raise HTTPException(status_code=501, detail="Groups are not available with sharding")
+
+
+async def _remember_writes(user_ids):
+    if has_replicas():
+        await cache.remember_writes(user_ids, DB_READ_YOUR_WRITES)
+
+
+async def _send(db, **kwargs):
+    # Sharded sends write to several shards through their own sessions
+    if sharding.enabled():
+        return await run_in_threadpool(sharding.send_message, **kwargs)
+    return await run_db(db, crud.send_message, **kwargs)
+
+
+async def _reply(db, message_id: uuid.UUID, **kwargs):
+    if sharding.enabled():
+        return await run_in_threadpool(sharding.reply_to_message, message_id, **kwargs)
+    return await run_db(db, crud.reply_to_message, message_id, **kwargs)
+
+
+async def _original(db, message_id: uuid.UUID):
+    # The first message of an idempotent send, found on any shard
+    if sharding.enabled():
+        found = await run_in_threadpool(sharding.get_message, message_id)
+        return found[0] if found else None
+    return await run_db(db, crud.get_message, message_id)
+
+
+async def _replayed(db, message_id: uuid.UUID, response: Response):
+    # Answer a retry with the original message, and with 202 like the
+    # original while the outbox worker still has deliveries of it queued
+    original = await _original(db, message_id)
+    if original is None:
+        raise HTTPException(status_code=409,
+                            detail=f"Already sent as message {message_id}, which no longer exists")
+    if sharding.enabled():
+        pending = await run_in_threadpool(sharding.delivery_pending, message_id)
+    else:
+        pending = await run_db(db, crud.delivery_pending, message_id)
+    if pending:
+        response.status_code = 202
+    response.headers["Idempotent-Replayed"] = "true"
+    return original
+
 # User routes
 
 
 @router.post("/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = models.User(
-        email=user.email,
-        name=user.name
-    )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+async def create_user(user: schemas.UserCreate, db=Depends(get_session)):
+    try:
+        if sharding.enabled():
+            return await run_in_threadpool(sharding.create_user, user.email, user.name)
+        return await run_db(db, crud.create_user, email=user.email, name=user.name)
+    except crud.EmailTaken as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/users/bulk", response_model=schemas.UserBulkResult)
+async def create_users(batch: schemas.UserBulkCreate, db=Depends(get_session)):
+    users = [(user.email, user.name) for user in batch.users]
+    if sharding.enabled():
+        created, existing = await run_in_threadpool(sharding.create_users, users)
+    else:
+        created, existing = await run_db(db, crud.create_users, users)
+    return {"created": created, "existing": existing}
 
 
 @router.get("/users/", response_model=List[schemas.User])
-def list_users(db: Session = Depends(get_db)):
-    return db.query(models.User).all()
+async def list_users(response: Response,
+                     ids: Optional[List[uuid.UUID]] = Query(None, max_length=1000),
+                     email_prefix: Optional[str] = None, cursor: Optional[str] = None,
+                     limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                     db=Depends(get_read_session)):
+    # ?ids= is a batch lookup; otherwise a page in email order with the
+    # next page's cursor in the X-Next-Cursor header
+    if ids:
+        return await run_db(db, crud.get_users, ids)
+    try:
+        users, next_cursor = await run_db(db, crud.list_users, email_prefix, cursor, limit)
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return users
 
 
 @router.get("/users/{user_id}", response_model=schemas.User)
-def get_user(user_id: uuid.UUID, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+async def get_user(user_id: uuid.UUID, db=Depends(get_read_session)):
+    user = await run_db(db, crud.get_user, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
-# Message routes
 
+@router.get("/users/{user_id}/unread_count", response_model=schemas.UnreadCount)
+async def get_unread_count(user_id: uuid.UUID, db=Depends(get_read_session)):
+    unread_count = await run_db(db, crud.get_unread_count, user_id)
+    if unread_count is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"user_id": user_id, "unread_count": unread_count}
+
+# Group routes
+
+
+@router.post("/groups/", response_model=schemas.Group,
+             dependencies=[Depends(unsharded)])
+async def create_group(group: schemas.GroupCreate, db=Depends(get_session)):
+    try:
+        return await run_db(db, crud.create_group, group.name, group.member_ids)
+    except (crud.GroupNameTaken, crud.UnknownUsers) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/groups/{group_id}", response_model=schemas.Group,
+             dependencies=[Depends(unsharded)])
+async def get_group(group_id: uuid.UUID, db=Depends(get_read_session)):
+    group = await run_db(db, crud.get_group, group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return group
+
+
+@router.post("/groups/{group_id}/members", response_model=schemas.GroupMembersResult,
+             dependencies=[Depends(unsharded)])
+async def add_group_members(group_id: uuid.UUID, members: schemas.GroupMembers,
+                            db=Depends(get_session)):
+    if not await run_db(db, crud.get_group, group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    try:
+        added = await run_db(db, crud.add_group_members, group_id, members.user_ids)
+    except crud.UnknownUsers as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"added": len(added)}
 
-@router.post("/messages/", response_model=schemas.Message)
-def send_message(message: schemas.MessageCreate, db: Session = Depends(get_db)):
-    # Create message
-    db_message = models.Message(
-        subject=message.subject,
-        content=message.content,
-        sender_id=message.sender_id
-    )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-
-    # Create message recipients
-    for recipient_id in message.recipient_ids:
-        recipient = models.MessageRecipient(
-            message_id=db_message.id,
-            recipient_id=recipient_id
+
+@router.delete("/groups/{group_id}/members/{user_id}", dependencies=[Depends(unsharded)])
+async def remove_group_member(group_id: uuid.UUID, user_id: uuid.UUID, db=Depends(get_session)):
+    if not await run_db(db, crud.remove_group_member, group_id, user_id):
+        raise HTTPException(status_code=404, detail="Group member not found")
+    return {"status": "success"}
+
+
+@router.post("/groups/{group_id}/messages", response_model=schemas.Broadcast,
+             dependencies=[Depends(unsharded)])
+async def broadcast_message(group_id: uuid.UUID, message: schemas.BroadcastCreate,
+                            db=Depends(get_session)):
+    try:
+        db_message = await run_db(
+            db,
+            crud.broadcast_message,
+            sender_id=message.sender_id,
+            group_id=group_id,
+            subject=message.subject,
+            content=message.content
         )
-        db.add(recipient)
+    except crud.UnknownUsers as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if db_message is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    await _remember_writes([message.sender_id])
+    # Members' cached pages turn over with the group's message_count,
+    # which is part of their mailbox version, so nothing is invalidated
+    await realtime.publish_broadcast(db_message)
+    return db_message
 
-    db.commit()
+# Message routes
+
+
+@router.post("/messages/", response_model=schemas.Message,
+             responses={202: {"model": schemas.Message,
+                              "description": "Queued for delivery by the outbox worker"}})
+async def send_message(message: schemas.MessageCreate, response: Response,
+                       idempotency_key: Optional[str] = Header(None, min_length=1, max_length=255),
+                       db=Depends(get_session)):
+    try:
+        db_message = await _send(
+            db,
+            sender_id=message.sender_id,
+            recipient_ids=message.recipient_ids,
+            subject=message.subject,
+            content=message.content,
+            idempotency_key=idempotency_key
+        )
+    except crud.UnknownUsers as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except crud.IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except crud.IdempotentReplay as e:
+        # A retry: answer with the original message and deliver nothing
+        return await _replayed(db, e.message_id, response)
+    await _remember_writes([message.sender_id])
+    if crud.delivers_later(message.recipient_ids):
+        # Accepted: the outbox worker delivers it and notifies recipients
+        response.status_code = 202
+        return db_message
+    await cache.invalidate(message.recipient_ids)
+    await realtime.publish_delivery(db_message, message.recipient_ids)
     return db_message
 
 
-@router.get("/messages/sent/{user_id}", response_model=List[schemas.Message])
-def get_sent_messages(user_id: uuid.UUID, db: Session = Depends(get_db)):
-    return db.query(models.Message).filter(models.Message.sender_id == user_id).all()
+FieldsQuery = Query("summary", pattern="^(summary|full)$",
+                    description="summary rows with a content snippet, or full messages")
+PageModel = Union[schemas.MessageSummaryPage, schemas.MessagePage]
 
+# Listing pages bypass FastAPI's response_model pass (per-object validation
+# followed by the stdlib encoder): schemas.render_page validates the rows
+# in one batch and pydantic-core writes the JSON bytes.
 
-@router.get("/messages/inbox/{user_id}", response_model=List[schemas.Message])
-def get_inbox_messages(user_id: uuid.UUID, db: Session = Depends(get_db)):
-    return (
-        db.query(models.Message)
-        .join(models.MessageRecipient)
-        .filter(models.MessageRecipient.recipient_id == user_id)
-        .all()
-    )
 
+async def _render_page(fetch, db, user_id: uuid.UUID, cursor: Optional[str], limit: int,
+                       fields: str) -> bytes:
+    try:
+        items, next_cursor = await run_db(db, fetch, user_id, cursor, limit, fields)
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return schemas.render_page(fields, items, next_cursor)
 
-@router.get("/messages/unread/{user_id}", response_model=List[schemas.Message])
-def get_unread_messages(user_id: uuid.UUID, db: Session = Depends(get_db)):
-    return (
-        db.query(models.Message)
-        .join(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.recipient_id == user_id,
-            models.MessageRecipient.read == False
-        )
-        .all()
-    )
 
+async def _sync_broadcasts(db, user_id: uuid.UUID):
+    # Listings of received messages need the user's group broadcasts as
+    # recipient rows. Creating them is a write, so when any are pending the
+    # request leaves the replica and syncs on the primary first.
+    if await run_db(db, crud.has_pending_broadcasts, user_id):
+        use_primary(db)
+        await run_db(db, crud.sync_group_deliveries, user_id)
 
-@router.get("/messages/{message_id}", response_model=schemas.Message)
-def get_message(message_id: uuid.UUID, db: Session = Depends(get_db)):
-    message = (
-        db.query(models.Message)
-        .filter(models.Message.id == message_id)
-        .first()
-    )
+
+async def _page(fetch, db, user_id: uuid.UUID, cursor: Optional[str], limit: int,
+                fields: str = "summary") -> Response:
+    body = await _render_page(fetch, db, user_id, cursor, limit, fields)
+    return Response(body, media_type="application/json")
+
+
+def _etag(version: int, *parts) -> str:
+    variant = hashlib.sha1("|".join(str(part) for part in parts).encode())
+    return f'"{version}-{variant.hexdigest()[:16]}"'
+
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def _cached_page(view: str, fetch, db, user_id: uuid.UUID, cursor: Optional[str],
+                       limit: int, fields: str, if_none_match: Optional[str] = None):
+    view = f"{view}:{fields}"
+    # One primary-key lookup decides whether the client's copy is current
+    version = await run_db(db, crud.get_mailbox_version, user_id)
+    etag = _etag(version, user_id, view, cursor, limit)
+    if _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    key = f"{await cache.page_key(user_id, view, cursor, limit)}:{version}"
+    body = await cache.get_page(key)
+    if body is None:
+        await _sync_broadcasts(db, user_id)
+        body = (await _render_page(fetch, db, user_id, cursor, limit, fields)).decode()
+        await cache.set_page(key, body)
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+@router.get("/messages/sent/{user_id}", response_model=PageModel)
+async def get_sent_messages(user_id: uuid.UUID, cursor: Optional[str] = None,
+                            limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                            fields: str = FieldsQuery, db=Depends(get_read_session)):
+    return await _page(crud.get_sent_messages, db, user_id, cursor, limit, fields)
+
+
+@router.get("/messages/inbox/{user_id}", response_model=PageModel)
+async def get_inbox_messages(user_id: uuid.UUID, cursor: Optional[str] = None,
+                             limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                             fields: str = FieldsQuery,
+                             if_none_match: Optional[str] = Header(None),
+                             db=Depends(get_read_session)):
+    return await _cached_page("inbox", crud.get_inbox_messages, db, user_id, cursor, limit,
+                              fields, if_none_match)
+
+
+@router.get("/messages/unread/{user_id}", response_model=PageModel)
+async def get_unread_messages(user_id: uuid.UUID, cursor: Optional[str] = None,
+                              limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                              fields: str = FieldsQuery,
+                              if_none_match: Optional[str] = Header(None),
+                              db=Depends(get_read_session)):
+    return await _cached_page("unread", crud.get_unread_messages, db, user_id, cursor, limit,
+                              fields, if_none_match)
+
+
+@router.get("/messages/threads/{user_id}", response_model=PageModel)
+async def get_thread_inbox(user_id: uuid.UUID, cursor: Optional[str] = None,
+                           limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                           fields: str = FieldsQuery,
+                           if_none_match: Optional[str] = Header(None),
+                           db=Depends(get_read_session)):
+    # The latest message received in each thread
+    return await _cached_page("threads", crud.get_thread_inbox, db, user_id, cursor, limit,
+                              fields, if_none_match)
+
+
+@router.get("/threads/{thread_id}", response_model=PageModel)
+async def get_thread(thread_id: uuid.UUID, cursor: Optional[str] = None,
+                     limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                     fields: str = FieldsQuery, db=Depends(get_read_session)):
+    try:
+        if sharding.enabled():
+            # Copies of the thread's messages are spread over the shards
+            items, next_cursor = await run_in_threadpool(
+                sharding.get_thread_messages, thread_id, cursor, limit, fields)
+        else:
+            items, next_cursor = await run_db(
+                db, crud.get_thread_messages, thread_id, cursor, limit, fields)
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not items and not cursor:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return Response(schemas.render_page(fields, items, next_cursor),
+                    media_type="application/json")
+
+
+@router.get("/messages/search/{user_id}", response_model=PageModel)
+async def search_messages(user_id: uuid.UUID, q: str = Query(..., min_length=1, max_length=256),
+                          folder: str = Query("inbox", pattern="^(inbox|sent)$"),
+                          cursor: Optional[str] = None,
+                          limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                          fields: str = FieldsQuery, db=Depends(get_read_session)):
+    def search(db, user_id, cursor, limit, fields):
+        return crud.search_messages(db, user_id, q, folder, cursor, limit, fields)
+    if folder == "inbox":
+        await _sync_broadcasts(db, user_id)
+    return await _page(search, db, user_id, cursor, limit, fields)
+
+
+async def export_lines(user_id: uuid.UUID, folders=crud.EXPORT_FOLDERS):
+    """NDJSON chunks of a user's mailbox, one batch of rows at a time.
+
+    Rows come from a server-side cursor (yield_per), so memory holds one
+    batch however large the mailbox is. The stream owns its session: it
+    outlives the request's dependencies.
+    """
+    async with sharding.user_scope(user_id) as db:
+        for folder, stmt in crud.export_statements(user_id, folders):
+            stmt = stmt.execution_options(yield_per=crud.EXPORT_BATCH_SIZE)
+            if isinstance(db, AsyncSession):
+                result = await db.stream(stmt)
+                async for rows in result.partitions():
+                    yield schemas.render_export(folder, rows)
+            else:
+                partitions = (await run_in_threadpool(db.execute, stmt)).partitions()
+                while rows := await run_in_threadpool(next, partitions, None):
+                    yield schemas.render_export(folder, rows)
+
+
+@router.get("/messages/export/{user_id}", response_class=StreamingResponse)
+async def export_messages(user_id: uuid.UUID,
+                          folder: Optional[str] = Query(None, pattern="^(inbox|sent)$"),
+                          db=Depends(get_user_session)):
+    if not await run_db(db, crud.get_user, user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    await run_db(db, crud.sync_group_deliveries, user_id)
+    folders = [folder] if folder else crud.EXPORT_FOLDERS
+    return StreamingResponse(
+        export_lines(user_id, folders), media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="mailbox-{user_id}.ndjson"'})
+
+
+@router.post("/messages/read/{user_id}", response_model=schemas.MarkReadResult)
+async def mark_messages_as_read(user_id: uuid.UUID, batch: schemas.MarkRead,
+                                db=Depends(get_user_session)):
+    marked = await run_db(db, crud.mark_messages_as_read, user_id, batch.message_ids)
+    if marked:
+        await _remember_writes([user_id])
+        await cache.invalidate([user_id])
+    return {"marked": len(marked), "message_ids": marked}
+
+
+@router.post("/messages/read_all/{user_id}", response_model=schemas.MarkReadResult)
+async def mark_all_as_read(user_id: uuid.UUID, mark: schemas.MarkAllRead,
+                           db=Depends(get_user_session)):
+    try:
+        marked = await run_db(db, crud.mark_all_as_read, user_id,
+                              up_to=mark.up_to, cursor=mark.cursor)
+    except crud.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if marked:
+        await _remember_writes([user_id])
+        await cache.invalidate([user_id])
+    return {"marked": len(marked), "message_ids": marked}
+
+
+@router.get("/messages/{message_id}",
+            response_model=Union[schemas.MessageWithRecipients, schemas.Message])
+async def get_message(message_id: uuid.UUID,
+                      include: Optional[str] = Query(None, pattern="^recipients$"),
+                      db=Depends(get_read_session)):
+    include_recipients = include == "recipients"
+    if sharding.enabled():
+        # Each shard with a copy holds the recipient rows of its users
+        found = await run_in_threadpool(sharding.get_message, message_id, include_recipients)
+        if not found:
+            raise HTTPException(status_code=404, detail="Message not found")
+        message, recipients = found
+        if include_recipients:
+            return schemas.MessageWithRecipients(
+                **schemas.Message.model_validate(message).model_dump(),
+                recipients=[schemas.MessageRecipient.model_validate(row) for row in recipients])
+        return schemas.Message.model_validate(message)
+    message = await run_db(db, crud.get_message, message_id, include_recipients)
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
 
-    return message
+    # Validate here, while the eagerly loaded recipients are attached
+    if include_recipients:
+        return schemas.MessageWithRecipients.model_validate(message)
+    return schemas.Message.model_validate(message)
 
 
-@router.post("/messages/{message_id}/read/{user_id}")
-def mark_message_as_read(message_id: uuid.UUID, user_id: uuid.UUID, db: Session = Depends(get_db)):
-    recipient = (
-        db.query(models.MessageRecipient)
-        .filter(
-            models.MessageRecipient.message_id == message_id,
-            models.MessageRecipient.recipient_id == user_id
+@router.post("/messages/{message_id}/reply", response_model=schemas.Message,
+             responses={202: {"model": schemas.Message,
+                              "description": "Queued for delivery by the outbox worker"}})
+async def reply_to_message(message_id: uuid.UUID, reply: schemas.ReplyCreate, response: Response,
+                           idempotency_key: Optional[str] = Header(None, min_length=1, max_length=255),
+                           db=Depends(get_session)):
+    try:
+        result = await _reply(
+            db,
+            message_id,
+            sender_id=reply.sender_id,
+            subject=reply.subject,
+            content=reply.content,
+            recipient_ids=reply.recipient_ids,
+            idempotency_key=idempotency_key
         )
-        .first()
-    )
-    if not recipient:
+    except crud.NotAParticipant as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except crud.UnknownUsers as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except crud.IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except crud.IdempotentReplay as e:
+        return await _replayed(db, e.message_id, response)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    db_message, recipient_ids = result
+    await _remember_writes([reply.sender_id])
+    if crud.delivers_later(recipient_ids):
+        response.status_code = 202
+        return db_message
+    await cache.invalidate(recipient_ids)
+    await realtime.publish_delivery(db_message, recipient_ids)
+    return db_message
+
+
+@router.post("/messages/{message_id}/read/{user_id}")
+async def mark_message_as_read(message_id: uuid.UUID, user_id: uuid.UUID,
+                               db=Depends(get_user_session)):
+    if not await run_db(db, crud.mark_message_as_read, message_id, user_id):
         raise HTTPException(
             status_code=404, detail="Message recipient not found")
-
-    recipient.read = True
-    recipient.read_at = datetime.now(timezone.utc)
-    db.commit()
+    await _remember_writes([user_id])
+    await cache.invalidate([user_id])
     return {"status": "success"}
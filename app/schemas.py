@@ -1,6 +1,6 @@
 # Pydantic models
 
-from pydantic import BaseModel, EmailStr, UUID4, ConfigDict
+from pydantic import BaseModel, EmailStr, UUID4, ConfigDict, Field, TypeAdapter
 from typing import Optional, List
 from datetime import datetime
 
@@ -21,6 +21,20 @@ class User(UserBase):
     created_at: datetime
     model_config = ConfigDict(from_attributes=True)
 
+
+class UserBulkCreate(BaseModel):
+    users: List[UserCreate] = Field(max_length=50000)
+
+
+class UserBulkResult(BaseModel):
+    created: List[User]
+    existing: List[EmailStr]
+
+
+class UnreadCount(BaseModel):
+    user_id: UUID4
+    unread_count: int
+
 # Message schemas
 
 
@@ -38,15 +52,138 @@ class Message(MessageBase):
     id: UUID4
     sender_id: UUID4
     timestamp: datetime
+    thread_id: Optional[UUID4] = None
+    parent_id: Optional[UUID4] = None
     model_config = ConfigDict(from_attributes=True)
 
-# Message with recipients
 
+# Replies default to the parent's subject and everyone else on it
 
-class MessageWithRecipients(Message):
-    recipients: List[User]
+
+class ReplyCreate(BaseModel):
+    sender_id: UUID4
+    subject: Optional[str] = None
+    content: str
+    recipient_ids: Optional[List[UUID4]] = None
+
+# Groups and broadcasts
+
+
+class GroupCreate(BaseModel):
+    name: str = Field(min_length=1)
+    member_ids: List[UUID4] = Field(default=[], max_length=50000)
+
+
+class Group(BaseModel):
+    id: UUID4
+    name: str
+    created_at: datetime
+    message_count: int
+    model_config = ConfigDict(from_attributes=True)
+
+
+class GroupMembers(BaseModel):
+    user_ids: List[UUID4] = Field(max_length=50000)
+
+
+class GroupMembersResult(BaseModel):
+    added: int
+
+
+class BroadcastCreate(MessageBase):
+    sender_id: UUID4
+
+
+class Broadcast(Message):
+    group_id: UUID4
+    group_seq: int
+
+# Paginated message listing
+
+
+# Inbox and unread rows carry the recipient's read state; it is None
+# in sent listings
+
+
+class MessageListItem(Message):
+    read: Optional[bool] = None
+    read_at: Optional[datetime] = None
+
+
+class MessagePage(BaseModel):
+    items: List[MessageListItem]
+    next_cursor: Optional[str] = None
+
+
+class MessageExport(MessageListItem):
+    folder: str
+
+
+class MessageSummary(BaseModel):
+    id: UUID4
+    sender_id: UUID4
+    subject: Optional[str] = None
+    timestamp: datetime
+    thread_id: Optional[UUID4] = None
+    parent_id: Optional[UUID4] = None
+    read: Optional[bool] = None
+    read_at: Optional[datetime] = None
+    snippet: str
     model_config = ConfigDict(from_attributes=True)
 
+
+class MessageSummaryPage(BaseModel):
+    items: List[MessageSummary]
+    next_cursor: Optional[str] = None
+
+
+PAGE_SCHEMAS = {"summary": MessageSummaryPage, "full": MessagePage}
+_PAGE_ADAPTERS = {fields: TypeAdapter(schema) for fields, schema in PAGE_SCHEMAS.items()}
+
+
+def render_page(fields: str, rows, next_cursor: Optional[str]) -> bytes:
+    """Validate a page of listing rows in one pass and dump it to JSON bytes.
+
+    Rows are the tuples crud selects column-wise; zipping them into dicts
+    validates several times faster than attribute access on Row objects.
+    """
+    adapter = _PAGE_ADAPTERS[fields]
+    keys = [str(key) for key in rows[0]._fields] if rows else []
+    page = adapter.validate_python({
+        "items": [dict(zip(keys, row)) for row in rows],
+        "next_cursor": next_cursor
+    })
+    return adapter.dump_json(page)
+
+
+_EXPORT_ADAPTER = TypeAdapter(List[MessageExport])
+_EXPORT_ITEM = TypeAdapter(MessageExport)
+
+
+def render_export(folder: str, rows) -> bytes:
+    """One NDJSON line per export row."""
+    keys = [str(key) for key in rows[0]._fields] if rows else []
+    items = _EXPORT_ADAPTER.validate_python(
+        [{"folder": folder, **dict(zip(keys, row))} for row in rows])
+    return b"".join(_EXPORT_ITEM.dump_json(item) + b"\n" for item in items)
+
+# Read state updates
+
+
+class MarkRead(BaseModel):
+    message_ids: List[UUID4] = Field(max_length=1000)
+
+
+class MarkAllRead(BaseModel):
+    up_to: Optional[datetime] = None
+    cursor: Optional[str] = None
+
+
+class MarkReadResult(BaseModel):
+    status: str = "success"
+    marked: int
+    message_ids: List[UUID4]
+
 # Message recipient schemas
 
 
@@ -60,3 +197,11 @@ class MessageRecipientBase(BaseModel):
 class MessageRecipient(MessageRecipientBase):
     id: UUID4
     model_config = ConfigDict(from_attributes=True)
+
+# Message with recipients
+
+
+class MessageWithRecipients(Message):
+    recipients: List[MessageRecipient]
+    model_config = ConfigDict(from_attributes=True)
+
@@ -0,0 +1,576 @@
+# Mailboxes sharded by user id
+#
+# With DB_SHARD_URLS set, mailboxes are spread over the primary (shard 0)
+# and the listed databases. A user id hashes to one of SHARD_SLOTS slots
+# and each slot lives on one shard: shard 0, unless the shard_slots table
+# on shard 0 assigns it elsewhere. On their shard a user has their
+# recipient rows and counters, a copy of every message they received and
+# the messages they sent, so every query about one user (inbox, unread,
+# threads, search, read marks) runs on a single shard. The users table is
+# copied to every shard, which keeps foreign keys and recipient checks
+# local.
+#
+# Slots are moved by the rebalancer (python -m app.manage rebalance-shards
+# and move-slots): it copies the users' mailboxes while they stay live,
+# assigns the slots to their new shard, waits for every process to reload
+# the map, copies again what arrived meanwhile and purges the old shard.
+#
+# Group broadcasts are not sharded; the group routes refuse to run on
+# more than one shard.
+
+from collections import defaultdict
+from sqlalchemy import delete, exists, func, or_, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from . import crud, db as app_db, models, partitions
+
+logger = logging.getLogger(__name__)
+
+# Fixed for the life of the data: changing it remaps every user
+SHARD_SLOTS = 1024
+# Seconds between reloads of the slot map; moves wait twice as long
+SHARD_MAP_REFRESH = float(os.getenv("SHARD_MAP_REFRESH", "10"))
+# Users whose mailboxes are copied per transaction when rebalancing
+SHARD_COPY_BATCH = int(os.getenv("SHARD_COPY_BATCH", "200"))
+
+
+def enabled() -> bool:
+    return len(app_db.shards) > 1
+
+
+def shard_count() -> int:
+    return len(app_db.shards)
+
+
+def slot_of(user_id) -> int:
+    return uuid.UUID(str(user_id)).int % SHARD_SLOTS
+
+
+def session(index: int) -> Session:
+    """A new session on shard index; the caller closes it."""
+    db = app_db.SessionLocal()
+    app_db.use_shard(db, index)
+    return db
+
+
+class ShardMap:
+    """Slot assignments read from shard 0's shard_slots and kept in memory.
+
+    The map loads on first use; the API reloads it every SHARD_MAP_REFRESH
+    seconds (refresh_map), so a moved slot is routed to its new shard in
+    every process within that time.
+    """
+
+    def __init__(self):
+        self._slots = None
+        self._lock = Lock()
+
+    def load(self):
+        db = session(0)
+        try:
+            rows = db.execute(select(models.ShardSlot.slot, models.ShardSlot.shard)).all()
+        finally:
+            db.close()
+        self._slots = {slot: shard for slot, shard in rows}
+
+    def invalidate(self):
+        self._slots = None
+
+    def shard_of_slot(self, slot: int) -> int:
+        if self._slots is None:
+            with self._lock:
+                if self._slots is None:
+                    self.load()
+        return self._slots.get(slot, 0)
+
+    def shard_of(self, user_id) -> int:
+        return self.shard_of_slot(slot_of(user_id))
+
+
+shard_map = ShardMap()
+
+
+def shard_of(user_id) -> int:
+    return shard_map.shard_of(user_id)
+
+
+async def refresh_map(interval: float = SHARD_MAP_REFRESH):
+    """Reload the slot map every interval seconds, forever."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(shard_map.load)
+        except Exception:
+            logger.exception("Failed to reload the shard map")
+
+
+def user_scope(user_id, replica: bool = False):
+    """session_scope() for queries about one user.
+
+    Sharded, that is the user's shard; otherwise the primary, or a replica
+    with replica set.
+    """
+    if enabled():
+        return app_db.session_scope(shard=shard_of(user_id))
+    return app_db.session_scope(replica=replica)
+
+# Users
+
+
+def _copy_users(users: Iterable, shards: Iterable[int]) -> int:
+    rows = [{"id": user.id, "email": user.email, "name": user.name,
+             "created_at": user.created_at} for user in users]
+    copied = 0
+    if not rows:
+        return copied
+    table = models.User.__table__
+    for index in shards:
+        db = session(index)
+        try:
+            copied += db.execute(
+                crud._upsert(db, table).on_conflict_do_nothing(), rows).rowcount
+            db.commit()
+        except Exception:
+            # The users exist on shard 0; sync_users() fills the gap
+            logger.exception("Copying users to shard %d failed; "
+                             "run python -m app.manage sync-users", index)
+        finally:
+            db.close()
+    return copied
+
+
+def create_user(email: str, name: str) -> models.User:
+    """Create the user on shard 0, where emails are checked, then on the others."""
+    db = session(0)
+    try:
+        user = crud.create_user(db, email, name)
+    finally:
+        db.close()
+    _copy_users([user], range(1, shard_count()))
+    return user
+
+
+def create_users(users: Iterable[Tuple[str, str]]):
+    """crud.create_users on shard 0, with the created users copied to the others."""
+    db = session(0)
+    try:
+        created, existing = crud.create_users(db, users)
+    finally:
+        db.close()
+    _copy_users(created, range(1, shard_count()))
+    return created, existing
+
+
+def sync_users(batch_size: int = 1000) -> int:
+    """Copy users missing from any shard over from shard 0; returns rows copied."""
+    copied = 0
+    after = None
+    while True:
+        db = session(0)
+        try:
+            query = select(models.User).order_by(models.User.id).limit(batch_size)
+            if after is not None:
+                query = query.where(models.User.id > after)
+            users = db.scalars(query).all()
+        finally:
+            db.close()
+        if not users:
+            return copied
+        copied += _copy_users(users, range(1, shard_count()))
+        after = users[-1].id
+
+# Messages
+
+
+def send_message(sender_id: uuid.UUID, recipient_ids: Iterable[uuid.UUID], content: str,
+                 subject: Optional[str] = None, idempotency_key: Optional[str] = None,
+                 thread_id: Optional[uuid.UUID] = None,
+                 parent_id: Optional[uuid.UUID] = None) -> models.Message:
+    """crud.send_message across shards.
+
+    Each shard with recipients gets a copy of the message with their rows
+    and counters; the sender's shard, which also keeps the sent copy, is
+    written last. Shards commit one after the other, so a failure can
+    leave some recipients delivered. With an idempotency key the message
+    id is derived from the key and every shard written claims the key,
+    with the hash of the whole send: a retry skips the shards that already
+    have the message and is rejected on any shard that saw a different one.
+    """
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+    home = shard_of(sender_id)
+    by_shard = defaultdict(list)
+    for recipient_id in recipient_ids:
+        by_shard[shard_of(recipient_id)].append(recipient_id)
+    local = by_shard.pop(home, [])
+    request_hash = crud._send_hash(recipient_ids, subject, content, parent_id)
+
+    db = session(home)
+    try:
+        # Every shard has every user, so the sender's checks them all
+        missing = crud._missing_users(db, recipient_ids + [sender_id])
+        if missing:
+            raise crud.UnknownUsers(missing)
+        if idempotency_key is not None:
+            crud._check_idempotency_key(db, sender_id, idempotency_key, request_hash)
+    finally:
+        db.close()
+
+    message_id = uuid.uuid4()
+    if idempotency_key is not None:
+        # Derived from the key (with version 4 bits, like every message id)
+        derived = uuid.uuid5(uuid.UUID(str(sender_id)), idempotency_key)
+        message_id = uuid.UUID(bytes=derived.bytes, version=4)
+    copy = {"content": content, "subject": subject, "thread_id": thread_id or message_id,
+            "parent_id": parent_id, "message_id": message_id, "timestamp": models.utcnow(),
+            "queue": crud.delivers_later(recipient_ids), "idempotency_key": idempotency_key,
+            "request_hash": request_hash}
+    for index, shard_recipients in sorted(by_shard.items()):
+        db = session(index)
+        try:
+            crud.send_message(db, sender_id, shard_recipients, **copy)
+        except crud.IdempotentReplay:
+            # Delivered here by an earlier try
+            pass
+        finally:
+            db.close()
+    db = session(home)
+    try:
+        return crud.send_message(db, sender_id, local, **copy)
+    finally:
+        db.close()
+
+
+def get_message(message_id: uuid.UUID, include_recipients: bool = False
+                ) -> Optional[Tuple[models.Message, list]]:
+    """The message and, with include_recipients, its recipient rows from every shard.
+
+    None if no shard has the message.
+    """
+    message, recipients = None, []
+    for index in range(shard_count()):
+        db = session(index)
+        try:
+            found = crud.get_message(db, message_id, include_recipients)
+        finally:
+            db.close()
+        if found is None:
+            continue
+        if not include_recipients:
+            return found, []
+        message = message or found
+        recipients += found.recipients
+    return (message, recipients) if message is not None else None
+
+
+def delivery_pending(message_id: uuid.UUID) -> bool:
+    """crud.delivery_pending on any shard."""
+    for index in range(shard_count()):
+        db = session(index)
+        try:
+            if crud.delivery_pending(db, message_id):
+                return True
+        finally:
+            db.close()
+    return False
+
+
+def reply_to_message(message_id: uuid.UUID, sender_id: uuid.UUID, content: str,
+                     subject: Optional[str] = None,
+                     recipient_ids: Optional[Iterable[uuid.UUID]] = None,
+                     idempotency_key: Optional[str] = None
+                     ) -> Optional[Tuple[models.Message, List[uuid.UUID]]]:
+    """crud.reply_to_message across shards; the replier's shard checks the parent."""
+    db = session(shard_of(sender_id))
+    try:
+        reply = crud.prepare_reply(db, message_id, sender_id, subject, recipient_ids)
+    finally:
+        db.close()
+    if reply is None:
+        return None
+    if recipient_ids is None:
+        # The replier's copy only has the recipients on their shard
+        parent, recipients = get_message(message_id, include_recipients=True)
+        if parent.group_id is None:
+            everyone = [parent.sender_id, *(row.recipient_id for row in recipients)]
+            reply["recipient_ids"] = [
+                user_id for user_id in dict.fromkeys(everyone) if user_id != sender_id]
+    message = send_message(sender_id, content=content, idempotency_key=idempotency_key, **reply)
+    return message, reply["recipient_ids"]
+
+
+def get_thread_messages(thread_id: uuid.UUID, cursor: Optional[str] = None,
+                        limit: int = crud.DEFAULT_PAGE_SIZE, fields: str = "full"):
+    """crud.get_thread_messages merged from every shard.
+
+    Each shard's page is newest first, so the merged page is the newest
+    limit of them, with the copies of a message on several shards counted
+    once.
+    """
+    rows, more = {}, False
+    for index in range(shard_count()):
+        db = session(index)
+        try:
+            page, next_cursor = crud.get_thread_messages(db, thread_id, cursor, limit, fields)
+        finally:
+            db.close()
+        more = more or next_cursor is not None
+        for row in page:
+            rows.setdefault(row.id, row)
+    rows = sorted(rows.values(), key=lambda row: (row.timestamp, row.id), reverse=True)
+    next_cursor = None
+    if len(rows) > limit or more:
+        rows = rows[:limit]
+        next_cursor = crud.encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
+
+# Rebalancing
+
+
+def _slot_users(slots: Iterable[int]) -> Dict[int, List[uuid.UUID]]:
+    """Ids of the users in each slot, from shard 0's copy of users."""
+    slots = set(slots)
+    users = defaultdict(list)
+    db = session(0)
+    try:
+        for user_id in db.scalars(select(models.User.id).execution_options(yield_per=10000)):
+            slot = slot_of(user_id)
+            if slot in slots:
+                users[slot].append(user_id)
+    finally:
+        db.close()
+    return users
+
+
+def _insert_missing(db: Session, table, rows):
+    if rows:
+        db.execute(crud._upsert(db, table).on_conflict_do_nothing(), rows)
+
+
+def _copy_batch(source: Session, target: Session, user_ids: List[uuid.UUID]) -> int:
+    messages = models.Message.__table__
+    recipients = models.MessageRecipient.__table__
+    keys = models.IdempotencyKey.__table__
+    stats = models.UserMailboxStats.__table__
+
+    members = models.GroupMember.__table__
+    if source.scalar(select(exists().where(members.c.user_id.in_(user_ids)))):
+        # Broadcasts aren't sharded: give the members their rows now
+        for user_id in user_ids:
+            crud.sync_group_deliveries(source, user_id)
+
+    received = select(recipients.c.message_id).where(recipients.c.recipient_id.in_(user_ids))
+    message_rows = source.execute(select(messages).where(
+        or_(messages.c.id.in_(received), messages.c.sender_id.in_(user_ids)))).mappings().all()
+    body_hashes = {row["body_hash"] for row in message_rows if row["body_hash"]}
+    group_ids = {row["group_id"] for row in message_rows if row["group_id"]}
+    for table, column, wanted in ((models.MessageBody.__table__, "hash", body_hashes),
+                                  (models.Group.__table__, "id", group_ids)):
+        if wanted:
+            _insert_missing(target, table, source.execute(
+                select(table).where(table.c[column].in_(wanted))).mappings().all())
+    _insert_missing(target, messages, message_rows)
+
+    recipient_rows = source.execute(
+        select(recipients).where(recipients.c.recipient_id.in_(user_ids))).mappings().all()
+    if recipient_rows:
+        # Read marks only ever go one way, so a row read on either shard is read
+        stmt = crud._upsert(target, recipients)
+        key = ["message_id", "recipient_id"]
+        if partitions.is_partitioned(target):
+            key.append("message_timestamp")
+        target.execute(stmt.on_conflict_do_update(index_elements=key, set_={
+            "read": or_(recipients.c.read, stmt.excluded.read),
+            "read_at": func.coalesce(recipients.c.read_at, stmt.excluded.read_at)
+        }), recipient_rows)
+    _insert_missing(target, keys, source.execute(
+        select(keys).where(keys.c.sender_id.in_(user_ids))).mappings().all())
+
+    # Counters are recounted on the target; versions move past both
+    # shards' so cached pages and ETags turn over
+    versions = defaultdict(int)
+    for db in (source, target):
+        for user_id, version in db.execute(
+                select(stats.c.user_id, stats.c.version).where(stats.c.user_id.in_(user_ids))):
+            versions[user_id] = max(versions[user_id], version)
+    unread = dict(target.execute(
+        select(recipients.c.recipient_id, func.count())
+        .where(recipients.c.recipient_id.in_(user_ids), recipients.c.read == False)
+        .group_by(recipients.c.recipient_id)).all())
+    stmt = crud._upsert(target, stats)
+    target.execute(stmt.on_conflict_do_update(index_elements=[stats.c.user_id], set_={
+        "unread_count": stmt.excluded.unread_count, "version": stmt.excluded.version
+    }), [{"user_id": user_id, "unread_count": unread.get(user_id, 0),
+          "version": versions[user_id] + 1} for user_id in user_ids])
+    return len(recipient_rows)
+
+
+def copy_mailboxes(source: int, target: int, user_ids: List[uuid.UUID]) -> int:
+    """Copy the users' mailboxes from shard source to target.
+
+    Safe to repeat while the users stay live: rows already on the target
+    are kept and read marks merged. Returns the recipient rows copied.
+    """
+    copied = 0
+    for start in range(0, len(user_ids), SHARD_COPY_BATCH):
+        batch = user_ids[start:start + SHARD_COPY_BATCH]
+        source_db, target_db = session(source), session(target)
+        try:
+            copied += _copy_batch(source_db, target_db, batch)
+            target_db.commit()
+            source_db.commit()
+        finally:
+            source_db.close()
+            target_db.close()
+    return copied
+
+
+def purge_mailboxes(source: int, user_ids: List[uuid.UUID]) -> int:
+    """Delete moved users' mailboxes from shard source; returns recipient rows deleted.
+
+    Their messages go too, unless a recipient left on the shard or a
+    sender homed there still needs them. Broadcasts stay.
+    """
+    messages = models.Message.__table__
+    recipients = models.MessageRecipient.__table__
+    purged = 0
+    for start in range(0, len(user_ids), SHARD_COPY_BATCH):
+        batch = user_ids[start:start + SHARD_COPY_BATCH]
+        db = session(source)
+        try:
+            received = set(db.scalars(
+                delete(recipients).where(recipients.c.recipient_id.in_(batch))
+                .returning(recipients.c.message_id)))
+            purged += len(received)
+            db.execute(delete(models.UserMailboxStats.__table__).where(
+                models.UserMailboxStats.user_id.in_(batch)))
+            db.execute(delete(models.IdempotencyKey.__table__).where(
+                models.IdempotencyKey.sender_id.in_(batch)))
+            candidates = db.execute(
+                select(messages.c.id, messages.c.sender_id)
+                .where(or_(messages.c.id.in_(received), messages.c.sender_id.in_(batch)),
+                       messages.c.group_id.is_(None),
+                       ~exists().where(recipients.c.message_id == messages.c.id))).all()
+            orphans = [row.id for row in candidates if shard_of(row.sender_id) != source]
+            if orphans:
+                db.execute(delete(messages).where(messages.c.id.in_(orphans)))
+            db.commit()
+        finally:
+            db.close()
+    return purged
+
+
+def _assign(moves: Dict[int, int]):
+    table = models.ShardSlot.__table__
+    db = session(0)
+    try:
+        stmt = crud._upsert(db, table)
+        db.execute(stmt.on_conflict_do_update(index_elements=[table.c.slot], set_={
+            "shard": stmt.excluded.shard, "moved_at": stmt.excluded.moved_at
+        }), [{"slot": slot, "shard": shard, "moved_at": models.utcnow()}
+             for slot, shard in moves.items()])
+        db.commit()
+    finally:
+        db.close()
+    shard_map.load()
+
+
+def move_slots(moves: Dict[int, int], grace: float = 2 * SHARD_MAP_REFRESH,
+               log=logger.info) -> int:
+    """Move slots to new shards ({slot: shard}); returns the users moved.
+
+    Copies the mailboxes, assigns the slots, waits grace seconds for every
+    process to reload the map, copies what arrived on the old shards in
+    the meantime and purges them there.
+    """
+    shard_map.load()
+    moves = {slot: shard for slot, shard in moves.items()
+             if shard_map.shard_of_slot(slot) != shard}
+    if not moves:
+        return 0
+    for shard in moves.values():
+        if not 0 <= shard < shard_count():
+            raise ValueError(f"No shard {shard}; there are {shard_count()}")
+    sources = {slot: shard_map.shard_of_slot(slot) for slot in moves}
+    for source in set(sources.values()):
+        db = session(source)
+        try:
+            # Queued deliveries would land on the old shard after the purge
+            if crud.outbox_stats(db)[0]:
+                raise RuntimeError(f"Shard {source} has queued deliveries; drain the outbox first")
+        finally:
+            db.close()
+
+    def transfers():
+        # (source, target, user ids); reread so users created meanwhile move too
+        users = _slot_users(moves)
+        pairs = defaultdict(list)
+        for slot, target in moves.items():
+            pairs[sources[slot], target] += users.get(slot, [])
+        return [(source, target, user_ids) for (source, target), user_ids in pairs.items()]
+
+    for source, target, user_ids in transfers():
+        copied = copy_mailboxes(source, target, user_ids)
+        log(f"Copied {len(user_ids)} mailboxes ({copied} rows) from shard {source} to {target}")
+    _assign(moves)
+    log(f"Assigned {len(moves)} slots; waiting {grace:g}s for the map to reload")
+    time.sleep(grace)
+    moved = 0
+    for source, target, user_ids in transfers():
+        copy_mailboxes(source, target, user_ids)
+        purged = purge_mailboxes(source, user_ids)
+        log(f"Purged {len(user_ids)} mailboxes ({purged} rows) from shard {source}")
+        moved += len(user_ids)
+    return moved
+
+
+def plan_rebalance(shards: Optional[int] = None) -> Dict[int, int]:
+    """Moves that spread the slots evenly over the first shards shards.
+
+    Slots stay where they are when they can; the rest move from the most
+    loaded shards (and from shards past the first ``shards``) to the least.
+    """
+    shards = shards or shard_count()
+    owned = defaultdict(list)
+    for slot in range(SHARD_SLOTS):
+        owned[shard_map.shard_of_slot(slot)].append(slot)
+    quota = {index: SHARD_SLOTS // shards + (index < SHARD_SLOTS % shards)
+             for index in range(shards)}
+    spare = []
+    for index, slots in sorted(owned.items()):
+        keep = quota.get(index, 0)
+        spare += slots[keep:]
+    moves = {}
+    for index in range(shards):
+        short = quota[index] - min(len(owned[index]), quota[index])
+        for slot in spare[:short]:
+            moves[slot] = index
+        spare = spare[short:]
+    return moves
+
+
+def rebalance(shards: Optional[int] = None, grace: float = 2 * SHARD_MAP_REFRESH,
+              log=logger.info) -> int:
+    """Spread the slots evenly (see plan_rebalance); returns the users moved."""
+    shard_map.load()
+    moves = plan_rebalance(shards)
+    log(f"Moving {len(moves)} slots")
+    return move_slots(moves, grace, log)
+
+
+def status() -> List[dict]:
+    """Slots and users per shard."""
+    shard_map.load()
+    counts = [{"shard": index, "slots": 0, "users": 0} for index in range(shard_count())]
+    for slot in range(SHARD_SLOTS):
+        counts[shard_map.shard_of_slot(slot)]["slots"] += 1
+    for slot, users in _slot_users(range(SHARD_SLOTS)).items():
+        counts[shard_map.shard_of_slot(slot)]["users"] += len(users)
+    return counts
@@ -0,0 +1,82 @@
+# Benchmark group broadcasts against per-recipient fan-out
+#
+# Usage: python -m benchmarks.bench_broadcast [--recipients N] [--sends N] [--body-bytes N]
+# Runs against the database configured for the app (see app/db.py); the
+# storage figures need Postgres.
+
+import argparse
+import time
+
+from sqlalchemy import delete, text
+
+from app import crud, models
+from app.db import SessionLocal
+
+from .bench_send import cleanup, create_users
+
+TABLES = ("messages", "message_recipients", "message_bodies",
+          "group_members", "user_mailbox_stats")
+
+
+def storage(db):
+    """Total bytes of the mailbox tables, partitions and indexes included."""
+    return db.scalar(text(
+        "SELECT sum(coalesce((SELECT sum(pg_total_relation_size(relid)) "
+        "FROM pg_partition_tree(t) WHERE isleaf AND relid <> t), pg_total_relation_size(t))) "
+        "FROM unnest(CAST(:tables AS regclass[])) AS t"), {"tables": list(TABLES)})
+
+
+def timed(db, label, sends, send):
+    before = storage(db)
+    start = time.perf_counter()
+    for _ in range(sends):
+        send()
+    elapsed = time.perf_counter() - start
+    db.execute(text("CHECKPOINT"))
+    grown = storage(db) - before
+    print(f"{label:>10} ms/send={elapsed / sends * 1000:9.1f} "
+          f"storage/send={grown / sends / 1024:10.1f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, default=100_000)
+    parser.add_argument("--sends", type=int, default=5)
+    parser.add_argument("--body-bytes", type=int, default=8_000)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    user_ids = create_users(db, args.recipients + 1)
+    sender_id, recipients = user_ids[0], user_ids[1:]
+    body = ("announcement " * (args.body_bytes // 13 + 1))[:args.body_bytes]
+    group = None
+    try:
+        timed(db, "fan-out", args.sends, lambda: crud.send_message(
+            db, sender_id, recipients, body, subject="Announcement"))
+
+        start = time.perf_counter()
+        group = crud.create_group(db, f"bench-{sender_id}", recipients)
+        print(f"{'group':>10} members={args.recipients} "
+              f"created in {time.perf_counter() - start:.2f}s")
+        timed(db, "broadcast", args.sends, lambda: crud.broadcast_message(
+            db, sender_id, group.id, body, subject="Announcement"))
+
+        # What a member pays on their next mailbox read
+        start = time.perf_counter()
+        synced = crud.sync_group_deliveries(db, recipients[0])
+        print(f"{'sync':>10} rows={synced} ms={(time.perf_counter() - start) * 1000:.1f}")
+    finally:
+        if group is not None:
+            db.execute(delete(models.GroupMember).where(models.GroupMember.group_id == group.id))
+        db.execute(delete(models.UserMailboxStats).where(
+            models.UserMailboxStats.user_id.in_(user_ids)))
+        db.commit()
+        cleanup(db, user_ids)
+        if group is not None:
+            db.execute(delete(models.Group).where(models.Group.id == group.id))
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Benchmark inbox listing payloads: summary projection vs full messages
+#
+# Usage: python -m benchmarks.bench_listing [--messages N] [--body-bytes N] [--pages N]
+# Runs against the database configured for the app (see app/db.py).
+
+import argparse
+import time
+import uuid
+
+from sqlalchemy import text
+
+from app import crud, models, schemas
+from app.db import SessionLocal
+
+from .bench_send import cleanup, create_users
+
+
+def seed(db, sender_id, recipient_id, count, body_bytes):
+    body = ("lorem ipsum " * (body_bytes // 12 + 1))[:body_bytes]
+    messages = [
+        {"id": uuid.uuid4(), "subject": f"Benchmark {i}", "content": body,
+         "sender_id": sender_id, "timestamp": models.utcnow()}
+        for i in range(count)
+    ]
+    db.execute(models.Message.__table__.insert(), messages)
+    db.execute(models.MessageRecipient.__table__.insert(), [
+        {"id": uuid.uuid4(), "message_id": message["id"],
+         "recipient_id": recipient_id, "read": False,
+         "message_timestamp": message["timestamp"]}
+        for message in messages
+    ])
+    db.commit()
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("ANALYZE messages"))
+        db.execute(text("ANALYZE message_recipients"))
+        db.commit()
+
+
+def walk_inbox(db, user_id, fields, pages, limit):
+    """Read and serialize up to `pages` pages; returns (rows, bytes, seconds)."""
+    rows = size = 0
+    cursor = None
+    start = time.perf_counter()
+    for _ in range(pages):
+        items, cursor = crud.get_inbox_messages(db, user_id, cursor, limit, fields)
+        body = schemas.PAGE_SCHEMAS[fields].model_validate(
+            {"items": items, "next_cursor": cursor}, from_attributes=True).model_dump_json()
+        db.rollback()
+        rows += len(items)
+        size += len(body)
+        if cursor is None:
+            break
+    return rows, size, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--body-bytes", type=int, default=2_000)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=crud.DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    user_ids = create_users(db, 2)
+    sender_id, recipient_id = user_ids
+    try:
+        seed(db, sender_id, recipient_id, args.messages, args.body_bytes)
+        for fields in ("full", "summary"):
+            rows, size, elapsed = walk_inbox(db, recipient_id, fields, args.pages, args.limit)
+            pages = -(-rows // args.limit)
+            print(f"{fields:>7} rows={rows:>6} bytes/page={size // pages:>8} "
+                  f"rows/sec={rows / elapsed:10.0f}")
+    finally:
+        cleanup(db, user_ids)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
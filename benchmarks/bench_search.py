@@ -0,0 +1,108 @@
+# Benchmark full-text search latency on a large message corpus
+#
+# Usage: python -m benchmarks.bench_search [--messages N] [--users N] [--queries N]
+# Seeds the corpus server side with generate_series, so it needs Postgres.
+
+import argparse
+import statistics
+import time
+
+from sqlalchemy import text
+
+from app import crud
+from app.db import SessionLocal, engine
+
+from .bench_send import cleanup, create_users
+
+WORDS = (
+    "budget meeting invoice report launch schedule release review contract "
+    "design proposal travel lunch dinner deadline migration database server "
+    "customer support ticket outage incident retro planning hiring interview "
+    "offer payroll holiday vacation conference keynote demo prototype feedback "
+    "roadmap quarter forecast pricing discount partner vendor security audit "
+    "compliance backup restore deploy rollback feature bug patch upgrade"
+).split()
+
+QUERIES = [
+    ("common term", "budget"),
+    ("two terms", "budget deadline"),
+    ("phrase", '"security audit"'),
+    ("no match", "zeppelin"),
+]
+
+SEED_MESSAGES = text("""
+    INSERT INTO messages (id, subject, content, sender_id, timestamp)
+    SELECT gen_random_uuid(),
+           w[1 + (random() * (cardinality(w) - 1))::int] || ' ' ||
+           w[1 + (random() * (cardinality(w) - 1))::int],
+           array_to_string(ARRAY(
+               SELECT w[1 + (random() * (cardinality(w) - 1))::int]
+               FROM generate_series(1, 30) WHERE g > 0), ' '),
+           :sender_id,
+           now() - g * interval '1 second'
+    FROM generate_series(1, :count) AS g, (SELECT CAST(:words AS text[]) AS w) AS words
+""")
+
+SEED_RECIPIENTS = text("""
+    INSERT INTO message_recipients (id, message_id, recipient_id, read, message_timestamp)
+    SELECT gen_random_uuid(), m.id,
+           (CAST(:recipient_ids AS uuid[]))[1 + abs(hashtext(m.id::text)) % :users],
+           false, m.timestamp
+    FROM messages m WHERE m.sender_id = :sender_id
+""")
+
+
+def seed(db, sender_id, recipient_ids, count, batch=100_000):
+    for start in range(0, count, batch):
+        db.execute(SEED_MESSAGES, {"sender_id": sender_id, "words": WORDS,
+                                   "count": min(batch, count - start)})
+        db.commit()
+    db.execute(SEED_RECIPIENTS, {"recipient_ids": [str(r) for r in recipient_ids],
+                                 "users": len(recipient_ids), "sender_id": sender_id})
+    db.commit()
+    db.execute(text("ANALYZE messages"))
+    db.execute(text("ANALYZE message_recipients"))
+    db.commit()
+
+
+def percentile(samples, pct):
+    return statistics.quantiles(samples, n=100)[pct - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1_000,
+                        help="recipients the corpus is spread across")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if engine.dialect.name != "postgresql":
+        raise SystemExit("bench_search seeds its corpus with Postgres SQL")
+
+    db = SessionLocal()
+    user_ids = create_users(db, args.users + 1)
+    sender_id, recipients = user_ids[0], user_ids[1:]
+    try:
+        start = time.perf_counter()
+        seed(db, sender_id, recipients, args.messages)
+        print(f"seeded {args.messages} messages in {time.perf_counter() - start:.1f}s")
+
+        for folder, user_id in [("inbox", recipients[0]), ("sent", sender_id)]:
+            for label, query in QUERIES:
+                samples = []
+                for _ in range(args.queries):
+                    start = time.perf_counter()
+                    rows, _ = crud.search_messages(db, user_id, query, folder=folder)
+                    samples.append((time.perf_counter() - start) * 1000)
+                    db.rollback()
+                print(f"{folder:>5} {label:<12} rows={len(rows):>3} "
+                      f"p50={percentile(samples, 50):8.2f}ms "
+                      f"p95={percentile(samples, 95):8.2f}ms")
+    finally:
+        cleanup(db, user_ids)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
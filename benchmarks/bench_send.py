@@ -0,0 +1,117 @@
+# Benchmark send_message fan-out at different recipient counts
+#
+# Usage: python -m benchmarks.bench_send [--sends N] [--legacy] [--outbox]
+# Runs against the database configured for the app (see app/db.py).
+
+import argparse
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import delete
+
+from app import crud, models, outbox
+from app.db import SessionLocal
+
+RECIPIENT_COUNTS = [1, 100, 10_000]
+
+
+def create_users(db, count):
+    users = [
+        {"id": uuid.uuid4(), "email": f"bench-{uuid.uuid4()}@example.com",
+         "name": "Bench"}
+        for _ in range(count)
+    ]
+    db.execute(models.User.__table__.insert(), users)
+    db.commit()
+    return [user["id"] for user in users]
+
+
+def legacy_send(db, sender_id, recipient_ids, content, subject=None):
+    # The previous implementation: two commits, one ORM object per recipient
+    db_message = models.Message(
+        subject=subject, content=content, sender_id=sender_id)
+    db.add(db_message)
+    db.commit()
+    db.refresh(db_message)
+    for recipient_id in recipient_ids:
+        db.add(models.MessageRecipient(
+            message_id=db_message.id, recipient_id=recipient_id,
+            message_timestamp=db_message.timestamp))
+    db.commit()
+    return db_message
+
+
+def inline_send(db, sender_id, recipient_ids, content, subject=None):
+    # Fan out in the request whatever the recipient count
+    threshold, crud.OUTBOX_MIN_RECIPIENTS = crud.OUTBOX_MIN_RECIPIENTS, len(recipient_ids) + 1
+    try:
+        return crud.send_message(db, sender_id, recipient_ids, content, subject)
+    finally:
+        crud.OUTBOX_MIN_RECIPIENTS = threshold
+
+
+def queued_send(db, sender_id, recipient_ids, content, subject=None):
+    threshold, crud.OUTBOX_MIN_RECIPIENTS = crud.OUTBOX_MIN_RECIPIENTS, 1
+    try:
+        return crud.send_message(db, sender_id, recipient_ids, content, subject)
+    finally:
+        crud.OUTBOX_MIN_RECIPIENTS = threshold
+
+
+def cleanup(db, user_ids):
+    message_ids = db.query(models.Message.id).filter(
+        models.Message.sender_id.in_(user_ids))
+    db.execute(delete(models.OutboxEntry).where(
+        models.OutboxEntry.message_id.in_(message_ids)))
+    db.execute(delete(models.MessageRecipient).where(
+        models.MessageRecipient.message_id.in_(message_ids)))
+    db.execute(delete(models.Message).where(
+        models.Message.sender_id.in_(user_ids)))
+    db.execute(delete(models.UserMailboxStats).where(
+        models.UserMailboxStats.user_id.in_(user_ids)))
+    db.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+    db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sends", type=int, default=20)
+    parser.add_argument("--legacy", action="store_true",
+                        help="also time the per-row ORM implementation")
+    parser.add_argument("--outbox", action="store_true",
+                        help="also time queued sends and the worker draining them")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    user_ids = create_users(db, max(RECIPIENT_COUNTS) + 1)
+    sender_id, recipients = user_ids[0], user_ids[1:]
+    send_paths = [("bulk", inline_send)]
+    if args.legacy:
+        send_paths.append(("legacy", legacy_send))
+    if args.outbox:
+        send_paths.append(("queued", queued_send))
+    try:
+        for count in RECIPIENT_COUNTS:
+            sends = max(1, args.sends if count < 10_000 else args.sends // 10)
+            for label, send in send_paths:
+                start = time.perf_counter()
+                for _ in range(sends):
+                    send(db, sender_id, recipients[:count], "Benchmark body",
+                         subject="Benchmark")
+                elapsed = time.perf_counter() - start
+                print(f"{label:>6} recipients={count:>6} sends={sends:>4} "
+                      f"sends/sec={sends / elapsed:10.2f}")
+                if label == "queued":
+                    start = time.perf_counter()
+                    delivered = asyncio.run(outbox.drain())
+                    elapsed = time.perf_counter() - start
+                    print(f"{'drain':>6} recipients={count:>6} rows={delivered:>8} "
+                          f"rows/sec={delivered / elapsed:10.0f}")
+    finally:
+        cleanup(db, user_ids)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Microbenchmark listing page serialization
+#
+# Usage: python -m benchmarks.bench_serialize [--rounds N]
+# Fetches real pages once, then times only turning them into JSON bytes.
+# Runs against the database configured for the app (see app/db.py).
+
+import argparse
+import json
+import time
+from typing import Union
+
+from pydantic import TypeAdapter
+
+from app import crud, schemas
+from app.db import SessionLocal
+
+from .bench_listing import seed
+from .bench_send import cleanup, create_users
+
+PAGE_SIZES = [50, 200, 1000]
+
+# What a response_model route does with a returned page: validate it
+# against the declared model, dump it to Python, then the stdlib encoder
+_response_model = TypeAdapter(Union[schemas.MessageSummaryPage, schemas.MessagePage])
+
+
+def response_model_path(fields, rows, next_cursor):
+    page = schemas.PAGE_SCHEMAS[fields].model_validate(
+        {"items": rows, "next_cursor": next_cursor}, from_attributes=True)
+    content = _response_model.dump_python(
+        _response_model.validate_python(page), mode="json")
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def fast_path(fields, rows, next_cursor):
+    return schemas.render_page(fields, rows, next_cursor)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    user_ids = create_users(db, 2)
+    sender_id, recipient_id = user_ids
+    try:
+        seed(db, sender_id, recipient_id, max(PAGE_SIZES), 500)
+        for fields in ("summary", "full"):
+            for size in PAGE_SIZES:
+                rows, next_cursor = crud.get_inbox_messages(
+                    db, recipient_id, None, size, fields)
+                db.rollback()
+                results = []
+                for label, render in [("response_model", response_model_path),
+                                      ("fast", fast_path)]:
+                    render(fields, rows, next_cursor)
+                    start = time.perf_counter()
+                    for _ in range(args.rounds):
+                        render(fields, rows, next_cursor)
+                    per_page = (time.perf_counter() - start) / args.rounds * 1000
+                    results.append(per_page)
+                    print(f"{fields:>7} rows={size:>5} {label:>14} {per_page:8.3f}ms/page")
+                print(f"{'':>7} speedup {results[0] / results[1]:.1f}x")
+    finally:
+        cleanup(db, user_ids)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
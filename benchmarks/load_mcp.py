@@ -0,0 +1,58 @@
+# Load test the MCP tools and check that no pooled connections leak
+#
+# Usage: python -m benchmarks.load_mcp [--calls N] [--concurrency N]
+# Runs against the database configured for the app (see app/db.py).
+
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+
+from app import mcp_server
+from app.db import DB_ASYNC, async_engine, engine
+
+
+async def run(calls, concurrency):
+    sender = await mcp_server.create_user(
+        f"load-{uuid.uuid4()}@example.com", "Load Sender")
+    recipient = await mcp_server.create_user(
+        f"load-{uuid.uuid4()}@example.com", "Load Recipient")
+    sent = await mcp_server.send_message(
+        sender["id"], [recipient["id"]], "Load body", subject="Load")
+
+    tools = [
+        lambda: mcp_server.get_inbox_messages(recipient["id"], limit=10),
+        lambda: mcp_server.get_unread_messages(recipient["id"], limit=10),
+        lambda: mcp_server.get_sent_messages(sender["id"], limit=10),
+        lambda: mcp_server.mark_message_read(sent["message_id"], recipient["id"]),
+    ]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(i):
+        async with semaphore:
+            await tools[i % len(tools)]()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(calls)])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    elapsed = asyncio.run(run(args.calls, args.concurrency))
+    pool = (async_engine.sync_engine if DB_ASYNC else engine).pool
+    print(f"calls={args.calls} concurrency={args.concurrency} "
+          f"elapsed={elapsed:.2f}s calls/sec={args.calls / elapsed:.0f}")
+    print(f"pool: {pool.status()}")
+    if pool.checkedout():
+        print(f"LEAK: {pool.checkedout()} connections still checked out")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
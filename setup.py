@@ -7,9 +7,11 @@ setup(
     install_requires=[
         "fastapi>=0.104.0",
         "uvicorn>=0.24.0",
-        "sqlalchemy>=2.0.23",
+        "sqlalchemy[asyncio]>=2.0.23",
         "alembic>=1.12.1",
         "psycopg2-binary>=2.9.9",
+        "asyncpg>=0.29.0",
+        "aiosqlite>=0.19.0",
         "python-dotenv>=1.0.0",
         "pydantic>=2.4.2",
         "email-validator>=2.1.0",
@@ -0,0 +1,200 @@
+# Test the async session path against aiosqlite
+
+import asyncio
+from fastapi.testclient import TestClient
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import uuid
+from app import crud
+from app.db import Base, get_session, run_db
+from app.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def async_sqlite(tmp_path_factory):
+    url = f"sqlite+aiosqlite:///{tmp_path_factory.mktemp('async') / 'test.db'}"
+    engine = create_async_engine(url)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    AsyncTestingSession = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def override_get_session():
+        async with AsyncTestingSession() as db:
+            yield db
+
+    app.dependency_overrides[get_session] = override_get_session
+    yield
+    app.dependency_overrides.pop(get_session, None)
+    asyncio.run(engine.dispose())
+
+
+def test_async_message_flow():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "async-sender@example.com", "name": "Async Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "async-recipient@example.com", "name": "Async Recipient"}
+    ).json()["id"]
+
+    response = client.post(
+        "/api/v1/messages/",
+        json={
+            "subject": "Async",
+            "content": "Async Content",
+            "sender_id": sender_id,
+            "recipient_ids": [recipient_id]
+        }
+    )
+    assert response.status_code == 200
+    message_id = response.json()["id"]
+
+    inbox = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    assert [m["id"] for m in inbox["items"]] == [message_id]
+
+    response = client.post(
+        f"/api/v1/messages/{message_id}/read/{recipient_id}")
+    assert response.status_code == 200
+
+    unread = client.get(f"/api/v1/messages/unread/{recipient_id}").json()
+    assert unread["items"] == []
+
+    count = client.get(f"/api/v1/users/{recipient_id}/unread_count").json()
+    assert count["unread_count"] == 0
+
+    response = client.get(f"/api/v1/users/{sender_id}")
+    assert response.json()["email"] == "async-sender@example.com"
+
+
+def test_async_search_uses_fts5():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "fts-sender@example.com", "name": "FTS Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "fts-recipient@example.com", "name": "FTS Recipient"}
+    ).json()["id"]
+    for subject, content in [("Launch plan", "Rocket schedule"),
+                             ("Groceries", "Milk and \"eggs\" -- rocket fuel")]:
+        client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": subject,
+                "content": content,
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        )
+
+    response = client.get(
+        f"/api/v1/messages/search/{recipient_id}", params={"q": "rocket"})
+    assert response.status_code == 200
+    assert [m["subject"] for m in response.json()["items"]] == ["Launch plan", "Groceries"]
+
+    # Query syntax characters are matched literally rather than rejected
+    response = client.get(
+        f"/api/v1/messages/search/{recipient_id}", params={"q": 'eggs" OR ('})
+    assert response.status_code == 200
+
+
+def test_async_bulk_create_users():
+    users = [{"email": f"async-bulk-{i}@example.com", "name": "Async Bulk"} for i in range(3)]
+    data = client.post("/api/v1/users/bulk", json={"users": users}).json()
+    assert len(data["created"]) == 3
+
+    data = client.post("/api/v1/users/bulk", json={"users": users[:1]}).json()
+    assert data == {"created": [], "existing": ["async-bulk-0@example.com"]}
+
+
+def test_async_broadcast_and_shared_body():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "async-broadcaster@example.com", "name": "Async Broadcaster"}
+    ).json()["id"]
+    member_id = client.post(
+        "/api/v1/users/",
+        json={"email": "async-member@example.com", "name": "Async Member"}
+    ).json()["id"]
+    group_id = client.post(
+        "/api/v1/groups/", json={"name": "async-group", "member_ids": [member_id]}
+    ).json()["id"]
+
+    body = "nebula " * 1000
+    response = client.post(
+        f"/api/v1/groups/{group_id}/messages",
+        json={"sender_id": sender_id, "subject": "Shared", "content": body})
+    assert response.status_code == 200
+    assert response.json()["content"] == body
+
+    count = client.get(f"/api/v1/users/{member_id}/unread_count").json()
+    assert count["unread_count"] == 1
+    inbox = client.get(f"/api/v1/messages/inbox/{member_id}", params={"fields": "full"}).json()
+    assert [m["content"] for m in inbox["items"]] == [body]
+
+    # The FTS5 triggers index the body through message_bodies
+    response = client.get(f"/api/v1/messages/search/{member_id}", params={"q": "nebula"})
+    assert [m["subject"] for m in response.json()["items"]] == ["Shared"]
+
+
+def test_async_thread_inbox():
+    alice, bob = [
+        client.post(
+            "/api/v1/users/",
+            json={"email": f"async-thread-{name}@example.com", "name": name}
+        ).json()["id"]
+        for name in ("alice", "bob")
+    ]
+    first = client.post(
+        "/api/v1/messages/",
+        json={"subject": "First", "content": "One", "sender_id": alice, "recipient_ids": [bob]}
+    ).json()
+    second = client.post(
+        "/api/v1/messages/",
+        json={"subject": "Second", "content": "Two", "sender_id": alice, "recipient_ids": [bob]}
+    ).json()
+    reply = client.post(f"/api/v1/messages/{first['id']}/reply",
+                        json={"sender_id": bob, "content": "Back to you"}).json()
+    again = client.post(f"/api/v1/messages/{reply['id']}/reply",
+                        json={"sender_id": alice, "content": "And again"}).json()
+    assert again["thread_id"] == first["id"]
+
+    # SQLite picks each thread's latest row with row_number()
+    threads = client.get(f"/api/v1/messages/threads/{bob}").json()
+    assert [m["id"] for m in threads["items"]] == [again["id"], second["id"]]
+    page = client.get(f"/api/v1/threads/{first['id']}").json()
+    assert [m["id"] for m in page["items"]] == [again["id"], reply["id"], first["id"]]
+
+
+def test_async_outbox_delivery(monkeypatch):
+    monkeypatch.setattr(crud, "OUTBOX_MIN_RECIPIENTS", 2)
+    sender_id, *recipient_ids = [
+        client.post(
+            "/api/v1/users/",
+            json={"email": f"async-outbox-{i}@example.com", "name": "Async Outbox"}
+        ).json()["id"]
+        for i in range(3)
+    ]
+    response = client.post(
+        "/api/v1/messages/",
+        json={"content": "Later", "sender_id": sender_id, "recipient_ids": recipient_ids})
+    assert response.status_code == 202
+    assert client.get(f"/api/v1/messages/inbox/{recipient_ids[0]}").json()["items"] == []
+
+    async def deliver():
+        async for db in app.dependency_overrides[get_session]():
+            return await run_db(db, crud.deliver_outbox, 10)
+
+    entries = asyncio.run(deliver())
+    assert [entry.id for entry in entries] == [uuid.UUID(response.json()["id"])]
+    for recipient_id in recipient_ids:
+        count = client.get(f"/api/v1/users/{recipient_id}/unread_count").json()
+        assert count["unread_count"] == 1
+    assert asyncio.run(deliver()) == []
@@ -0,0 +1,136 @@
+# Test the mailbox response cache
+
+import asyncio
+import time
+from fastapi.testclient import TestClient
+import pytest
+from app import cache
+from app.main import app
+
+client = TestClient(app)
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis for RedisCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            return None
+        return value
+
+    async def set(self, key, value, px=None, nx=False):
+        if px is not None and px <= 0:
+            raise ValueError("invalid expire time in 'set' command")
+        if nx and await self.get(key) is not None:
+            return None
+        self.data[key] = (value, time.monotonic() + px / 1000 if px else None)
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def set(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    async def execute(self):
+        return [await self.redis.set(*args, **kwargs) for args, kwargs in self.calls]
+
+
+def test_lru_eviction_and_ttl():
+    async def run():
+        lru = cache.LRUCache(max_entries=2, ttl=0.05)
+        evictions = cache.cache_evictions.value()
+        await lru.set("a", "1")
+        await lru.set("b", "2")
+        await lru.get("a")
+        await lru.set("c", "3")
+        assert await lru.get("b") is None
+        assert await lru.get("a") == "1"
+        assert cache.cache_evictions.value() == evictions + 1
+
+        await asyncio.sleep(0.06)
+        assert await lru.get("a") is None
+
+    asyncio.run(run())
+
+
+def test_redis_backend_invalidation(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(cache, "mailbox_cache", cache.RedisCache(redis))
+
+    async def run():
+        user_id = "0b5c3a3e-7d1c-4e1a-9d7e-1f2a3b4c5d6e"
+        key = await cache.page_key(user_id, "inbox", None, 50)
+        await cache.set_page(key, "[]")
+        assert await cache.get_page(key) == "[]"
+        assert await cache.page_key(user_id, "inbox", None, 50) == key
+
+        await cache.invalidate([user_id])
+        assert await cache.page_key(user_id, "inbox", None, 50) != key
+        # Generation tokens expire too
+        assert all(expires is not None for _, expires in redis.data.values())
+
+        # Sub-second TTLs are kept, not truncated to an invalid 0
+        await cache.remember_writes([user_id], 0.05)
+        assert await cache.wrote_recently(user_id)
+        await asyncio.sleep(0.06)
+        assert not await cache.wrote_recently(user_id)
+
+    asyncio.run(run())
+
+
+def test_inbox_cache_hits_and_invalidation():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "cache-sender@example.com", "name": "Cache Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "cache-recipient@example.com", "name": "Cache Recipient"}
+    ).json()["id"]
+
+    def send(subject):
+        return client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": subject,
+                "content": "Cache Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        ).json()["id"]
+
+    send("Cache 1")
+    hits = cache.cache_hits.value()
+    first = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    second = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    assert first == second
+    assert cache.cache_hits.value() == hits + 1
+
+    # A new delivery invalidates the recipient's cached pages
+    message_id = send("Cache 2")
+    inbox = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    assert inbox["items"][0]["id"] == message_id
+
+    # So does marking a message read
+    unread = client.get(f"/api/v1/messages/unread/{recipient_id}").json()
+    assert len(unread["items"]) == 2
+    client.post(f"/api/v1/messages/{message_id}/read/{recipient_id}")
+    unread = client.get(f"/api/v1/messages/unread/{recipient_id}").json()
+    assert [m["subject"] for m in unread["items"]] == ["Cache 1"]
@@ -0,0 +1,142 @@
+# Test group broadcasts and deduplicated message bodies
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+from app import crud, models
+from app.db import SessionLocal
+from app.main import app
+
+client = TestClient(app)
+
+
+def _user(email):
+    return client.post("/api/v1/users/", json={"email": email, "name": email}).json()["id"]
+
+
+def _recipient_rows(message_id):
+    db = SessionLocal()
+    try:
+        return db.scalar(select(func.count()).select_from(models.MessageRecipient)
+                         .where(models.MessageRecipient.message_id == message_id))
+    finally:
+        db.close()
+
+
+def test_broadcast_delivers_lazily():
+    sender_id = _user("broadcast-sender@example.com")
+    first_id = _user("broadcast-first@example.com")
+    second_id = _user("broadcast-second@example.com")
+
+    response = client.post("/api/v1/groups/",
+                           json={"name": "everyone", "member_ids": [first_id, second_id]})
+    assert response.status_code == 200
+    group_id = response.json()["id"]
+    assert client.post("/api/v1/groups/", json={"name": "everyone"}).status_code == 400
+    response = client.post("/api/v1/groups/",
+                           json={"name": "nobody",
+                                 "member_ids": ["00000000-0000-4000-8000-000000000000"]})
+    assert response.status_code == 400
+
+    response = client.post(f"/api/v1/groups/{group_id}/messages",
+                           json={"sender_id": sender_id, "subject": "All hands",
+                                 "content": "Friday at ten"})
+    assert response.status_code == 200
+    broadcast = response.json()
+    assert broadcast["group_seq"] == 1
+    assert _recipient_rows(broadcast["id"]) == 0
+
+    # Counted before any recipient row exists
+    for user_id in (first_id, second_id):
+        assert client.get(f"/api/v1/users/{user_id}/unread_count").json()["unread_count"] == 1
+
+    # Reading the mailbox materializes the member's row
+    items = client.get(f"/api/v1/messages/unread/{first_id}").json()["items"]
+    assert [(item["id"], item["read"]) for item in items] == [(broadcast["id"], False)]
+    assert _recipient_rows(broadcast["id"]) == 1
+    assert client.get(f"/api/v1/users/{first_id}/unread_count").json()["unread_count"] == 1
+
+    # A broadcast can be marked read before the member's row exists
+    assert client.post(f"/api/v1/messages/{broadcast['id']}/read/{second_id}").status_code == 200
+    assert client.get(f"/api/v1/users/{second_id}/unread_count").json()["unread_count"] == 0
+    assert _recipient_rows(broadcast["id"]) == 2
+
+    # Members only receive what is sent after they join
+    late_id = _user("broadcast-late@example.com")
+    response = client.post(f"/api/v1/groups/{group_id}/members",
+                           json={"user_ids": [late_id, first_id]})
+    assert response.json() == {"added": 1}
+    assert client.get(f"/api/v1/messages/inbox/{late_id}").json()["items"] == []
+
+    # A broadcast changes members' ETags without touching their rows
+    etag = client.get(f"/api/v1/messages/inbox/{first_id}").headers["etag"]
+    client.post(f"/api/v1/groups/{group_id}/messages",
+                json={"sender_id": sender_id, "content": "Second"})
+    response = client.get(f"/api/v1/messages/inbox/{first_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # Inbox search syncs first too, and listing reads then find nothing pending
+    db = SessionLocal()
+    try:
+        assert crud.has_pending_broadcasts(db, second_id)
+    finally:
+        db.close()
+    items = client.get(f"/api/v1/messages/search/{second_id}", params={"q": "Second"}).json()["items"]
+    assert [item["snippet"] for item in items] == ["Second"]
+    db = SessionLocal()
+    try:
+        assert not crud.has_pending_broadcasts(db, second_id)
+    finally:
+        db.close()
+
+    # Leaving keeps what was delivered and never repeats a version
+    client.post(f"/api/v1/groups/{group_id}/messages",
+                json={"sender_id": sender_id, "content": "Third"})
+    db = SessionLocal()
+    try:
+        version = crud.get_mailbox_version(db, first_id)
+    finally:
+        db.close()
+    assert client.delete(f"/api/v1/groups/{group_id}/members/{first_id}").status_code == 200
+    assert client.delete(f"/api/v1/groups/{group_id}/members/{first_id}").status_code == 404
+    items = client.get(f"/api/v1/messages/inbox/{first_id}").json()["items"]
+    assert len(items) == 3
+    db = SessionLocal()
+    try:
+        assert crud.get_mailbox_version(db, first_id) > version
+    finally:
+        db.close()
+
+    assert client.get(f"/api/v1/groups/{group_id}").json()["message_count"] == 3
+    response = client.post("/api/v1/groups/00000000-0000-4000-8000-000000000000/messages",
+                           json={"sender_id": sender_id, "content": "Nobody"})
+    assert response.status_code == 404
+
+
+def test_large_bodies_are_stored_once():
+    sender_id = _user("body-sender@example.com")
+    recipient_id = _user("body-recipient@example.com")
+    body = "quarterly " + "x" * crud.BODY_DEDUP_BYTES
+
+    ids = [client.post("/api/v1/messages/",
+                       json={"sender_id": sender_id, "recipient_ids": [recipient_id],
+                             "subject": f"Report {i}", "content": body}).json()["id"]
+           for i in range(2)]
+
+    db = SessionLocal()
+    try:
+        rows = db.execute(select(models.Message.stored_content, models.Message.body_hash)
+                          .where(models.Message.id.in_(ids))).all()
+        assert {row.stored_content for row in rows} == {None}
+        assert len({row.body_hash for row in rows}) == 1
+        assert db.scalar(select(func.count()).select_from(models.MessageBody)) == 1
+    finally:
+        db.close()
+
+    assert client.get(f"/api/v1/messages/{ids[0]}").json()["content"] == body
+    page = client.get(f"/api/v1/messages/inbox/{recipient_id}", params={"fields": "full"}).json()
+    assert [item["content"] for item in page["items"]] == [body, body]
+    page = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    assert page["items"][0]["snippet"] == body[:crud.SNIPPET_LENGTH]
+    found = client.get(f"/api/v1/messages/search/{recipient_id}", params={"q": "quarterly"}).json()
+    assert sorted(item["id"] for item in found["items"]) == sorted(ids)
@@ -0,0 +1,57 @@
+# Test the MCP tool functions
+
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app import mcp_server
+from app.db import engine
+
+
+def test_mcp_message_flow():
+    async def flow():
+        sender = await mcp_server.create_user("mcp-sender@example.com", "MCP Sender")
+        recipient = await mcp_server.create_user("mcp-recipient@example.com", "MCP Recipient")
+        sent = await mcp_server.send_message(
+            sender["id"], [recipient["id"]], "MCP Content", subject="MCP")
+        unread = await mcp_server.get_unread_messages(recipient["id"])
+        assert [m["id"] for m in unread["items"]] == [sent["message_id"]]
+
+        await mcp_server.mark_message_read(sent["message_id"], recipient["id"])
+        unread = await mcp_server.get_unread_messages(recipient["id"])
+        assert unread["items"] == []
+
+        first = await mcp_server.send_message(
+            sender["id"], [recipient["id"]], "Once", idempotency_key="mcp-retry")
+        retry = await mcp_server.send_message(
+            sender["id"], [recipient["id"]], "Once", idempotency_key="mcp-retry")
+        assert retry == {"message_id": first["message_id"], "replayed": True, "queued": False}
+
+        with pytest.raises(HTTPException):
+            await mcp_server.create_user("mcp-sender@example.com", "Again")
+
+        created = await mcp_server.create_users([
+            {"email": "mcp-sender@example.com", "name": "Again"},
+            {"email": "mcp-bulk@example.com", "name": "MCP Bulk"}])
+        assert created["existing"] == ["mcp-sender@example.com"]
+        users = await mcp_server.get_users([created["created"][0]["id"], sender["id"]])
+        assert [user["email"] for user in users] == [
+            "mcp-bulk@example.com", "mcp-sender@example.com"]
+
+    asyncio.run(flow())
+    assert engine.pool.checkedout() == 0
+
+
+def test_mcp_tools_return_connections():
+    # More concurrent calls than the pool holds; a leaked session per call
+    # would exhaust it long before the end.
+    async def load():
+        user = await mcp_server.create_user("mcp-load@example.com", "MCP Load")
+        for _ in range(5):
+            await asyncio.gather(*[
+                mcp_server.get_inbox_messages(user["id"]) for _ in range(20)
+            ])
+        with pytest.raises(HTTPException):
+            await mcp_server.mark_message_read(user["id"], user["id"])
+
+    asyncio.run(load())
+    assert engine.pool.checkedout() == 0
@@ -1,7 +1,14 @@
 # Test message-related functionality
 
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
+from datetime import timedelta
+import asyncio
+import json
 import pytest
+from sqlalchemy import event
+from app import crud, models, outbox, partitions, schemas
+from app.db import SessionLocal, engine
 from app.main import app
 
 client = TestClient(app)
@@ -67,7 +74,7 @@ def test_get_inbox():
     # Get inbox
     response = client.get(f"/api/v1/messages/inbox/{recipient_id}")
     assert response.status_code == 200
-    messages = response.json()
+    messages = response.json()["items"]
     assert len(messages) > 0
     assert any(m["subject"] == "Inbox Test" for m in messages)
 
@@ -107,5 +114,701 @@ def test_mark_as_read():
     # Check unread messages
     unread_response = client.get(f"/api/v1/messages/unread/{recipient_id}")
     assert unread_response.status_code == 200
-    unread_messages = unread_response.json()
+    unread_messages = unread_response.json()["items"]
     assert not any(m["id"] == message_id for m in unread_messages)
+
+
+def test_inbox_pagination():
+    # Create sender and recipient
+    sender_response = client.post(
+        "/api/v1/users/",
+        json={"email": "sender4@example.com", "name": "Sender 4"}
+    )
+    sender_id = sender_response.json()["id"]
+
+    recipient_response = client.post(
+        "/api/v1/users/",
+        json={"email": "recipient4@example.com", "name": "Recipient 4"}
+    )
+    recipient_id = recipient_response.json()["id"]
+
+    # Send five messages
+    for i in range(5):
+        client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": f"Page Test {i}",
+                "content": "Page Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        )
+
+    # Walk the inbox two messages at a time
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get(
+            f"/api/v1/messages/inbox/{recipient_id}", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 2
+        seen.extend(m["subject"] for m in page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen == [f"Page Test {i}" for i in reversed(range(5))]
+
+    # Sent listing is paginated the same way
+    response = client.get(
+        f"/api/v1/messages/sent/{sender_id}", params={"limit": 3})
+    assert len(response.json()["items"]) == 3
+    assert response.json()["next_cursor"]
+
+    # Garbage cursors are rejected
+    response = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}", params={"cursor": "nope"})
+    assert response.status_code == 400
+
+
+def test_send_message_unknown_recipient():
+    sender_response = client.post(
+        "/api/v1/users/",
+        json={"email": "sender5@example.com", "name": "Sender 5"}
+    )
+    sender_id = sender_response.json()["id"]
+    unknown_id = "00000000-0000-4000-8000-000000000000"
+
+    response = client.post(
+        "/api/v1/messages/",
+        json={
+            "subject": "Nobody",
+            "content": "Nobody home",
+            "sender_id": sender_id,
+            "recipient_ids": [unknown_id]
+        }
+    )
+    assert response.status_code == 400
+    assert unknown_id in response.json()["detail"]
+
+    # Nothing was written for the rejected send
+    sent_response = client.get(f"/api/v1/messages/sent/{sender_id}")
+    assert sent_response.json()["items"] == []
+
+
+def test_unread_count():
+    sender_response = client.post(
+        "/api/v1/users/",
+        json={"email": "sender6@example.com", "name": "Sender 6"}
+    )
+    sender_id = sender_response.json()["id"]
+
+    recipient_response = client.post(
+        "/api/v1/users/",
+        json={"email": "recipient6@example.com", "name": "Recipient 6"}
+    )
+    recipient_id = recipient_response.json()["id"]
+
+    message_ids = []
+    for i in range(2):
+        message_response = client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": f"Count Test {i}",
+                "content": "Count Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        )
+        message_ids.append(message_response.json()["id"])
+
+    response = client.get(f"/api/v1/users/{recipient_id}/unread_count")
+    assert response.status_code == 200
+    assert response.json()["unread_count"] == 2
+
+    # Marking twice only counts once
+    for _ in range(2):
+        client.post(f"/api/v1/messages/{message_ids[0]}/read/{recipient_id}")
+    response = client.get(f"/api/v1/users/{recipient_id}/unread_count")
+    assert response.json()["unread_count"] == 1
+
+    # Reconciliation agrees with the maintained counter
+    db = SessionLocal()
+    try:
+        crud.rebuild_unread_counts(db)
+    finally:
+        db.close()
+    response = client.get(f"/api/v1/users/{recipient_id}/unread_count")
+    assert response.json()["unread_count"] == 1
+
+    response = client.get(
+        "/api/v1/users/00000000-0000-4000-8000-000000000000/unread_count")
+    assert response.status_code == 404
+
+
+def test_bulk_mark_as_read():
+    sender_response = client.post(
+        "/api/v1/users/",
+        json={"email": "sender7@example.com", "name": "Sender 7"}
+    )
+    sender_id = sender_response.json()["id"]
+
+    recipient_response = client.post(
+        "/api/v1/users/",
+        json={"email": "recipient7@example.com", "name": "Recipient 7"}
+    )
+    recipient_id = recipient_response.json()["id"]
+
+    message_ids = []
+    for i in range(4):
+        message_response = client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": f"Bulk Test {i}",
+                "content": "Bulk Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        )
+        message_ids.append(message_response.json()["id"])
+
+    # Batch mark the newest message; repeating it marks nothing
+    for expected in (1, 0):
+        response = client.post(
+            f"/api/v1/messages/read/{recipient_id}",
+            json={"message_ids": [message_ids[3]]}
+        )
+        assert response.status_code == 200
+        assert response.json()["marked"] == expected
+
+    # Mark everything up to the oldest message on the first page
+    page = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}", params={"limit": 2}).json()
+    response = client.post(
+        f"/api/v1/messages/read_all/{recipient_id}",
+        json={"cursor": page["next_cursor"]}
+    )
+    assert sorted(response.json()["message_ids"]) == sorted(message_ids[:3])
+
+    # Nothing is left to mark
+    response = client.post(
+        f"/api/v1/messages/read_all/{recipient_id}", json={})
+    assert response.json()["marked"] == 0
+
+    response = client.get(f"/api/v1/users/{recipient_id}/unread_count")
+    assert response.json()["unread_count"] == 0
+
+
+def test_inbox_etag():
+    sender_response = client.post(
+        "/api/v1/users/",
+        json={"email": "sender8@example.com", "name": "Sender 8"}
+    )
+    sender_id = sender_response.json()["id"]
+
+    recipient_response = client.post(
+        "/api/v1/users/",
+        json={"email": "recipient8@example.com", "name": "Recipient 8"}
+    )
+    recipient_id = recipient_response.json()["id"]
+
+    def send():
+        return client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": "ETag Test",
+                "content": "ETag Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        ).json()["id"]
+
+    message_id = send()
+    response = client.get(f"/api/v1/messages/inbox/{recipient_id}")
+    etag = response.headers["etag"]
+
+    # Unchanged mailbox: 304 with no body
+    response = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}",
+        headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # Different pages have different tags
+    response = client.get(
+        f"/api/v1/messages/unread/{recipient_id}",
+        headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # Read-state changes and deliveries both change the tag
+    client.post(f"/api/v1/messages/{message_id}/read/{recipient_id}")
+    response = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}",
+        headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    send()
+    response = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}",
+        headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 2
+
+
+def test_search_messages():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "search-sender@example.com", "name": "Search Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "search-recipient@example.com", "name": "Search Recipient"}
+    ).json()["id"]
+
+    def send(subject, content):
+        return client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": subject,
+                "content": content,
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        ).json()["id"]
+
+    in_subject = send("Quarterly budget", "Numbers attached")
+    in_content = send("Hello", "Let's talk about the budget tomorrow")
+    send("Lunch", "Pizza or tacos?")
+
+    # Subject matches rank above content matches
+    response = client.get(
+        f"/api/v1/messages/search/{recipient_id}", params={"q": "budgets"})
+    assert response.status_code == 200
+    assert [m["id"] for m in response.json()["items"]] == [in_subject, in_content]
+
+    page = client.get(
+        f"/api/v1/messages/search/{recipient_id}", params={"q": "budget", "limit": 1}).json()
+    assert [m["id"] for m in page["items"]] == [in_subject]
+    page = client.get(
+        f"/api/v1/messages/search/{recipient_id}",
+        params={"q": "budget", "limit": 1, "cursor": page["next_cursor"]}).json()
+    assert [m["id"] for m in page["items"]] == [in_content]
+    assert page["next_cursor"] is None
+
+    # Folders are per user
+    sent = client.get(
+        f"/api/v1/messages/search/{sender_id}", params={"q": "pizza", "folder": "sent"}).json()
+    assert len(sent["items"]) == 1
+    inbox = client.get(
+        f"/api/v1/messages/search/{sender_id}", params={"q": "pizza"}).json()
+    assert inbox["items"] == []
+
+
+def test_list_projections():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "slim-sender@example.com", "name": "Slim Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "slim-recipient@example.com", "name": "Slim Recipient"}
+    ).json()["id"]
+    body = "long body " * 100
+    client.post(
+        "/api/v1/messages/",
+        json={
+            "subject": "Slim",
+            "content": body,
+            "sender_id": sender_id,
+            "recipient_ids": [recipient_id]
+        }
+    )
+
+    # Summaries by default: a snippet and the read flag, no body
+    item = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()["items"][0]
+    assert "content" not in item
+    assert item["snippet"] == body[:crud.SNIPPET_LENGTH]
+    assert item["read"] is False
+    sent = client.get(f"/api/v1/messages/sent/{sender_id}").json()["items"][0]
+    assert sent["read"] is None
+
+    item = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}", params={"fields": "full"}).json()["items"][0]
+    assert item["content"] == body
+    assert "snippet" not in item
+
+    response = client.get(
+        f"/api/v1/messages/inbox/{recipient_id}", params={"fields": "bodies"})
+    assert response.status_code == 422
+
+
+def test_inbox_read_state_and_message_recipients():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "state-sender@example.com", "name": "State Sender"}
+    ).json()["id"]
+    recipient_ids = [
+        client.post(
+            "/api/v1/users/",
+            json={"email": f"state-recipient-{i}@example.com", "name": "State Recipient"}
+        ).json()["id"]
+        for i in range(3)
+    ]
+    message_id = client.post(
+        "/api/v1/messages/",
+        json={
+            "subject": "State",
+            "content": "State Content",
+            "sender_id": sender_id,
+            "recipient_ids": recipient_ids
+        }
+    ).json()["id"]
+    client.post(f"/api/v1/messages/{message_id}/read/{recipient_ids[0]}")
+
+    for fields in ("summary", "full"):
+        item = client.get(
+            f"/api/v1/messages/inbox/{recipient_ids[0]}", params={"fields": fields}
+        ).json()["items"][0]
+        assert item["read"] is True
+        assert item["read_at"] is not None
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        response = client.get(
+            f"/api/v1/messages/{message_id}", params={"include": "recipients"})
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert response.status_code == 200
+    recipients = {r["recipient_id"]: r["read"] for r in response.json()["recipients"]}
+    assert recipients == {recipient_id: recipient_id == recipient_ids[0]
+                          for recipient_id in recipient_ids}
+    # The message and all of its recipients, not one query per recipient
+    assert len(statements) == 2
+
+    assert "recipients" not in client.get(f"/api/v1/messages/{message_id}").json()
+
+
+def test_render_page_matches_model_serialization():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "render-sender@example.com", "name": "Render Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "render-recipient@example.com", "name": "Render Recipient"}
+    ).json()["id"]
+    for i in range(3):
+        client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": f"Render {i}",
+                "content": "Render Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        )
+
+    db = SessionLocal()
+    try:
+        for fields in crud.LIST_FIELDS:
+            rows, next_cursor = crud.get_inbox_messages(db, recipient_id, None, 2, fields)
+            expected = schemas.PAGE_SCHEMAS[fields].model_validate(
+                {"items": rows, "next_cursor": next_cursor}, from_attributes=True)
+            assert schemas.render_page(fields, rows, next_cursor) == expected.model_dump_json().encode()
+        assert schemas.render_page("summary", [], None) == b'{"items":[],"next_cursor":null}'
+    finally:
+        db.close()
+
+
+def test_export_messages():
+    user_id = client.post(
+        "/api/v1/users/",
+        json={"email": "export-user@example.com", "name": "Export User"}
+    ).json()["id"]
+    other_id = client.post(
+        "/api/v1/users/",
+        json={"email": "export-other@example.com", "name": "Export Other"}
+    ).json()["id"]
+    received = client.post(
+        "/api/v1/messages/",
+        json={"subject": "To export", "content": "Received body",
+              "sender_id": other_id, "recipient_ids": [user_id]}
+    ).json()["id"]
+    client.post(f"/api/v1/messages/{received}/read/{user_id}")
+    sent = client.post(
+        "/api/v1/messages/",
+        json={"subject": "From export", "content": "Sent body",
+              "sender_id": user_id, "recipient_ids": [other_id]}
+    ).json()["id"]
+
+    response = client.get(f"/api/v1/messages/export/{user_id}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [(line["folder"], line["id"]) for line in lines] == [
+        ("inbox", received), ("sent", sent)]
+    assert lines[0]["content"] == "Received body"
+    assert lines[0]["read"] is True and lines[0]["read_at"] is not None
+    assert lines[1]["read"] is None
+
+    response = client.get(f"/api/v1/messages/export/{user_id}", params={"folder": "sent"})
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [sent]
+
+    response = client.get("/api/v1/messages/export/00000000-0000-4000-8000-000000000000")
+    assert response.status_code == 404
+
+
+def test_inbox_pages_span_listing_windows():
+    user_id = client.post(
+        "/api/v1/users/",
+        json={"email": "window-user@example.com", "name": "Window User"}
+    ).json()["id"]
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "window-sender@example.com", "name": "Window Sender"}
+    ).json()["id"]
+
+    # One message inside each default window and one older than all of them
+    now = models.utcnow()
+    db = SessionLocal()
+    try:
+        ids = []
+        for days in (2, 100, 1000):
+            message = models.Message(subject=f"{days} days old", content="Old",
+                                     sender_id=sender_id, timestamp=now - timedelta(days=days))
+            db.add(message)
+            db.flush()
+            db.add(models.MessageRecipient(message_id=message.id, recipient_id=user_id,
+                                           read=False, message_timestamp=message.timestamp))
+            ids.append(str(message.id))
+        db.commit()
+    finally:
+        db.close()
+
+    first = client.get(f"/api/v1/messages/inbox/{user_id}", params={"limit": 2}).json()
+    assert [item["id"] for item in first["items"]] == ids[:2]
+    second = client.get(f"/api/v1/messages/inbox/{user_id}",
+                        params={"limit": 2, "cursor": first["next_cursor"]}).json()
+    assert [item["id"] for item in second["items"]] == ids[2:]
+    assert second["next_cursor"] is None
+
+    unread = client.get(f"/api/v1/messages/unread/{user_id}", params={"limit": 5}).json()
+    assert [item["id"] for item in unread["items"]] == ids
+
+    # A page that doesn't fill takes a query per window only when partitioned
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    db = SessionLocal()
+    try:
+        partitioned = partitions.listings_partitioned(db)
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            rows, next_cursor = crud.get_sent_messages(db, sender_id, limit=5)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+    finally:
+        db.close()
+    assert [str(row.id) for row in rows] == ids
+    assert len(statements) == (len(crud.LISTING_WINDOWS) + 1 if partitioned else 1)
+
+
+def test_idempotent_send():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "retry-sender@example.com", "name": "Retry Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "retry-recipient@example.com", "name": "Retry Recipient"}
+    ).json()["id"]
+    message = {"subject": "Retry", "content": "Sent once",
+               "sender_id": sender_id, "recipient_ids": [recipient_id]}
+
+    first = client.post("/api/v1/messages/", json=message,
+                        headers={"Idempotency-Key": "retry-1"})
+    assert first.status_code == 200
+    assert "idempotent-replayed" not in first.headers
+    retry = client.post("/api/v1/messages/", json=message,
+                        headers={"Idempotency-Key": "retry-1"})
+    assert retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+
+    response = client.post("/api/v1/messages/", json={**message, "content": "Changed"},
+                           headers={"Idempotency-Key": "retry-1"})
+    assert response.status_code == 422
+
+    # Concurrent retries wait on the first claim of the key
+    def send(_):
+        db = SessionLocal()
+        try:
+            return crud.send_message(db, sender_id, [recipient_id], "Raced",
+                                     idempotency_key="retry-2").id
+        except crud.IdempotentReplay as e:
+            return e.message_id
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(8) as pool:
+        assert len(set(pool.map(send, range(8)))) == 1
+
+    inbox = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()
+    assert len(inbox["items"]) == 2
+    count = client.get(f"/api/v1/users/{recipient_id}/unread_count").json()
+    assert count["unread_count"] == 2
+
+
+def test_threads():
+    alice, bob, carol, dave = [
+        client.post(
+            "/api/v1/users/",
+            json={"email": f"thread-{name}@example.com", "name": name}
+        ).json()["id"]
+        for name in ("alice", "bob", "carol", "dave")
+    ]
+    root = client.post(
+        "/api/v1/messages/",
+        json={"subject": "Offsite", "content": "Where to?", "sender_id": alice,
+              "recipient_ids": [bob, carol]}
+    ).json()
+    assert root["thread_id"] == root["id"]
+    assert root["parent_id"] is None
+
+    # Reply-all by default, in the parent's thread with its subject
+    response = client.post(f"/api/v1/messages/{root['id']}/reply",
+                           json={"sender_id": bob, "content": "The lake"})
+    assert response.status_code == 200
+    reply = response.json()
+    assert (reply["thread_id"], reply["parent_id"]) == (root["id"], root["id"])
+    assert reply["subject"] == "Re: Offsite"
+    alice_inbox = client.get(f"/api/v1/messages/inbox/{alice}").json()["items"]
+    assert [m["id"] for m in alice_inbox] == [reply["id"]]
+    carol_inbox = client.get(f"/api/v1/messages/inbox/{carol}").json()["items"]
+    assert [(m["id"], m["thread_id"]) for m in carol_inbox] == [
+        (reply["id"], root["id"]), (root["id"], root["id"])]
+
+    # A reply to a reply stays in the thread; "Re:" isn't stacked
+    nested = client.post(f"/api/v1/messages/{reply['id']}/reply",
+                         json={"sender_id": carol, "content": "Agreed",
+                               "recipient_ids": [alice]}).json()
+    assert (nested["thread_id"], nested["parent_id"]) == (root["id"], reply["id"])
+    assert nested["subject"] == "Re: Offsite"
+
+    response = client.post(f"/api/v1/messages/{root['id']}/reply",
+                           json={"sender_id": dave, "content": "Me too?"})
+    assert response.status_code == 403
+    response = client.post("/api/v1/messages/00000000-0000-4000-8000-000000000000/reply",
+                           json={"sender_id": alice, "content": "Hello?"})
+    assert response.status_code == 404
+
+    # Thread pages, newest first
+    page = client.get(f"/api/v1/threads/{root['id']}", params={"limit": 2}).json()
+    assert [m["id"] for m in page["items"]] == [nested["id"], reply["id"]]
+    page = client.get(f"/api/v1/threads/{root['id']}",
+                      params={"limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [m["id"] for m in page["items"]] == [root["id"]]
+    assert page["next_cursor"] is None
+    response = client.get("/api/v1/threads/00000000-0000-4000-8000-000000000000")
+    assert response.status_code == 404
+
+    # One row per thread: the latest message the user received in it
+    other = client.post(
+        "/api/v1/messages/",
+        json={"subject": "Lunch", "content": "Noon?", "sender_id": bob,
+              "recipient_ids": [alice]}
+    ).json()
+    threads = client.get(f"/api/v1/messages/threads/{alice}").json()
+    assert [(m["id"], m["thread_id"]) for m in threads["items"]] == [
+        (other["id"], other["id"]), (nested["id"], root["id"])]
+    page = client.get(f"/api/v1/messages/threads/{alice}", params={"limit": 1}).json()
+    page = client.get(f"/api/v1/messages/threads/{alice}",
+                      params={"limit": 1, "cursor": page["next_cursor"]}).json()
+    assert [m["id"] for m in page["items"]] == [nested["id"]]
+    assert page["next_cursor"] is None
+
+    # Messages from before threading are threads of their own
+    db = SessionLocal()
+    try:
+        db.query(models.Message).filter(models.Message.id == other["id"]).update(
+            {"thread_id": None})
+        db.commit()
+    finally:
+        db.close()
+    page = client.get(f"/api/v1/threads/{other['id']}").json()
+    assert [(m["id"], m["thread_id"]) for m in page["items"]] == [(other["id"], other["id"])]
+    reply = client.post(f"/api/v1/messages/{other['id']}/reply",
+                        json={"sender_id": alice, "content": "Sure"}).json()
+    assert reply["thread_id"] == other["id"]
+    page = client.get(f"/api/v1/threads/{other['id']}").json()
+    assert [m["id"] for m in page["items"]] == [reply["id"], other["id"]]
+
+
+def test_large_send_goes_through_outbox(monkeypatch):
+    monkeypatch.setattr(crud, "OUTBOX_MIN_RECIPIENTS", 3)
+    monkeypatch.setattr(crud, "OUTBOX_CHUNK", 2)
+    sender_id = client.post(
+        "/api/v1/users/", json={"email": "outbox-sender@example.com", "name": "Outbox"}
+    ).json()["id"]
+    recipient_ids = [
+        client.post(
+            "/api/v1/users/",
+            json={"email": f"outbox-recipient-{i}@example.com", "name": "Outbox Recipient"}
+        ).json()["id"]
+        for i in range(3)
+    ]
+    small = client.post(
+        "/api/v1/messages/",
+        json={"content": "Inline", "sender_id": sender_id, "recipient_ids": recipient_ids[:2]})
+    assert small.status_code == 200
+
+    queued = {"content": "Queued", "sender_id": sender_id, "recipient_ids": recipient_ids}
+    headers = {"Idempotency-Key": "outbox-once"}
+    response = client.post("/api/v1/messages/", json=queued, headers=headers)
+    assert response.status_code == 202
+    queued_id = response.json()["id"]
+    # A retry answers like the original while the delivery is queued
+    retry = client.post("/api/v1/messages/", json=queued, headers=headers)
+    assert (retry.status_code, retry.json()["id"]) == (202, queued_id)
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    response = client.post(
+        "/api/v1/messages/",
+        json={"content": "Nobody", "sender_id": sender_id,
+              "recipient_ids": recipient_ids[:2] + ["00000000-0000-4000-8000-000000000000"]})
+    assert response.status_code == 400
+
+    # Committed with two outbox entries, nothing delivered yet
+    db = SessionLocal()
+    try:
+        assert crud.outbox_stats(db)[0] == 2
+    finally:
+        db.close()
+    inbox = client.get(f"/api/v1/messages/inbox/{recipient_ids[2]}")
+    assert inbox.json()["items"] == []
+    etag = inbox.headers["etag"]
+    assert "outbox_queue_depth 2" in client.get("/metrics").text
+
+    assert asyncio.run(outbox.drain(batch_size=1)) == 3
+    assert asyncio.run(outbox.drain()) == 0
+    response = client.get(f"/api/v1/messages/inbox/{recipient_ids[2]}",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert [m["id"] for m in response.json()["items"]] == [queued_id]
+    for recipient_id in recipient_ids:
+        count = client.get(f"/api/v1/users/{recipient_id}/unread_count").json()
+        assert count["unread_count"] == (2 if recipient_id in recipient_ids[:2] else 1)
+    assert outbox.outbox_lag.count() >= 2
+    assert client.post("/api/v1/messages/", json=queued, headers=headers).status_code == 200
+    assert "outbox_queue_depth 0" in client.get("/metrics").text
@@ -0,0 +1,93 @@
+# Test the internal metrics endpoint
+
+from fastapi.testclient import TestClient
+from starlette.routing import Route
+import asyncio
+import logging
+import pytest
+import threading
+import uuid
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from app import crud, db, instrumentation, mcp_server
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_pool_metrics():
+    client.get("/api/v1/users/")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'db_pool_checked_out{engine="sync"} 0' in body
+    assert 'db_pool_size{engine="sync"}' in body
+    assert 'db_pool_wait_seconds_bucket{engine="sync",le="+Inf"}' in body
+
+
+def test_pool_wait_counts_only_exhausted_pools(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=0,
+                           poolclass=db._timed_pool(QueuePool, "wait-test"))
+    held = engine.connect()
+    # Connecting on a pool with room to grow isn't waiting
+    assert db.pool_wait_seconds.count(engine="wait-test") == 1
+    assert db.pool_wait_seconds._values[("wait-test",)][1] == 0
+
+    threading.Timer(0.1, held.close).start()
+    engine.connect().close()
+    assert db.pool_wait_seconds.count(engine="wait-test") == 2
+    assert db.pool_wait_seconds._values[("wait-test",)][1] >= 0.1
+    engine.dispose()
+
+
+def test_outbox_read_once_per_scrape(monkeypatch):
+    reads = []
+    outbox_stats = crud.outbox_stats
+    monkeypatch.setattr(crud, "outbox_stats", lambda db: reads.append(1) or outbox_stats(db))
+
+    body = client.get("/metrics").text
+    assert "outbox_queue_depth 0" in body
+    assert "outbox_oldest_entry_seconds 0" in body
+    assert len(reads) == 1
+
+
+def test_request_metrics(monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation, "SERVER_TIMING", True)
+    route = "/api/v1/users/{user_id}"
+    before = instrumentation.request_duration.count(method="GET", route=route, status=404)
+
+    response = client.get(f"/api/v1/users/{uuid.uuid4()}")
+    assert response.status_code == 404
+    assert response.headers["Server-Timing"].startswith('db;dur=')
+    assert '1 queries' in response.headers["Server-Timing"]
+    assert instrumentation.request_duration.count(
+        method="GET", route=route, status=404) == before + 1
+
+    # Every statement counts as slow at a threshold of 0.001 ms
+    monkeypatch.setattr(instrumentation, "SLOW_QUERY_MS", 0.001)
+    with caplog.at_level(logging.WARNING, logger="app.slow_queries"):
+        client.get(f"/api/v1/users/{uuid.uuid4()}/unread_count")
+    assert f"in /api/v1/users/{{user_id}}/unread_count: SELECT" in caplog.text
+
+    body = client.get("/metrics").text
+    assert f'db_queries_per_request_bucket{{route="{route}",le="1"}}' in body
+    assert f'http_request_duration_seconds_count{{method="GET",route="{route}",status="404"}}' in body
+    assert 'db_slow_queries_total{route="/api/v1/users/{user_id}/unread_count"}' in body
+
+
+def test_route_label_uses_route_template():
+    route = Route("/files/{name}/files/{rest:path}", lambda request: None)
+    scope = {"route": route, "path": "/api/files/files/files/a/b",
+             "path_params": {"name": "files", "rest": "a/b"}}
+    assert instrumentation._route_label(scope) == "/api/files/{name}/files/{rest}"
+    assert instrumentation._route_label({"path": f"/{uuid.uuid4()}", "root_path": ""}) == "unmatched"
+
+
+def test_mcp_tool_metrics():
+    before = instrumentation.request_queries.count(route="mcp:get_users")
+    asyncio.run(mcp_server.get_users([str(uuid.uuid4())]))
+    assert instrumentation.request_queries.count(route="mcp:get_users") == before + 1
+    assert instrumentation.request_duration.count(
+        method="MCP", route="mcp:get_users", status="ok") >= 1
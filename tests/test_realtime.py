@@ -0,0 +1,95 @@
+# Test real-time mailbox notifications
+
+import asyncio
+import json
+import uuid
+from fastapi.testclient import TestClient
+import pytest
+from app import realtime
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_websocket_delivery():
+    sender_id = client.post(
+        "/api/v1/users/",
+        json={"email": "ws-sender@example.com", "name": "WS Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/",
+        json={"email": "ws-recipient@example.com", "name": "WS Recipient"}
+    ).json()["id"]
+
+    with client.websocket_connect(f"/ws/{recipient_id}") as websocket:
+        message_id = client.post(
+            "/api/v1/messages/",
+            json={
+                "subject": "Live",
+                "content": "Live Content",
+                "sender_id": sender_id,
+                "recipient_ids": [recipient_id]
+            }
+        ).json()["id"]
+        event = json.loads(websocket.receive_text())
+        assert event["type"] == "message"
+        assert event["message_id"] == message_id
+        assert event["sender_id"] == sender_id
+
+        # Client frames (app-level pings) don't cost events
+        for _ in range(3):
+            websocket.send_text("ping")
+            realtime.hub.dispatch([uuid.UUID(recipient_id)], '{"type": "ping-test"}')
+        assert [websocket.receive_text() for _ in range(3)] == ['{"type": "ping-test"}'] * 3
+
+    assert realtime.hub.connection_count() == 0
+
+
+def test_broadcast_reaches_connected_members():
+    users = [client.post("/api/v1/users/", json={"email": f"ws-group-{name}@example.com",
+                                                 "name": name}).json()["id"]
+             for name in ("sender", "member", "outsider")]
+    sender_id, member_id, outsider_id = users
+    group_id = client.post("/api/v1/groups/",
+                           json={"name": "ws-group", "member_ids": [member_id]}).json()["id"]
+
+    with client.websocket_connect(f"/ws/{outsider_id}") as outsider, \
+            client.websocket_connect(f"/ws/{member_id}") as member:
+        message_id = client.post(f"/api/v1/groups/{group_id}/messages",
+                                 json={"sender_id": sender_id, "content": "All hands"}).json()["id"]
+        assert json.loads(member.receive_text())["message_id"] == message_id
+        # The outsider's next event is the direct message, not the broadcast
+        direct_id = client.post("/api/v1/messages/", json={
+            "sender_id": sender_id, "recipient_ids": [outsider_id], "content": "Just you"
+        }).json()["id"]
+        assert json.loads(outsider.receive_text())["message_id"] == direct_id
+
+
+def test_slow_subscriber_is_told_to_resync():
+    async def run():
+        subscription = realtime.Subscription("user", max_events=3)
+        for i in range(5):
+            subscription.offer(json.dumps({"n": i}))
+        events = [await subscription.get() for _ in range(2)]
+        assert events == [realtime.RESYNC_EVENT, json.dumps({"n": 4})]
+
+        byte_limited = realtime.Subscription("user", max_bytes=10)
+        byte_limited.offer("x" * 11)
+        assert await byte_limited.get() == realtime.RESYNC_EVENT
+
+    asyncio.run(run())
+
+
+def test_sse_stream():
+    async def run():
+        stream = realtime.sse_events("sse-user", heartbeat=0.01)
+        # Nothing is subscribed until the stream starts
+        assert realtime.hub.connection_count() == 0
+        assert await stream.__anext__() == ": keepalive\n\n"
+        assert realtime.hub.connection_count() == 1
+        realtime.hub.dispatch(["sse-user"], '{"type": "message"}')
+        assert await stream.__anext__() == 'data: {"type": "message"}\n\n'
+        await stream.aclose()
+        assert realtime.hub.connection_count() == 0
+
+    asyncio.run(run())
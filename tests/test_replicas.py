@@ -0,0 +1,110 @@
+# Test read/write splitting across a primary and replicas
+
+import asyncio
+import uuid
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from app import db as app_db, models
+from app.db import Base, ReplicaPool, RoutingSession
+from app.main import app
+
+client = TestClient(app)
+
+
+def _sqlite(tmp_path, name):
+    engine = create_engine(f"sqlite:///{tmp_path / name}.db")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def _add_user(engine, email):
+    user_id = uuid.uuid4()
+    with engine.begin() as connection:
+        connection.execute(models.User.__table__.insert(),
+                           {"id": user_id, "email": email, "name": email})
+    return user_id
+
+
+def test_routing_session(tmp_path):
+    primary, replica = _sqlite(tmp_path, "primary"), _sqlite(tmp_path, "replica")
+    on_primary = _add_user(primary, "on-primary@example.com")
+    on_replica = _add_user(replica, "on-replica@example.com")
+    Session = sessionmaker(class_=RoutingSession, bind=primary)
+
+    with Session() as db:
+        assert db.get(models.User, on_primary) is not None
+
+    with Session() as db:
+        db.info["replica"] = replica
+        assert db.get(models.User, on_replica) is not None
+        assert db.get(models.User, on_primary) is None
+        # Locking reads go to the primary
+        locked = select(models.User.email).where(models.User.id == on_primary).with_for_update()
+        assert db.scalar(locked) == "on-primary@example.com"
+        # After a write the session reads its own writes
+        db.add(models.User(email="new@example.com", name="New"))
+        db.flush()
+        assert db.scalar(select(models.User.id).where(models.User.email == "new@example.com"))
+        assert db.get(models.User, on_primary) is not None
+        db.commit()
+
+
+def test_replica_pool_skips_failed_replicas(tmp_path):
+    first, second = _sqlite(tmp_path, "first"), _sqlite(tmp_path, "second")
+    broken = create_engine(f"sqlite:///{tmp_path / 'missing' / 'broken.db'}")
+    pool = ReplicaPool([first, broken, second], retry=60)
+    assert [pool.pick() for _ in range(3)] == [first, broken, second]
+
+    # A failed connection takes the replica out of the rotation
+    Session = sessionmaker(class_=RoutingSession, bind=first)
+    with Session() as db:
+        db.info["replica"] = broken
+        try:
+            db.execute(select(models.User.id))
+        except Exception:
+            pass
+    assert not pool.is_up(broken)
+    assert {pool.pick() for _ in range(4)} == {first, second}
+
+    # Health checks keep it out until it answers
+    asyncio.run(pool.check())
+    assert not pool.is_up(broken)
+    (tmp_path / "missing").mkdir()
+    asyncio.run(pool.check())
+    assert pool.is_up(broken)
+
+    assert ReplicaPool([broken]).pick() is broken
+    down = ReplicaPool([broken], retry=60)
+    down.mark_down(broken)
+    assert down.pick() is None
+
+
+def test_reads_use_replica_until_user_writes(tmp_path, monkeypatch):
+    replica = _sqlite(tmp_path, "app-replica")
+    monkeypatch.setattr(app_db, "replicas", ReplicaPool([replica]))
+
+    # Read-only routes are answered by the replica
+    replica_only = _add_user(replica, "replica-only@example.com")
+    assert client.get(f"/api/v1/users/{replica_only}").status_code == 200
+    sender_id = client.post(
+        "/api/v1/users/", json={"email": "replica-sender@example.com", "name": "Sender"}
+    ).json()["id"]
+    recipient_id = client.post(
+        "/api/v1/users/", json={"email": "replica-recipient@example.com", "name": "Recipient"}
+    ).json()["id"]
+    assert client.get(f"/api/v1/users/{sender_id}").status_code == 404
+
+    # ...except for a user who just wrote, who reads from the primary
+    message_id = client.post(
+        "/api/v1/messages/",
+        json={"content": "Sticky", "sender_id": sender_id, "recipient_ids": [recipient_id]}
+    ).json()["id"]
+    sent = client.get(f"/api/v1/messages/sent/{sender_id}").json()["items"]
+    assert [m["id"] for m in sent] == [message_id]
+    assert client.get(f"/api/v1/users/{sender_id}").status_code == 200
+    assert client.get(f"/api/v1/messages/inbox/{recipient_id}").json()["items"] == []
+
+    client.post(f"/api/v1/messages/{message_id}/read/{recipient_id}")
+    inbox = client.get(f"/api/v1/messages/inbox/{recipient_id}").json()["items"]
+    assert [(m["id"], m["read"]) for m in inbox] == [(message_id, True)]
@@ -0,0 +1,166 @@
+# Test mailboxes sharded by user id, with SQLite files as the shards
+
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+from app import db as app_db, models, sharding
+from app.db import Base, RoutingSession
+from app.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    engines = []
+    for index in range(3):
+        engine = create_engine(f"sqlite:///{tmp_path / f'shard-{index}'}.db")
+        Base.metadata.create_all(engine)
+        engines.append(engine)
+    monkeypatch.setattr(app_db, "shards", engines)
+    monkeypatch.setattr(app_db, "SessionLocal", sessionmaker(
+        class_=RoutingSession, autocommit=False, autoflush=False, bind=engines[0]))
+    sharding.shard_map.invalidate()
+    # Every slot starts on shard 0; spread them while there's nothing to move
+    sharding.rebalance(grace=0)
+    yield engines
+    sharding.shard_map.invalidate()
+
+
+def _users_on_shards(count, shards_wanted):
+    """Create users until each wanted shard has one; returns {shard: user_id}."""
+    users = {}
+    for i in range(200):
+        user = client.post(
+            "/api/v1/users/", json={"email": f"shard-{uuid.uuid4()}@example.com", "name": "U"}
+        ).json()
+        users.setdefault(sharding.shard_of(user["id"]), uuid.UUID(user["id"]))
+        if all(shard in users for shard in shards_wanted):
+            return users
+    raise AssertionError("users did not cover the shards")
+
+
+def _count(engine, column, user_id):
+    with engine.connect() as connection:
+        return connection.scalar(select(func.count()).where(column == user_id))
+
+
+def test_rebalance_spreads_slots(shards):
+    assert [row["slots"] for row in sharding.status()] == [342, 341, 341]
+    # Users are copied to every shard
+    users = _users_on_shards(3, [0, 1, 2])
+    for engine in shards:
+        assert _count(engine, models.User.id, users[1]) == 1
+
+
+def test_sharded_mailboxes(shards):
+    users = _users_on_shards(3, [0, 1, 2])
+    sender, first, second = users[0], users[1], users[2]
+
+    response = client.post("/api/v1/messages/", json={
+        "sender_id": str(sender), "recipient_ids": [str(first), str(second)],
+        "subject": "Sharded", "content": "Hello shards"
+    })
+    assert response.status_code == 200
+    message_id = response.json()["id"]
+
+    # Recipient rows live on the recipient's shard only
+    recipient = models.MessageRecipient.recipient_id
+    assert [_count(engine, recipient, first) for engine in shards] == [0, 1, 0]
+    assert [_count(engine, recipient, second) for engine in shards] == [0, 0, 1]
+
+    for user_id in (first, second):
+        inbox = client.get(f"/api/v1/messages/inbox/{user_id}").json()["items"]
+        assert [m["id"] for m in inbox] == [message_id]
+        assert client.get(f"/api/v1/users/{user_id}/unread_count").json()["unread_count"] == 1
+    sent = client.get(f"/api/v1/messages/sent/{sender}").json()["items"]
+    assert [m["id"] for m in sent] == [message_id]
+
+    assert client.post(f"/api/v1/messages/{message_id}/read/{first}").status_code == 200
+    assert client.get(f"/api/v1/users/{first}/unread_count").json()["unread_count"] == 0
+    assert client.get(f"/api/v1/users/{second}/unread_count").json()["unread_count"] == 1
+
+    # Recipients are gathered from every shard
+    message = client.get(f"/api/v1/messages/{message_id}?include=recipients").json()
+    assert {(r["recipient_id"], r["read"]) for r in message["recipients"]} == {
+        (str(first), True), (str(second), False)}
+
+    # Reply-all reaches the sender and the recipient on the other shard
+    reply = client.post(f"/api/v1/messages/{message_id}/reply", json={
+        "sender_id": str(first), "content": "Back at you"}).json()
+    assert reply["subject"] == "Re: Sharded"
+    for user_id in (sender, second):
+        inbox = client.get(f"/api/v1/messages/inbox/{user_id}").json()["items"]
+        assert reply["id"] in [m["id"] for m in inbox]
+    thread = client.get(f"/api/v1/threads/{message_id}?limit=1").json()
+    assert [m["id"] for m in thread["items"]] == [reply["id"]]
+    older = client.get(f"/api/v1/threads/{message_id}?cursor={thread['next_cursor']}").json()
+    assert [m["id"] for m in older["items"]] == [message_id]
+    assert older["next_cursor"] is None
+
+    # A retry with the same key is answered from the sender's shard
+    send = {"sender_id": str(sender), "recipient_ids": [str(second)], "content": "Once"}
+    headers = {"Idempotency-Key": "sharded-once"}
+    original = client.post("/api/v1/messages/", json=send, headers=headers).json()
+    retried = client.post("/api/v1/messages/", json=send, headers=headers)
+    assert retried.headers["Idempotent-Replayed"] == "true"
+    assert retried.json()["id"] == original["id"]
+
+    assert client.post("/api/v1/groups/", json={"name": "sharded"}).status_code == 501
+
+
+def test_move_slot_keeps_mailbox(shards):
+    users = _users_on_shards(3, [0, 1, 2])
+    sender, mover, other = users[0], users[1], users[2]
+    first = client.post("/api/v1/messages/", json={
+        "sender_id": str(sender), "recipient_ids": [str(mover), str(other)], "content": "One"
+    }).json()["id"]
+    second = client.post("/api/v1/messages/", json={
+        "sender_id": str(mover), "recipient_ids": [str(other)], "content": "Two"
+    }).json()["id"]
+    client.post(f"/api/v1/messages/{first}/read/{mover}")
+    etag = client.get(f"/api/v1/messages/inbox/{mover}").headers["ETag"]
+
+    assert sharding.move_slots({sharding.slot_of(mover): 2}, grace=0) >= 1
+    assert sharding.shard_of(mover) == 2
+
+    recipient = models.MessageRecipient.recipient_id
+    assert [_count(engine, recipient, mover) for engine in shards] == [0, 0, 1]
+    assert _count(shards[1], models.Message.sender_id, mover) == 0
+    inbox = client.get(f"/api/v1/messages/inbox/{mover}")
+    assert [(m["id"], m["read"]) for m in inbox.json()["items"]] == [(first, True)]
+    assert inbox.headers["ETag"] != etag
+    sent = client.get(f"/api/v1/messages/sent/{mover}").json()["items"]
+    assert [m["id"] for m in sent] == [second]
+    assert client.get(f"/api/v1/users/{mover}/unread_count").json()["unread_count"] == 0
+    # The other recipients' copies are untouched
+    inbox = client.get(f"/api/v1/messages/inbox/{other}").json()["items"]
+    assert {m["id"] for m in inbox} == {first, second}
+
+
+def test_sharded_idempotency_key_covers_every_shard(shards):
+    users = _users_on_shards(3, [0, 1, 2])
+    sender, first, second = users[0], users[1], users[2]
+    send = {"sender_id": str(sender), "recipient_ids": [str(first)], "content": "Once"}
+    headers = {"Idempotency-Key": "sharded-key"}
+    message_id = client.post("/api/v1/messages/", json=send, headers=headers).json()["id"]
+
+    # Other recipients with the same key are another send, though neither is on the sender's shard
+    changed = {**send, "recipient_ids": [str(second)]}
+    assert client.post("/api/v1/messages/", json=changed, headers=headers).status_code == 422
+
+    # As if the sender's shard had failed: its copy and key are gone, shard 1's stay
+    with shards[0].begin() as connection:
+        connection.execute(models.IdempotencyKey.__table__.delete())
+        connection.execute(models.Message.__table__.delete())
+    changed = {**send, "recipient_ids": [str(first), str(second)]}
+    assert client.post("/api/v1/messages/", json=changed, headers=headers).status_code == 422
+    retried = client.post("/api/v1/messages/", json=send, headers=headers)
+    assert retried.status_code == 200
+    assert retried.json()["id"] == message_id
+    recipient = models.MessageRecipient.recipient_id
+    assert [_count(engine, recipient, first) for engine in shards] == [0, 1, 0]
+    sent = client.get(f"/api/v1/messages/sent/{sender}").json()["items"]
+    assert [m["id"] for m in sent] == [message_id]
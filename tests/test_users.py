@@ -40,3 +40,46 @@ def test_get_user():
     data = response.json()
     assert data["email"] == "get@example.com"
     assert data["name"] == "Get User"
+
+
+def test_bulk_create_and_lookup_users():
+    response = client.post(
+        "/api/v1/users/bulk",
+        json={"users": [
+            {"email": f"bulk-{i}@example.com", "name": f"Bulk {i}"} for i in range(5)
+        ] + [{"email": "bulk-0@example.com", "name": "Duplicate"}]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert sorted(user["email"] for user in data["created"]) == [
+        f"bulk-{i}@example.com" for i in range(5)]
+    assert data["existing"] == []
+
+    # Existing emails are skipped, not errors
+    response = client.post(
+        "/api/v1/users/bulk",
+        json={"users": [{"email": "bulk-1@example.com", "name": "Again"},
+                        {"email": "bulk-5@example.com", "name": "Bulk 5"}]}
+    )
+    data = response.json()
+    assert [user["email"] for user in data["created"]] == ["bulk-5@example.com"]
+    assert data["existing"] == ["bulk-1@example.com"]
+
+    # Paginated prefix listing in email order
+    seen = []
+    params = {"email_prefix": "bulk-", "limit": 4}
+    while True:
+        response = client.get("/api/v1/users/", params=params)
+        seen.extend(user["email"] for user in response.json())
+        if "x-next-cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["x-next-cursor"]
+    assert seen == [f"bulk-{i}@example.com" for i in range(6)]
+
+    # Batch lookup keeps request order and drops unknown ids
+    ids = [user["id"] for user in client.get(
+        "/api/v1/users/", params={"email_prefix": "bulk-"}).json()]
+    response = client.get(
+        "/api/v1/users/",
+        params={"ids": [ids[2], "00000000-0000-4000-8000-000000000000", ids[0]]})
+    assert [user["id"] for user in response.json()] == [ids[2], ids[0]]